@@ -0,0 +1,136 @@
+#   Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import division
+
+import os
+import sys
+import unittest
+import numpy as np
+# add python path of PadleDetection to sys.path
+parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 4)))
+if parent_path not in sys.path:
+    sys.path.append(parent_path)
+
+from ppdet.py_op.bbox import bbox_overlaps
+from ppdet.py_op.target import label_anchor, label_bbox
+
+
+def ref_label_anchor(anchors, gt_boxes):
+    # previous label_anchor on the full overlap matrix
+    iou = bbox_overlaps(anchors, gt_boxes)
+    gt_bbox_anchor_inds = iou.argmax(axis=0)
+    gt_bbox_anchor_iou = iou[gt_bbox_anchor_inds, np.arange(iou.shape[1])]
+    gt_bbox_anchor_iou_inds = np.where(iou == gt_bbox_anchor_iou)[0]
+    anchor_gt_bbox_inds = iou.argmax(axis=1)
+    anchor_gt_bbox_iou = iou[np.arange(iou.shape[0]), anchor_gt_bbox_inds]
+    labels = np.ones((iou.shape[0], ), dtype=np.int32) * -1
+    labels[gt_bbox_anchor_iou_inds] = 1
+    return anchor_gt_bbox_inds, anchor_gt_bbox_iou, labels
+
+
+def ref_label_bbox(boxes, gt_boxes, gt_classes, is_crowd, class_nums=81):
+    # previous label_bbox on the full overlap matrix
+    iou = bbox_overlaps(boxes, gt_boxes)
+    roi_gt_bbox_inds = np.zeros((boxes.shape[0]), dtype=np.int32)
+    roi_gt_bbox_iou = np.zeros((boxes.shape[0], class_nums), dtype=np.float32)
+    iou_argmax = iou.argmax(axis=1)
+    iou_max = iou.max(axis=1)
+    overlapped = np.where(iou_max > 0)[0]
+    roi_gt_bbox_inds[overlapped] = iou_argmax[overlapped]
+    roi_gt_bbox_iou[overlapped, gt_classes[iou_argmax[overlapped]]] = \
+        iou_max[overlapped]
+    roi_gt_bbox_iou[np.where(is_crowd)[0]] = -1
+    return roi_gt_bbox_inds, roi_gt_bbox_iou.argmax(
+        axis=1), roi_gt_bbox_iou.max(axis=1)
+
+
+def make_boxes(num, height, width, step=None):
+    x1 = np.random.uniform(0, width - 8., num)
+    y1 = np.random.uniform(0, height - 8., num)
+    x2 = np.minimum(x1 + np.random.uniform(8., 300., num), width - 1)
+    y2 = np.minimum(y1 + np.random.uniform(8., 300., num), height - 1)
+    boxes = np.stack([x1, y1, x2, y2], axis=-1)
+    if step is not None:
+        # snap to a grid, so that many overlaps tie
+        boxes = np.round(boxes / step) * step
+    return boxes.astype(np.float32)
+
+
+def make_anchors(height, width, stride=16):
+    ys, xs = np.meshgrid(
+        np.arange(0, height, stride), np.arange(0, width, stride), indexing='ij')
+    anchors = []
+    for size in [32, 64, 128, 256]:
+        for ratio in [0.5, 1., 2.]:
+            w = size / np.sqrt(ratio)
+            h = size * np.sqrt(ratio)
+            anchors.append(
+                np.stack(
+                    [xs - w / 2, ys - h / 2, xs + w / 2, ys + h / 2],
+                    axis=-1).reshape(-1, 4))
+    return np.concatenate(anchors).astype(np.float32)
+
+
+class TestTarget(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.height = 320
+        self.width = 480
+
+    def assert_outputs_equal(self, ref, out):
+        for r, o in zip(ref, out):
+            self.assertEqual(r.dtype, o.dtype)
+            self.assertTrue(np.array_equal(r, o))
+
+    def test_label_anchor(self):
+        anchors = make_anchors(self.height, self.width)
+        for step in [None, 8.]:
+            for gt_num in [1, 20]:
+                gt_boxes = make_boxes(gt_num, self.height, self.width, step)
+                ref = ref_label_anchor(anchors, gt_boxes)
+                self.assert_outputs_equal(
+                    ref, label_anchor(
+                        anchors, gt_boxes, prune=True))
+                self.assert_outputs_equal(
+                    ref, label_anchor(
+                        anchors, gt_boxes, prune=False))
+
+    def test_anchor_cache(self):
+        anchors = make_anchors(self.height, self.width)
+        gt_boxes = make_boxes(20, self.height, self.width)
+        label_anchor(anchors, gt_boxes)
+        # anchors differing in a single row must not share a cached index
+        for row in [1, anchors.shape[0] // 2 + 1]:
+            moved = anchors.copy()
+            moved[row] = gt_boxes[0]
+            self.assert_outputs_equal(
+                ref_label_anchor(moved, gt_boxes),
+                label_anchor(
+                    moved, gt_boxes, prune=True))
+
+    def test_label_bbox(self):
+        for step in [None, 8.]:
+            gt_boxes = make_boxes(20, self.height, self.width, step)
+            gt_classes = np.random.randint(1, 81, 20).astype(np.int32)
+            is_crowd = (np.random.rand(20) < 0.2).astype(np.int32)
+            rois = make_boxes(500, self.height, self.width, step)
+            boxes = np.vstack([gt_boxes, rois]).astype(np.float32)
+            ref = ref_label_bbox(boxes, gt_boxes, gt_classes, is_crowd)
+            out = label_bbox(boxes, gt_boxes, gt_classes, is_crowd)
+            self.assert_outputs_equal(ref, out)
+
+
+if __name__ == '__main__':
+    unittest.main()
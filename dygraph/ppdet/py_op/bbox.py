@@ -2,7 +2,9 @@ import numpy as np
 from numba import jit
 
 
-@jit
+# numba can not type the list arguments, keep the object mode
+# the bare @jit used to fall back to
+@jit(forceobj=True)
 def bbox2delta(bboxes1, bboxes2, weights):
     ex_w = bboxes1[:, 2] - bboxes1[:, 0] + 1
     ex_h = bboxes1[:, 3] - bboxes1[:, 1] + 1
@@ -124,7 +126,16 @@ def bbox_overlaps(bboxes1, bboxes2):
     return overlaps
 
 
-@jit
+@jit(nopython=True)
+def _nms_order(scores):
+    # numba's argsort breaks ties unlike numpy's, multiclass_nms shares it
+    # with nms so that both keep the same boxes
+    return scores.argsort()[::-1]
+
+
+# the empty list return can not be typed, keep the object mode the bare
+# @jit used to fall back to, the loop below is still compiled
+@jit(forceobj=True)
 def nms(dets, thresh):
     if dets.shape[0] == 0:
         return []
@@ -134,10 +145,10 @@ def nms(dets, thresh):
     x2 = dets[:, 3]
     y2 = dets[:, 4]
     areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
+    order = _nms_order(scores)
 
     ndets = dets.shape[0]
-    suppressed = np.zeros((ndets), dtype=np.int)
+    suppressed = np.zeros((ndets), dtype=np.int64)
 
     for _i in range(ndets):
         i = order[_i]
@@ -166,6 +177,92 @@ def nms(dets, thresh):
     return np.where(suppressed == 0)[0]
 
 
+def multiclass_nms(boxes,
+                   scores,
+                   labels,
+                   nms_thresh,
+                   keep_top_k=-1,
+                   batch_inds=None):
+    """
+    Greedy NMS over the candidates of all classes and images in one pass.
+    Candidates only suppress others of the same image and class, as if
+    every class was offset to its own coordinate range. Each round keeps
+    the best remaining candidate of every class and drops what overlaps
+    it, so the number of rounds is the largest per-class keep count.
+
+    Args:
+        boxes (np.ndarray): candidate boxes, shape [N, 4]
+        scores (np.ndarray): candidate scores, shape [N]
+        labels (np.ndarray): class id of every candidate, shape [N]
+        nms_thresh (float): overlap threshold of the suppression
+        keep_top_k (int): detections kept per image over all classes,
+            ties with the k-th score are kept, -1 keeps all
+        batch_inds (np.ndarray|None): image index of every candidate
+
+    Returns:
+        keep (np.ndarray): indices of the kept candidates, ordered by
+            image, class and then candidate index
+    """
+    num = len(scores)
+    if batch_inds is None:
+        batch_inds = np.zeros((num, ), dtype=np.int64)
+    if num == 0:
+        return np.zeros((0, ), dtype=np.int64)
+    labels = np.asarray(labels).astype(np.int64)
+    batch_inds = np.asarray(batch_inds).astype(np.int64)
+    groups = batch_inds * (labels.max() - labels.min() + 1) + (
+        labels - labels.min())
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    # every group in the order nms visits it, ties included, as the
+    # reversed argsort of the group's scores
+    by_group = np.argsort(groups, kind='mergesort')
+    splits = np.flatnonzero(np.diff(groups[by_group])) + 1
+    order = np.concatenate([
+        inds[_nms_order(scores[inds])]
+        for inds in np.split(by_group, splits)
+    ])
+    keep = []
+    while order.size > 0:
+        group = groups[order]
+        first = np.ones(order.shape, dtype=np.bool_)
+        first[1:] = group[1:] != group[:-1]
+        leaders = order[first]
+        keep.append(leaders)
+        leader = leaders[np.cumsum(first)[~first] - 1]
+        order = order[~first]
+        xx1 = np.maximum(x1[leader], x1[order])
+        yy1 = np.maximum(y1[leader], y1[order])
+        xx2 = np.minimum(x2[leader], x2[order])
+        yy2 = np.minimum(y2[leader], y2[order])
+        w = np.maximum(0.0, (xx2 - xx1).astype(np.float64) + 1)
+        h = np.maximum(0.0, (yy2 - yy1).astype(np.float64) + 1)
+        inter = w * h
+        ovr = inter / (
+            (areas[leader] + areas[order]).astype(np.float64) - inter)
+        order = order[~(ovr >= nms_thresh)]
+    keep = np.concatenate(keep)
+
+    # Limit to keep_top_k detections **over all classes** of each image
+    if keep_top_k > -1:
+        keep_batch = batch_inds[keep]
+        keep_scores = scores[keep]
+        valid = np.ones(keep.shape, dtype=np.bool_)
+        for i in np.unique(keep_batch):
+            im_inds = np.where(keep_batch == i)[0]
+            if len(im_inds) > keep_top_k:
+                im_scores = keep_scores[im_inds]
+                kth = len(im_scores) - keep_top_k
+                image_thresh = im_scores[np.argpartition(im_scores, kth)[kth]]
+                valid[im_inds] = im_scores >= image_thresh
+        keep = keep[valid]
+    return keep[np.lexsort((keep, groups[keep]))]
+
+
 def nms_with_decode(bboxes,
                     bbox_probs,
                     bbox_deltas,
@@ -228,7 +325,9 @@ def nms_with_decode(bboxes,
     return new_bboxes_num, im_results
 
 
-@jit
+# numba can not type the list arguments, keep the object mode
+# the bare @jit used to fall back to
+@jit(forceobj=True)
 def compute_bbox_targets(bboxes1, bboxes2, labels, bbox_reg_weights):
     assert bboxes1.shape[0] == bboxes2.shape[0]
     assert bboxes1.shape[1] == 4
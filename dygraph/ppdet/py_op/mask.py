@@ -1,7 +1,6 @@
-import six
 import math
 import numpy as np
-from numba import jit
+from numba import jit, prange
 
 
 @jit
@@ -15,18 +14,27 @@ def decode(cnts, m):
     return mask
 
 
-#@jit 
-def poly2mask(xy, k, h, w):
+@jit(nopython=True)
+def _poly2mask_kernel(xy, k, h, w, mask):
+    """Rasterize one polygon the way COCO's rleFrPoly does and OR it into
+    mask of shape (h, w).
+    """
     scale = 5.
-    x = [int(scale * p + 0.5) for p in xy[::2]]
-    x = x + [x[0]]
-    y = [int(scale * p + 0.5) for p in xy[1::2]]
-    y = y + [y[0]]
-    m = sum([
-        int(max(abs(x[j] - x[j + 1]), abs(y[j] - y[j + 1]))) + int(1)
-        for j in range(k)
-    ])
-    u, v = [], []
+    x = np.empty((k + 1, ), dtype=np.int64)
+    y = np.empty((k + 1, ), dtype=np.int64)
+    for j in range(k):
+        x[j] = int(scale * xy[2 * j] + 0.5)
+        y[j] = int(scale * xy[2 * j + 1] + 0.5)
+    x[k] = x[0]
+    y[k] = y[0]
+
+    # upsampled boundary points
+    m = 0
+    for j in range(k):
+        m += max(abs(x[j] - x[j + 1]), abs(y[j] - y[j + 1])) + 1
+    u = np.empty((m, ), dtype=np.int64)
+    v = np.empty((m, ), dtype=np.int64)
+    m = 0
     for j in range(k):
         xs = x[j]
         xe = x[j + 1]
@@ -38,66 +46,44 @@ def poly2mask(xy, k, h, w):
         if flip:
             xs, xe = xe, xs
             ys, ye = ye, ys
-
         if dx >= dy:
-            if (dx == 0):
-                assert ye - ys == 0
-
-            s = 0 if dx == 0 else float(ye - ys) / dx
+            s = 0. if dx == 0 else float(ye - ys) / dx
+            for d in range(dx + 1):
+                t = dx - d if flip else d
+                u[m] = xs + t
+                v[m] = int(ys + s * t + .5)
+                m += 1
         else:
-            if (dy == 0):
-                assert xe - xs == 0
-            s = 0 if dy == 0 else float(xe - xs) / dy
-
-        if dx >= dy:
-            ts = [dx - d if flip else d for d in range(dx + 1)]
-            u.extend([xs + t for t in ts])
-            v.extend([int(ys + s * t + .5) for t in ts])
-        else:
-            ts = [dy - d if flip else d for d in range(dy + 1)]
-            v.extend([t + ys for t in ts])
-            u.extend([int(xs + s * t + .5) for t in ts])
-
-    k = len(u)
-    x = np.zeros((k), np.int)
-    y = np.zeros((k), np.int)
-    m = 0
-    for j in six.moves.xrange(1, k):
+            s = 0. if dy == 0 else float(xe - xs) / dy
+            for d in range(dy + 1):
+                t = dy - d if flip else d
+                v[m] = t + ys
+                u[m] = int(xs + s * t + .5)
+                m += 1
+
+    # every x boundary crossing toggles the column-major mask from there on
+    toggle = np.zeros((h * w + 1, ), dtype=np.uint8)
+    for j in range(1, m):
         if u[j] != u[j - 1]:
-            xd = float(u[j] if (u[j] < u[j - 1]) else (u[j] - 1))
+            xd = float(u[j] if u[j] < u[j - 1] else u[j] - 1)
             xd = (xd + .5) / scale - .5
-            if (math.floor(xd) != xd or xd < 0 or xd > (w - 1)):
+            if math.floor(xd) != xd or xd < 0 or xd > w - 1:
                 continue
             yd = float(v[j] if v[j] < v[j - 1] else v[j - 1])
             yd = (yd + .5) / scale - .5
-            yd = math.ceil(0 if yd < 0 else (h if yd > h else yd))
-            x[m] = int(xd)
-            y[m] = int(yd)
-            m += 1
-    k = m
-    a = [int(x[i] * h + y[i]) for i in range(k)]
-    a.append(h * w)
-    a.sort()
-    b = [0] + a[:len(a) - 1]
-    a = [c - d for (c, d) in zip(a, b)]
-
-    k += 1
-    b = [0 for i in range(k)]
-    b[0] = a[0]
-    m, j = 1, 1
-    while (j < k):
-        if a[j] > 0:
-            b[m] = a[j]
-            m += 1
-            j += 1
-        else:
-            j += 1
-            if (j < k):
-                b[m - 1] += a[j]
-                j += 1
-    mask = decode(b, m)
-    mask = np.array(mask, dtype=np.int).reshape((w, h))
-    mask = mask.transpose((1, 0))
+            yd = 0. if yd < 0 else (float(h) if yd > h else yd)
+            toggle[int(xd) * h + int(math.ceil(yd))] ^= 1
+    inside = 0
+    for i in range(w):
+        for j in range(h):
+            inside ^= toggle[i * h + j]
+            if inside:
+                mask[j, i] = 1
+
+
+def poly2mask(xy, k, h, w):
+    mask = np.zeros((h, w), dtype=np.int64)
+    _poly2mask_kernel(np.asarray(xy, dtype=np.float64), k, h, w, mask)
     return mask
 
 
@@ -144,40 +130,59 @@ def bbox_overlaps_mask(boxes, query_boxes):
     return overlaps
 
 
-@jit
+@jit(nopython=True, parallel=True)
+def _polys_to_masks_kernel(coords, poly_offsets, gt_poly_offsets, gt_inds,
+                           boxes, M):
+    masks = np.zeros((boxes.shape[0], M, M), dtype=np.int32)
+    for r in prange(boxes.shape[0]):
+        x0 = boxes[r, 0]
+        y0 = boxes[r, 1]
+        w = max(boxes[r, 2] - boxes[r, 0], np.float32(1.))
+        h = max(boxes[r, 3] - boxes[r, 1], np.float32(1.))
+        gt_ind = gt_inds[r]
+        for p in range(gt_poly_offsets[gt_ind], gt_poly_offsets[gt_ind + 1]):
+            poly = coords[poly_offsets[p]:poly_offsets[p + 1]]
+            xy = np.empty((poly.shape[0], ), dtype=np.float64)
+            for i in range(0, poly.shape[0], 2):
+                xy[i] = (poly[i] - x0) * np.float32(M) / w
+                xy[i + 1] = (poly[i + 1] - y0) * np.float32(M) / h
+            _poly2mask_kernel(xy, poly.shape[0] // 2, M, M, masks[r])
+    return masks
+
+
+def polys_to_masks_wrt_boxes(gt_polys, gt_inds, boxes, M):
+    """Rasterize the polygons of gt_polys[gt_inds[i]] inside boxes[i] to
+    an M x M binary mask for every box, see polys_to_mask_wrt_box. All
+    boxes of an image are rasterized in one compiled call.
+    """
+    coords = []
+    poly_offsets = [0]
+    gt_poly_offsets = [0]
+    for polygons in gt_polys:
+        for poly in polygons:
+            p = np.array(poly, dtype=np.float32).reshape(-1)
+            assert p.shape[0] % 2 == 0, p.shape
+            coords.append(p)
+            poly_offsets.append(poly_offsets[-1] + p.shape[0])
+        gt_poly_offsets.append(len(coords))
+    coords = np.concatenate(coords) if len(coords) > 0 else np.zeros(
+        (0, ), dtype=np.float32)
+    return _polys_to_masks_kernel(
+        coords,
+        np.array(poly_offsets, dtype=np.int64),
+        np.array(gt_poly_offsets, dtype=np.int64),
+        np.asarray(gt_inds, dtype=np.int64),
+        np.ascontiguousarray(boxes, dtype=np.float32), int(M))
+
+
 def polys_to_mask_wrt_box(polygons, box, M):
     """Convert from the COCO polygon segmentation format to a binary mask
     encoded as a 2D array of data type numpy.float32. The polygon segmentation
     is understood to be enclosed in the given box and rasterized to an M x M
     mask. The resulting mask is therefore of shape (M, M).
     """
-    w = box[2] - box[0]
-    h = box[3] - box[1]
-    w = np.maximum(w, 1)
-    h = np.maximum(h, 1)
-
-    polygons_norm = []
-    i = 0
-    for poly in polygons:
-        p = np.array(poly, dtype=np.float32)
-        p = p.reshape(-1)
-        p[0::2] = (p[0::2] - box[0]) * M / w
-        p[1::2] = (p[1::2] - box[1]) * M / h
-        polygons_norm.append(p)
-
-    mask = []
-    for polygons in polygons_norm:
-        assert polygons.shape[0] % 2 == 0, polygons.shape
-        k = polygons.shape[0] // 2
-
-        one_msk = poly2mask(polygons, k, M, M)
-        mask.append(one_msk)
-
-    mask = np.array(mask)
-    # Flatten in case polygons was a list
-    mask = np.sum(mask, axis=0)
-    mask = np.array(mask > 0, dtype=np.float32)
-    return mask
+    mask = polys_to_masks_wrt_boxes([polygons], [0], box[np.newaxis], M)[0]
+    return np.array(mask > 0, dtype=np.float32)
 
 
 #@jit
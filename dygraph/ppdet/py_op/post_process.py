@@ -1,8 +1,9 @@
 import six
 import os
+import multiprocessing
 import numpy as np
 from numba import jit
-from .bbox import delta2bbox, clip_bbox, expand_bbox, nms
+from .bbox import delta2bbox, clip_bbox, expand_bbox, nms, multiclass_nms
 import pycocotools.mask as mask_util
 import cv2
 
@@ -19,8 +20,9 @@ def bbox_post_process(bboxes,
                       bbox_reg_weights=[0.1, 0.1, 0.2, 0.2],
                       with_background=True):
     bbox, bbox_num = bboxes
-    new_bbox = [[] for _ in range(len(bbox_num))]
-    new_bbox_num = []
+    dets = []
+    labels = []
+    batch_inds = []
     st_num = 0
     end_num = 0
     for i in range(len(bbox_num)):
@@ -36,43 +38,106 @@ def bbox_post_process(bboxes,
 
         # step2: clip 
         boxes = clip_bbox(boxes, im_shape[i][:2] / scale_factor[i])
-        # step3: nms 
-        cls_boxes = [[] for _ in range(class_nums)]
+        # collect the candidates of all classes above score_thresh
         scores_n = bbox_prob[st_num:end_num, :]
-        for j in range(with_background, class_nums):
-            inds = np.where(scores_n[:, j] > score_thresh)[0]
-            scores_j = scores_n[inds, j]
-            rois_j = boxes[inds, j * 4:(j + 1) * 4]
-            dets_j = np.hstack((scores_j[:, np.newaxis], rois_j)).astype(
-                np.float32, copy=False)
-            keep = nms(dets_j, nms_thresh)
-            nms_dets = dets_j[keep, :]
-            #add labels
-            label = np.array([j for _ in range(len(keep))])
-            nms_dets = np.hstack((label[:, np.newaxis], nms_dets)).astype(
-                np.float32, copy=False)
-            cls_boxes[j] = nms_dets
+        inds, label = np.nonzero(
+            scores_n[:, with_background:class_nums] > score_thresh)
+        label = label + with_background
+        scores_i = scores_n[inds, label]
+        rois_i = boxes.reshape(
+            (box_num, boxes.shape[1] // 4, 4))[inds, label]
+        dets.append(
+            np.hstack((scores_i[:, np.newaxis], rois_i)).astype(
+                np.float32, copy=False))
+        labels.append(label)
+        batch_inds.append(np.full(label.shape, i, dtype=np.int64))
 
         st_num += box_num
 
-        # Limit to max_per_image detections **over all classes**
-        image_scores = np.hstack(
-            [cls_boxes[j][:, 1] for j in range(with_background, class_nums)])
-        if len(image_scores) > keep_top_k:
-            image_thresh = np.sort(image_scores)[-keep_top_k]
-            for j in range(with_background, class_nums):
-                keep = np.where(cls_boxes[j][:, 1] >= image_thresh)[0]
-                cls_boxes[j] = cls_boxes[j][keep, :]
-        new_bbox_n = np.vstack(
-            [cls_boxes[j] for j in range(with_background, class_nums)])
-        new_bbox[i] = new_bbox_n
-        new_bbox_num.append(len(new_bbox_n))
-    new_bbox = np.vstack([new_bbox[k] for k in range(len(bbox_num))])
-    new_bbox_num = np.array(new_bbox_num).astype('int32')
+    # step3: nms of all images and classes in one pass, limited to
+    # keep_top_k detections **over all classes** of each image
+    dets = np.vstack(dets) if len(dets) > 0 else np.zeros(
+        (0, 5), dtype=np.float32)
+    labels = np.concatenate(labels) if len(labels) > 0 else np.zeros(
+        (0, ), dtype=np.int64)
+    batch_inds = np.concatenate(batch_inds) if len(
+        batch_inds) > 0 else np.zeros((0, ), dtype=np.int64)
+    keep = multiclass_nms(dets[:, 1:], dets[:, 0], labels, nms_thresh,
+                          keep_top_k, batch_inds)
+    new_bbox = np.hstack((labels[keep][:, np.newaxis], dets[keep])).astype(
+        np.float32, copy=False)
+    new_bbox_num = np.bincount(
+        batch_inds[keep], minlength=len(bbox_num)).astype('int32')
     return new_bbox, new_bbox_num
 
 
-@jit
+def crop_mask_rle(crop, x0, y0, im_h, im_w):
+    # COCO RLE of an im_h x im_w mask which is zero except for crop pasted
+    # at (x0, y0), same as mask_util.encode on the full image mask.
+    # Columns are padded with a zero pixel above and below, standing for
+    # the background around the crop.
+    h, w = crop.shape
+    padded = np.zeros((w, h + 2), dtype=np.int8)
+    padded[:, 1:-1] = crop.T != 0
+    padded = padded.ravel()
+    changes = np.nonzero(padded[1:] != padded[:-1])[0] + 1
+    cols, rows = np.divmod(changes, h + 2)
+    starts = (x0 + cols) * im_h + y0 + rows - 1
+    # runs joining over full height columns
+    joint = np.zeros(starts.shape, dtype=np.bool_)
+    joint[1:] = starts[1:] == starts[:-1]
+    joint[:-1] |= joint[1:]
+    starts = starts[~joint]
+    counts = np.diff(np.concatenate(([0], starts, [im_h * im_w])))
+    if len(counts) > 1 and counts[-1] == 0:
+        # no trailing empty run when the mask ends with foreground
+        counts = counts[:-1]
+    return mask_util.frPyObjects({
+        'counts': counts,
+        'size': [im_h, im_w]
+    }, im_h, im_w)
+
+
+def paste_mask_rles(boxes, masks, im_h, im_w, binary_thresh=0.5):
+    M = masks.shape[-1]
+    padded_mask = np.zeros((M + 2, M + 2), dtype=np.float32)
+    rles = []
+    for j in range(len(boxes)):
+        padded_mask[1:-1, 1:-1] = masks[j]
+
+        ref_box = boxes[j, :].tolist()
+        w = ref_box[2] - ref_box[0] + 1
+        h = ref_box[3] - ref_box[1] + 1
+        w = np.maximum(w, 1)
+        h = np.maximum(h, 1)
+
+        mask = cv2.resize(padded_mask, (w, h))
+        mask = np.array(mask > binary_thresh, dtype=np.uint8)
+
+        x_0 = min(max(ref_box[0], 0), im_w)
+        x_1 = max(min(ref_box[2] + 1, im_w), 0)
+        y_0 = min(max(ref_box[1], 0), im_h)
+        y_1 = max(min(ref_box[3] + 1, im_h), 0)
+        crop = mask[(y_0 - ref_box[1]):(y_1 - ref_box[1]), (x_0 - ref_box[0]):(
+            x_1 - ref_box[0])]
+        rles.append(crop_mask_rle(crop, x_0, y_0, im_h, im_w))
+    return rles
+
+
+_mask_pool = None
+
+
+def map_images(func, args):
+    # cv2.resize and the numpy work of paste_mask_rles release the GIL
+    global _mask_pool
+    if len(args) <= 1:
+        return [func(*arg) for arg in args]
+    if _mask_pool is None:
+        from multiprocessing.pool import ThreadPool
+        _mask_pool = ThreadPool(min(multiprocessing.cpu_count(), 8))
+    return _mask_pool.map(lambda arg: func(*arg), args)
+
+
 def mask_post_process(det_res,
                       im_shape,
                       scale_factor,
@@ -87,50 +152,26 @@ def mask_post_process(det_res,
     scale = (M + 2.0) / M
     boxes = bbox[:, 2:]
     labels = bbox[:, 0]
-    segms_results = [[] for _ in range(len(bbox_num))]
-    sum = 0
+    args = []
     st_num = 0
     end_num = 0
     for i in range(len(bbox_num)):
         length = bbox_num[i]
         end_num += length
-        cls_segms = []
         boxes_n = boxes[st_num:end_num]
-        labels_n = labels[st_num:end_num]
-        masks_n = masks[st_num:end_num]
+        labels_n = labels[st_num:end_num].astype(np.int32)
+        masks_n = masks[st_num:end_num][np.arange(length), labels_n]
 
         im_h = int(round(im_shape[i][0] / scale_factor[i, 0]))
         im_w = int(round(im_shape[i][1] / scale_factor[i, 0]))
         boxes_n = expand_bbox(boxes_n, scale)
         boxes_n = boxes_n.astype(np.int32)
-        padded_mask = np.zeros((M + 2, M + 2), dtype=np.float32)
-        for j in range(len(boxes_n)):
-            class_id = int(labels_n[j])
-            padded_mask[1:-1, 1:-1] = masks_n[j, class_id, :, :]
-
-            ref_box = boxes_n[j, :]
-            w = ref_box[2] - ref_box[0] + 1
-            h = ref_box[3] - ref_box[1] + 1
-            w = np.maximum(w, 1)
-            h = np.maximum(h, 1)
-
-            mask = cv2.resize(padded_mask, (w, h))
-            mask = np.array(mask > binary_thresh, dtype=np.uint8)
-            im_mask = np.zeros((im_h, im_w), dtype=np.uint8)
-
-            x_0 = max(ref_box[0], 0)
-            x_1 = min(ref_box[2] + 1, im_w)
-            y_0 = max(ref_box[1], 0)
-            y_1 = min(ref_box[3] + 1, im_h)
-            im_mask[y_0:y_1, x_0:x_1] = mask[(y_0 - ref_box[1]):(y_1 - ref_box[
-                1]), (x_0 - ref_box[0]):(x_1 - ref_box[0])]
-            sum += im_mask.sum()
-            rle = mask_util.encode(
-                np.array(
-                    im_mask[:, :, np.newaxis], order='F'))[0]
-            cls_segms.append(rle)
-        segms_results[i] = np.array(cls_segms)[:, np.newaxis]
+        args.append((boxes_n, masks_n, im_h, im_w, binary_thresh))
         st_num += length
+    segms_results = [
+        np.array(cls_segms)[:, np.newaxis]
+        for cls_segms in map_images(paste_mask_rles, args)
+    ]
     segms_results = np.vstack([segms_results[k] for k in range(len(bbox_num))])
     bboxes = np.hstack([segms_results, bbox])
     return bboxes[:, :3]
@@ -1,12 +1,189 @@
 import six
 import math
 import numpy as np
-from numba import jit
+from collections import OrderedDict
+from numba import jit, prange
 from .bbox import *
 from .mask import *
 
 
-@jit
+@jit(nopython=True, error_model='numpy')
+def _box_areas(boxes):
+    areas = np.empty((boxes.shape[0], ), dtype=np.float32)
+    for i in range(boxes.shape[0]):
+        w = max(boxes[i, 2] - boxes[i, 0] + np.float32(1.), np.float32(0.))
+        h = max(boxes[i, 3] - boxes[i, 1] + np.float32(1.), np.float32(0.))
+        areas[i] = w * h
+    return areas
+
+
+@jit(nopython=True, error_model='numpy')
+def _box_iou(box1, area1, box2, area2):
+    # same arithmetic as the compiled bbox_overlaps, so max/argmax ties
+    # match: areas and their sum are float32, the intersection and the
+    # iou are float64
+    inter_h = max(
+        np.float64(min(box1[3], box2[3]) - max(box1[1], box2[1])) + 1., 0.)
+    inter_w = max(
+        np.float64(min(box1[2], box2[2]) - max(box1[0], box2[0])) + 1., 0.)
+    inter_area = inter_w * inter_h
+    return inter_area / (np.float64(area1 + area2) - inter_area)
+
+
+def _sweep_index(boxes, valid, grouped=True):
+    """Order boxes by x1 inside groups of similar width. A box of group
+    g overlapping [x1, x2] must have its x1 in [x1 - max_w[g], x2 + 2),
+    so each group is swept over that interval only.
+    """
+    widths = np.where(valid, boxes[:, 2] - boxes[:, 0], 0.)
+    if grouped:
+        groups = np.floor(np.log2(np.maximum(widths, 1.))).astype(np.int64)
+    else:
+        groups = np.zeros(widths.shape, dtype=np.int64)
+    order = np.lexsort((boxes[:, 0], groups))
+    _, offsets = np.unique(groups[order], return_index=True)
+    offsets = np.append(offsets, len(order)).astype(np.int64)
+    max_w = np.maximum.reduceat(widths[order], offsets[:-1]) + 2.
+    return order, boxes[order, 0].astype(np.float64), offsets, max_w
+
+
+# anchors only change with the feature map size, keep a few sweep indexes
+_anchor_index_cache = OrderedDict()
+_ANCHOR_INDEX_CACHE_SIZE = 4
+
+
+def _anchor_sweep_index(anchors):
+    # anchors are regenerated every step, key them on their whole content,
+    # hashing it is cheap next to building the index
+    anchors = np.ascontiguousarray(anchors)
+    key = (anchors.shape, anchors.dtype.str, anchors.tobytes())
+    index = _anchor_index_cache.get(key)
+    if index is None:
+        index = _sweep_index(anchors, np.ones((anchors.shape[0], ), np.bool_))
+        if len(_anchor_index_cache) >= _ANCHOR_INDEX_CACHE_SIZE:
+            _anchor_index_cache.popitem(last=False)
+        _anchor_index_cache[key] = index
+    return index
+
+
+def _batch_sweep_index(boxes, valid):
+    batch_size, num = valid.shape
+    orders = np.zeros((batch_size, num), dtype=np.int64)
+    x1 = np.zeros((batch_size, num), dtype=np.float64)
+    offsets = np.zeros((batch_size, 2), dtype=np.int64)
+    max_w = np.zeros((batch_size, 1), dtype=np.float64)
+    for i in range(batch_size):
+        if num > 0:
+            orders[i], x1[i], offsets[i], max_w[i] = _sweep_index(
+                boxes[i], valid[i], grouped=False)
+    return orders, x1, offsets, max_w
+
+
+@jit(nopython=True)
+def _sweep_range(x1, offsets, max_w, group, lo, hi, prune):
+    st = offsets[group]
+    end = offsets[group + 1]
+    if prune:
+        group_x1 = x1[st:end]
+        end = st + np.searchsorted(group_x1, hi + 2.)
+        st = st + np.searchsorted(group_x1, lo - max_w[group])
+    return st, end
+
+
+@jit(nopython=True, parallel=True, error_model='numpy')
+def _label_anchor_kernel(anchors, anchor_index, inside, gt_boxes, gt_valid,
+                         gt_index, prune):
+    batch_size, gt_num = gt_valid.shape
+    anchor_num = anchors.shape[0]
+    anchor_order, anchor_x1, anchor_offsets, anchor_max_w = anchor_index
+    gt_order, gt_x1, gt_offsets, gt_max_w = gt_index
+    anchor_areas = _box_areas(anchors)
+    gt_areas = np.empty((batch_size, gt_num), dtype=np.float32)
+    inside_num = np.zeros((batch_size, ), dtype=np.int64)
+    for i in range(batch_size):
+        gt_areas[i] = _box_areas(gt_boxes[i])
+        inside_num[i] = inside[i].sum()
+
+    # every gt's best iou over the anchors inside the image, anchors out of
+    # the swept intervals don't overlap the gt and have an iou of 0
+    gt_max_iou = np.full((batch_size, gt_num), -1., dtype=np.float64)
+    for k in prange(batch_size * gt_num):
+        i = k // gt_num
+        j = k % gt_num
+        if not gt_valid[i, j]:
+            continue
+        best = -1.
+        overlap_num = 0
+        for g in range(len(anchor_max_w)):
+            st, end = _sweep_range(anchor_x1, anchor_offsets, anchor_max_w, g,
+                                   gt_boxes[i, j, 0], gt_boxes[i, j, 2],
+                                   prune)
+            for s in range(st, end):
+                a = anchor_order[s]
+                if inside[i, a]:
+                    iou = _box_iou(anchors[a], anchor_areas[a],
+                                   gt_boxes[i, j], gt_areas[i, j])
+                    if iou > 0:
+                        overlap_num += 1
+                        if iou > best:
+                            best = iou
+        if overlap_num < inside_num[i] and best < 0:
+            best = 0.
+        gt_max_iou[i, j] = best
+
+    # a gt overlapping no anchor makes every anchor hit its best iou of 0
+    first_valid = np.zeros((batch_size, ), dtype=np.int64)
+    zero_max = np.zeros((batch_size, ), dtype=np.bool_)
+    for i in range(batch_size):
+        for j in range(gt_num - 1, -1, -1):
+            if gt_valid[i, j]:
+                first_valid[i] = j
+                if gt_max_iou[i, j] == 0:
+                    zero_max[i] = True
+
+    # every anchor's best gt, anchors hitting a gt's best iou are positive
+    anchor_gt_inds = np.zeros((batch_size, anchor_num), dtype=np.int64)
+    anchor_gt_iou = np.zeros((batch_size, anchor_num), dtype=np.float64)
+    labels = np.full((batch_size, anchor_num), -1, dtype=np.int32)
+    for k in prange(batch_size * anchor_num):
+        i = k // anchor_num
+        a = k % anchor_num
+        if not inside[i, a]:
+            continue
+        best = 0.
+        best_ind = first_valid[i]
+        st, end = _sweep_range(gt_x1[i], gt_offsets[i], gt_max_w[i], 0,
+                               anchors[a, 0], anchors[a, 2], prune)
+        for s in range(st, end):
+            j = gt_order[i, s]
+            if not gt_valid[i, j]:
+                continue
+            iou = _box_iou(anchors[a], anchor_areas[a], gt_boxes[i, j],
+                           gt_areas[i, j])
+            if iou > 0:
+                if iou > best or (iou == best and j < best_ind):
+                    best = iou
+                    best_ind = j
+                if iou == gt_max_iou[i, j]:
+                    labels[i, a] = 1
+        if zero_max[i]:
+            labels[i, a] = 1
+        anchor_gt_inds[i, a] = best_ind
+        anchor_gt_iou[i, a] = best
+    return anchor_gt_inds, anchor_gt_iou, labels
+
+
+def _label_anchor(anchors, inside, gt_boxes, gt_valid, prune=True):
+    anchors = np.ascontiguousarray(anchors, dtype=np.float32)
+    gt_boxes = np.ascontiguousarray(gt_boxes, dtype=np.float32)
+    anchor_index = _anchor_sweep_index(anchors)
+    gt_index = _batch_sweep_index(gt_boxes, gt_valid)
+    return _label_anchor_kernel(anchors, anchor_index,
+                                np.ascontiguousarray(inside), gt_boxes,
+                                np.ascontiguousarray(gt_valid), gt_index,
+                                prune)
+
+
 def generate_rpn_anchor_target(anchors,
                                gt_boxes,
                                is_crowd,
@@ -17,44 +194,41 @@ def generate_rpn_anchor_target(anchors,
                                rpn_negative_overlap,
                                rpn_fg_fraction,
                                use_random=True,
-                               anchor_reg_weights=[1., 1., 1., 1.]):
+                               anchor_reg_weights=[1., 1., 1., 1.],
+                               prune=True):
     anchor_num = anchors.shape[0]
     batch_size = gt_boxes.shape[0]
 
+    # TODO: move anchor filter into anchor generator 
+    if rpn_straddle_thresh >= 0:
+        im_height = im_info[:, 0:1].astype(np.float64)
+        im_width = im_info[:, 1:2].astype(np.float64)
+        inside = (anchors[:, 0] >= -rpn_straddle_thresh) & (
+            anchors[:, 1] >= -rpn_straddle_thresh) & (
+                anchors[:, 2] < im_width + rpn_straddle_thresh) & (
+                    anchors[:, 3] < im_height + rpn_straddle_thresh)
+    else:
+        inside = np.ones((batch_size, anchor_num), dtype=np.bool_)
+    gt_boxes = gt_boxes * im_info[:, 2:3, np.newaxis]
+    gt_valid = is_crowd == 0
+
+    # Step1: match anchor and gt_bbox for the whole batch
+    anchor_gt_inds, anchor_gt_iou, anchor_labels = _label_anchor(
+        anchors, inside, gt_boxes, gt_valid, prune)
+
     loc_indexes = []
     cls_indexes = []
     tgt_labels = []
-    tgt_deltas = []
+    gt_indexes = []
     anchor_inside_weights = []
 
     for i in range(batch_size):
-
-        # TODO: move anchor filter into anchor generator 
-        im_height = im_info[i][0]
-        im_width = im_info[i][1]
-        im_scale = im_info[i][2]
-        if rpn_straddle_thresh >= 0:
-            anchor_inds = np.where((anchors[:, 0] >= -rpn_straddle_thresh) & (
-                anchors[:, 1] >= -rpn_straddle_thresh) & (
-                    anchors[:, 2] < im_width + rpn_straddle_thresh) & (
-                        anchors[:, 3] < im_height + rpn_straddle_thresh))[0]
-            anchor = anchors[anchor_inds, :]
-        else:
-            anchor_inds = np.arange(anchors.shape[0])
-            anchor = anchors
-
-        gt_bbox = gt_boxes[i] * im_scale
-        is_crowd_slice = is_crowd[i]
-        not_crowd_inds = np.where(is_crowd_slice == 0)[0]
-        gt_bbox = gt_bbox[not_crowd_inds]
-
-        # Step1: match anchor and gt_bbox
-        anchor_gt_bbox_inds, anchor_gt_bbox_iou, labels = label_anchor(anchor,
-                                                                       gt_bbox)
+        anchor_inds = np.where(inside[i])[0]
+        labels = anchor_labels[i, anchor_inds]
 
         # Step2: sample anchor 
         fg_inds, bg_inds, fg_fake_inds, fake_num = sample_anchor(
-            anchor_gt_bbox_iou, labels, rpn_positive_overlap,
+            anchor_gt_iou[i, anchor_inds], labels, rpn_positive_overlap,
             rpn_negative_overlap, rpn_batch_size_per_im, rpn_fg_fraction,
             use_random)
 
@@ -62,50 +236,37 @@ def generate_rpn_anchor_target(anchors,
         loc_inds = np.hstack([fg_fake_inds, fg_inds])
         cls_inds = np.hstack([fg_inds, bg_inds])
 
-        sampled_labels = labels[cls_inds]
-
-        sampled_anchors = anchor[loc_inds]
-        sampled_gt_boxes = gt_bbox[anchor_gt_bbox_inds[loc_inds]]
-        sampled_deltas = bbox2delta(sampled_anchors, sampled_gt_boxes,
-                                    anchor_reg_weights)
+        loc_indexes.append(anchor_inds[loc_inds] + i * anchor_num)
+        cls_indexes.append(anchor_inds[cls_inds] + i * anchor_num)
+        tgt_labels.append(labels[cls_inds])
+        gt_indexes.append(i * gt_boxes.shape[1] + anchor_gt_inds[
+            i, anchor_inds[loc_inds]])
 
         anchor_inside_weight = np.zeros((len(loc_inds), 4), dtype=np.float32)
         anchor_inside_weight[fake_num:, :] = 1
-
-        loc_indexes.append(anchor_inds[loc_inds] + i * anchor_num)
-        cls_indexes.append(anchor_inds[cls_inds] + i * anchor_num)
-        tgt_labels.append(sampled_labels)
-        tgt_deltas.append(sampled_deltas)
         anchor_inside_weights.append(anchor_inside_weight)
 
     loc_indexes = np.concatenate(loc_indexes)
     cls_indexes = np.concatenate(cls_indexes)
     tgt_labels = np.concatenate(tgt_labels).astype('float32')
-    tgt_deltas = np.vstack(tgt_deltas).astype('float32')
     anchor_inside_weights = np.vstack(anchor_inside_weights)
 
-    return loc_indexes, cls_indexes, tgt_labels, tgt_deltas, anchor_inside_weights
-
-
-@jit
-def label_anchor(anchors, gt_boxes):
-    iou = bbox_overlaps(anchors, gt_boxes)
-    # every gt's anchor's index
-    gt_bbox_anchor_inds = iou.argmax(axis=0)
-    gt_bbox_anchor_iou = iou[gt_bbox_anchor_inds, np.arange(iou.shape[1])]
-    gt_bbox_anchor_iou_inds = np.where(iou == gt_bbox_anchor_iou)[0]
+    sampled_anchors = anchors[loc_indexes % anchor_num]
+    sampled_gt_boxes = gt_boxes.reshape((-1, 4))[np.concatenate(gt_indexes)]
+    tgt_deltas = bbox2delta(sampled_anchors, sampled_gt_boxes,
+                            anchor_reg_weights).astype('float32')
 
-    # every anchor's gt bbox's index 
-    anchor_gt_bbox_inds = iou.argmax(axis=1)
-    anchor_gt_bbox_iou = iou[np.arange(iou.shape[0]), anchor_gt_bbox_inds]
+    return loc_indexes, cls_indexes, tgt_labels, tgt_deltas, anchor_inside_weights
 
-    labels = np.ones((iou.shape[0], ), dtype=np.int32) * -1
-    labels[gt_bbox_anchor_iou_inds] = 1
 
-    return anchor_gt_bbox_inds, anchor_gt_bbox_iou, labels
+def label_anchor(anchors, gt_boxes, prune=True):
+    anchor_gt_bbox_inds, anchor_gt_bbox_iou, labels = _label_anchor(
+        anchors, np.ones((1, anchors.shape[0]), dtype=np.bool_),
+        gt_boxes[np.newaxis], np.ones((1, gt_boxes.shape[0]), dtype=np.bool_),
+        prune)
+    return anchor_gt_bbox_inds[0], anchor_gt_bbox_iou[0], labels[0]
 
 
-@jit
 def sample_anchor(anchor_gt_bbox_iou,
                   labels,
                   rpn_positive_overlap,
@@ -132,13 +293,9 @@ def sample_anchor(anchor_gt_bbox_iou,
     else:
         enable_inds = bg_inds[:num_bg]
 
-    fg_fake_inds = np.array([], np.int32)
-    fg_value = np.array([fg_inds[0]], np.int32)
-    fake_num = 0
-    for bg_id in enable_inds:
-        if bg_id in fg_inds:
-            fake_num += 1
-            fg_fake_inds = np.hstack([fg_fake_inds, fg_value])
+    # sampled bg which is also fg is replaced by a fake fg location
+    fake_num = int(np.isin(enable_inds, fg_inds).sum())
+    fg_fake_inds = np.full((fake_num, ), fg_inds[0], dtype=np.int32)
     labels[enable_inds] = 0
 
     fg_inds = np.where(labels == 1)[0]
@@ -147,7 +304,6 @@ def sample_anchor(anchor_gt_bbox_iou,
     return fg_inds, bg_inds, fg_fake_inds, fake_num
 
 
-@jit
 def filter_roi(rois, max_overlap):
     ws = rois[:, 2] - rois[:, 0] + 1
     hs = rois[:, 3] - rois[:, 1] + 1
@@ -157,7 +313,42 @@ def filter_roi(rois, max_overlap):
     return np.zeros((1, 4)).astype('float32')
 
 
-@jit
+@jit(nopython=True, parallel=True, error_model='numpy')
+def _label_bbox_kernel(boxes, box_im_inds, box_offsets, gt_boxes, gt_classes,
+                       is_crowd):
+    box_num = boxes.shape[0]
+    batch_size, gt_num = gt_classes.shape
+    box_areas = _box_areas(boxes)
+    gt_areas = np.empty((batch_size, gt_num), dtype=np.float32)
+    for i in range(batch_size):
+        gt_areas[i] = _box_areas(gt_boxes[i])
+
+    roi_gt_bbox_inds = np.zeros((box_num, ), dtype=np.int32)
+    labels = np.zeros((box_num, ), dtype=np.int64)
+    max_overlap = np.zeros((box_num, ), dtype=np.float32)
+    for k in prange(box_num):
+        i = box_im_inds[k]
+        best = 0.
+        best_ind = 0
+        for j in range(gt_num):
+            iou = _box_iou(boxes[k], box_areas[k], gt_boxes[i, j],
+                           gt_areas[i, j])
+            if j == 0 or iou > best:
+                best = iou
+                best_ind = j
+        if best > 0:
+            roi_gt_bbox_inds[k] = best_ind
+        # the leading rows of every image are its gt boxes
+        local = k - box_offsets[i]
+        if local < gt_num and is_crowd[i, local] != 0:
+            max_overlap[k] = -1.
+        elif np.float32(best) > 0:
+            # the best iou is kept in float32 as the per class overlaps were
+            max_overlap[k] = best
+            labels[k] = gt_classes[i, best_ind]
+    return roi_gt_bbox_inds, labels, max_overlap
+
+
 def generate_proposal_target(rpn_rois,
                              rpn_rois_num,
                              gt_classes,
@@ -176,109 +367,95 @@ def generate_proposal_target(rpn_rois,
                              is_cascade_rcnn=False,
                              max_overlaps=None):
 
-    rois = []
-    tgt_labels = []
-    tgt_deltas = []
-    rois_inside_weights = []
-    rois_outside_weights = []
-    sampled_max_overlaps = []
-    new_rois_num = []
+    bboxes = []
     st_num = 0
     end_num = 0
     for im_i in range(len(rpn_rois_num)):
         length = rpn_rois_num[im_i]
         end_num += length
         rpn_roi = rpn_rois[st_num:end_num]
-        max_overlap = max_overlaps[st_num:end_num] if is_cascade_rcnn else None
         im_scale = im_info[im_i][2]
         rpn_roi = rpn_roi / im_scale
-        gt_bbox = gt_boxes[im_i]
-
         if is_cascade_rcnn:
-            rpn_roi = filter_roi(rpn_roi, max_overlap)
-        bbox = np.vstack([gt_bbox, rpn_roi]).astype('float32')
+            rpn_roi = filter_roi(rpn_roi, max_overlaps[st_num:end_num])
+        bboxes.append(np.vstack([gt_boxes[im_i], rpn_roi]).astype('float32'))
+        st_num += length
+
+    box_nums = np.array([len(b) for b in bboxes], dtype=np.int64)
+    box_offsets = np.cumsum(box_nums) - box_nums
+    box_im_inds = np.repeat(np.arange(len(bboxes)), box_nums)
+    bboxes = np.concatenate(bboxes, axis=0)
+
+    # Step1: label bbox for the whole batch
+    roi_gt_bbox_inds, labels, max_overlap = _label_bbox_kernel(
+        bboxes, box_im_inds, box_offsets,
+        np.ascontiguousarray(gt_boxes, dtype=np.float32),
+        np.ascontiguousarray(gt_classes, dtype=np.int64),
+        np.ascontiguousarray(is_crowd, dtype=np.int64))
 
-        # Step1: label bbox 
-        roi_gt_bbox_inds, labels, max_overlap = label_bbox(
-            bbox, gt_bbox, gt_classes[im_i], is_crowd[im_i])
+    sampled_inds = []
+    fg_masks = []
+    new_rois_num = []
+    for im_i in range(len(rpn_rois_num)):
+        st_num = box_offsets[im_i]
+        end_num = st_num + box_nums[im_i]
 
         # Step2: sample bbox 
         fg_inds, bg_inds, fg_nums = sample_bbox(
-            max_overlap, batch_size_per_im, fg_fraction, fg_thresh,
-            bg_thresh_hi, bg_thresh_lo, bbox_reg_weights, class_nums,
-            use_random, is_cls_agnostic, is_cascade_rcnn)
-
-        # Step3: make output 
-        sampled_inds = np.append(fg_inds, bg_inds)
-
-        sampled_labels = labels[sampled_inds]
-        sampled_labels[fg_nums:] = 0
-
-        sampled_boxes = bbox[sampled_inds]
-        sampled_max_overlap = max_overlap[sampled_inds]
-        sampled_gt_boxes = gt_bbox[roi_gt_bbox_inds[sampled_inds]]
-        sampled_gt_boxes[fg_nums:, :] = 0
-        sampled_deltas = compute_bbox_targets(sampled_boxes, sampled_gt_boxes,
-                                              sampled_labels, bbox_reg_weights)
-        sampled_deltas[fg_nums:, :] = 0
-        sampled_deltas, bbox_inside_weights = expand_bbox_targets(
-            sampled_deltas, class_nums, is_cls_agnostic)
-        bbox_outside_weights = np.array(
-            bbox_inside_weights > 0, dtype=bbox_inside_weights.dtype)
-
-        roi = sampled_boxes * im_scale
-        st_num += length
-
-        rois.append(roi)
-        new_rois_num.append(roi.shape[0])
-        tgt_labels.append(sampled_labels)
-        tgt_deltas.append(sampled_deltas)
-        rois_inside_weights.append(bbox_inside_weights)
-        rois_outside_weights.append(bbox_outside_weights)
-        sampled_max_overlaps.append(sampled_max_overlap)
-
-    rois = np.concatenate(rois, axis=0).astype(np.float32)
-    tgt_labels = np.concatenate(
-        tgt_labels, axis=0).astype(np.int32).reshape(-1, 1)
-    tgt_deltas = np.concatenate(tgt_deltas, axis=0).astype(np.float32)
-    rois_inside_weights = np.concatenate(
-        rois_inside_weights, axis=0).astype(np.float32)
-    rois_outside_weights = np.concatenate(
-        rois_outside_weights, axis=0).astype(np.float32)
-    sampled_max_overlaps = np.concatenate(
-        sampled_max_overlaps, axis=0).astype(np.float32)
+            max_overlap[st_num:end_num], batch_size_per_im, fg_fraction,
+            fg_thresh, bg_thresh_hi, bg_thresh_lo, bbox_reg_weights,
+            class_nums, use_random, is_cls_agnostic, is_cascade_rcnn)
+
+        im_sampled_inds = np.append(fg_inds, bg_inds).astype(np.int64)
+        fg_mask = np.zeros(im_sampled_inds.shape, dtype=np.bool_)
+        fg_mask[:fg_nums] = True
+        sampled_inds.append(im_sampled_inds + st_num)
+        fg_masks.append(fg_mask)
+        new_rois_num.append(len(im_sampled_inds))
+
+    # Step3: make output 
+    sampled_inds = np.concatenate(sampled_inds)
+    fg_mask = np.concatenate(fg_masks)
+    bg_mask = ~fg_mask
+    sampled_im_inds = box_im_inds[sampled_inds]
+
+    sampled_labels = labels[sampled_inds]
+    sampled_labels[bg_mask] = 0
+
+    sampled_boxes = bboxes[sampled_inds]
+    sampled_max_overlaps = max_overlap[sampled_inds]
+    sampled_gt_boxes = gt_boxes[sampled_im_inds, roi_gt_bbox_inds[
+        sampled_inds]]
+    sampled_gt_boxes[bg_mask, :] = 0
+    tgt_deltas = compute_bbox_targets(sampled_boxes, sampled_gt_boxes,
+                                      sampled_labels, bbox_reg_weights)
+    tgt_deltas[bg_mask, :] = 0
+    tgt_deltas, rois_inside_weights = expand_bbox_targets(
+        tgt_deltas, class_nums, is_cls_agnostic)
+    rois_outside_weights = np.array(
+        rois_inside_weights > 0, dtype=rois_inside_weights.dtype)
+
+    im_scales = im_info[:, 2][sampled_im_inds]
+    rois = (sampled_boxes * im_scales[:, np.newaxis]).astype(np.float32)
+    tgt_labels = sampled_labels.astype(np.int32).reshape(-1, 1)
+    tgt_deltas = tgt_deltas.astype(np.float32)
+    rois_inside_weights = rois_inside_weights.astype(np.float32)
+    rois_outside_weights = rois_outside_weights.astype(np.float32)
+    sampled_max_overlaps = sampled_max_overlaps.astype(np.float32)
     new_rois_num = np.asarray(new_rois_num, np.int32)
     return rois, tgt_labels, tgt_deltas, rois_inside_weights, rois_outside_weights, new_rois_num, sampled_max_overlaps
 
 
-@jit
 def label_bbox(boxes, gt_boxes, gt_classes, is_crowd, class_nums=81):
+    return _label_bbox_kernel(
+        np.ascontiguousarray(boxes, dtype=np.float32),
+        np.zeros((boxes.shape[0], ), dtype=np.int64),
+        np.zeros((1, ), dtype=np.int64),
+        np.ascontiguousarray(gt_boxes[np.newaxis], dtype=np.float32),
+        np.ascontiguousarray(gt_classes[np.newaxis], dtype=np.int64),
+        np.ascontiguousarray(is_crowd[np.newaxis], dtype=np.int64))
 
-    iou = bbox_overlaps(boxes, gt_boxes)
-
-    # every roi's gt box's index  
-    roi_gt_bbox_inds = np.zeros((boxes.shape[0]), dtype=np.int32)
-    roi_gt_bbox_iou = np.zeros((boxes.shape[0], class_nums), dtype=np.float32)
-
-    iou_argmax = iou.argmax(axis=1)
-    iou_max = iou.max(axis=1)
-    overlapped_boxes_ind = np.where(iou_max > 0)[0].astype('int32')
-    roi_gt_bbox_inds[overlapped_boxes_ind] = iou_argmax[overlapped_boxes_ind]
-    overlapped_boxes_gt_classes = gt_classes[iou_argmax[
-        overlapped_boxes_ind]].astype('int32')
-    roi_gt_bbox_iou[overlapped_boxes_ind,
-                    overlapped_boxes_gt_classes] = iou_max[overlapped_boxes_ind]
-
-    crowd_ind = np.where(is_crowd)[0]
-    roi_gt_bbox_iou[crowd_ind] = -1
 
-    max_overlap = roi_gt_bbox_iou.max(axis=1)
-    labels = roi_gt_bbox_iou.argmax(axis=1)
-
-    return roi_gt_bbox_inds, labels, max_overlap
-
-
-@jit
 def sample_bbox(max_overlap,
                 batch_size_per_im,
                 fg_fraction,
@@ -320,7 +497,6 @@ def sample_bbox(max_overlap,
     return fg_inds, bg_inds, fg_nums
 
 
-@jit
 def generate_mask_target(im_info, gt_classes, is_crowd, gt_segms, rois,
                          rois_num, labels_int32, num_classes, resolution):
     mask_rois = []
@@ -335,21 +511,11 @@ def generate_mask_target(im_info, gt_classes, is_crowd, gt_segms, rois,
 
         # remove padding
         gt_polys = gt_segms[k]
-        new_gt_polys = []
-        for i in range(gt_polys.shape[0]):
-            gt_segs = []
-            for j in range(gt_polys[i].shape[0]):
-                new_poly = []
-                polys = gt_polys[i][j]
-                for ii in range(polys.shape[0]):
-                    x, y = polys[ii]
-                    if (x == -1 and y == -1):
-                        continue
-                    elif (x >= 0 or y >= 0):
-                        new_poly.append([x, y])  # array, one poly 
-                if len(new_poly) > 0:
-                    gt_segs.append(new_poly)
-            new_gt_polys.append(gt_segs)
+        valid = (gt_polys[..., 0] >= 0) | (gt_polys[..., 1] >= 0)
+        new_gt_polys = [[
+            polys[valid_polys] for polys, valid_polys in zip(gt_segs, valid_segs)
+            if valid_polys.any()
+        ] for gt_segs, valid_segs in zip(gt_polys, valid)]
         im_scale = im_info[k][2]
         boxes = rois[st_num:end_num] / im_scale
 
@@ -373,7 +539,6 @@ def generate_mask_target(im_info, gt_classes, is_crowd, gt_segms, rois,
     return mask_rois, mask_rois_num, rois_has_mask_int32, mask_int32
 
 
-@jit
 def sample_mask(boxes, gt_polys, label_int32, gt_classes, is_crowd, num_classes,
                 resolution):
 
@@ -386,19 +551,15 @@ def sample_mask(boxes, gt_polys, label_int32, gt_classes, is_crowd, num_classes,
 
     if fg_inds.shape[0] > 0:
         labels_fg = label_int32[fg_inds]
-        masks_fg = np.zeros((fg_inds.shape[0], resolution**2), dtype=np.int32)
         bbox_fg = boxes[fg_inds]
 
         iou = bbox_overlaps_mask(bbox_fg, boxes_from_polys)
         fg_polys_inds = np.argmax(iou, axis=1)
 
-        for i in range(bbox_fg.shape[0]):
-            poly_gt = _gt_polys[fg_polys_inds[i]]
-            roi_fg = bbox_fg[i]
-
-            mask = polys_to_mask_wrt_box(poly_gt, roi_fg, resolution)
-            mask = np.array(mask > 0, dtype=np.int32)
-            masks_fg[i, :] = np.reshape(mask, resolution**2)
+        masks = polys_to_masks_wrt_boxes(_gt_polys, fg_polys_inds, bbox_fg,
+                                         resolution)
+        masks_fg = np.array(masks > 0, dtype=np.int32).reshape(
+            (-1, resolution**2))
     else:
         bg_inds = np.where(label_int32 == 0)[0]
         bbox_fg = boxes[bg_inds[0]].reshape((1, -1))
@@ -18,12 +18,15 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import sys
+import math
 import numpy as np
 
 from .logger import setup_logger
 logger = setup_logger(__name__)
 
-__all__ = ['bbox_area', 'jaccard_overlap', 'DetectionMAP']
+__all__ = [
+    'bbox_area', 'jaccard_overlap', 'jaccard_overlap_matrix', 'DetectionMAP'
+]
 
 
 def bbox_area(bbox, is_bbox_normalized):
@@ -55,6 +58,92 @@ def jaccard_overlap(pred, gt, is_bbox_normalized=False):
     return overlap
 
 
+def _intersect_length(pred_min, pred_max, gt_min, gt_max, norm):
+    # max/min in jaccard_overlap keep the prediction coordinate on ties,
+    # and the difference stays in the gt dtype when both ends are from gt
+    from_gt_min = gt_min > pred_min
+    from_gt_max = gt_max < pred_max
+    length = np.where(from_gt_max, gt_max, pred_max) - \
+        np.where(from_gt_min, gt_min, pred_min)
+    gt_length = (gt_max - gt_min).astype(np.float64)
+    length = np.where(from_gt_min & from_gt_max, gt_length, length)
+    return length + norm
+
+
+def jaccard_overlap_matrix(pred, gt, is_bbox_normalized=False):
+    """
+    Calculate jaccard overlap ratio between every prediction and every
+    ground truth bounding box, element-wise the same as jaccard_overlap
+    with a float64 prediction and a ground truth row of gt.
+
+    Args:
+        pred (np.ndarray): prediction boxes in shape [P, 4].
+        gt (np.ndarray): ground truth boxes in shape [G, 4].
+        is_bbox_normalized (bool): whether boxes are normalized.
+
+    Returns:
+        overlaps (np.ndarray): float64 overlaps in shape [P, G].
+    """
+    norm = 1. - float(is_bbox_normalized)
+    pred = np.asarray(pred, dtype=np.float64).reshape(-1, 4)
+    gt = np.asarray(gt).reshape(-1, 4)
+    px1, py1, px2, py2 = [pred[:, i:i + 1] for i in range(4)]
+    gx1, gy1, gx2, gy2 = [gt[:, i] for i in range(4)]
+
+    inter_w = _intersect_length(px1, px2, gx1, gx2, norm)
+    inter_h = _intersect_length(py1, py2, gy1, gy2, norm)
+    inter_size = inter_w * inter_h
+    pred_size = (px2 - px1 + norm) * (py2 - py1 + norm)
+    gt_size = ((gx2 - gx1).astype(np.float64) + norm) * (
+        (gy2 - gy1).astype(np.float64) + norm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlaps = inter_size / (pred_size + gt_size - inter_size)
+    disjoint = (px1 >= gx2) | (px2 <= gx1) | (py1 >= gy2) | (py2 <= gy1)
+    overlaps[disjoint] = 0.
+    return overlaps
+
+
+def _11point_ap(precision, recall):
+    """
+    11 point AP of precision/recall curves sorted by descending score
+    """
+    # max precision at recall >= j / 10 is the suffix maximum from the
+    # first such detection on, recall is non-decreasing along the curve
+    suffix_max = np.maximum.accumulate(precision[::-1])[::-1]
+    thresholds = np.arange(11) / 10.
+    starts = np.searchsorted(recall, thresholds, side='left')
+    max_precisions = np.zeros(11)
+    valid = starts < len(recall)
+    max_precisions[valid] = suffix_max[starts[valid]]
+    # below the recall of the first detection, the points at recall
+    # >= (j + 1) / 10 are skipped, same as the previous loop did
+    first = np.searchsorted(thresholds, recall[0], side='right') - 1
+    if first < 10:
+        prefix_max = np.maximum.accumulate(precision)
+        max_precisions[:first] = prefix_max[starts[first + 1] - 1]
+    return sum(max_precisions.tolist()) / 11.
+
+
+def _integral_ap(precision, recall):
+    """
+    Integral AP of precision/recall curves sorted by descending score
+    """
+    prev_recall = np.concatenate(([0.], recall[:-1]))
+    steps = np.nonzero(recall != prev_recall)[0]
+    recall_gaps = np.abs(recall[steps] - prev_recall[steps])
+    if np.all(recall_gaps > 1e-6):
+        return sum((precision[steps] * recall_gaps).tolist())
+    # tiny recall steps are merged into the next one
+    ap = 0.
+    prev_recall = 0.
+    for i in steps.tolist():
+        recall_gap = math.fabs(recall[i] - prev_recall)
+        if recall_gap > 1e-6:
+            ap += precision[i] * recall_gap
+            prev_recall = recall[i]
+    return ap
+
+
 class DetectionMAP(object):
     """
     Calculate detection mean average precision.
@@ -62,10 +151,11 @@ class DetectionMAP(object):
 
     Args:
         class_num (int): the class number.
-        overlap_thresh (float): The threshold of overlap
+        overlap_thresh (float|list): The threshold of overlap
             ratio between prediction bounding box and 
             ground truth bounding box for deciding 
-            true/false positive. Default 0.5.
+            true/false positive, a list of thresholds
+            is evaluated in one pass. Default 0.5.
         map_type (str): calculation method of mean average
             precision, currently support '11point' and
             'integral'. Default '11point'.
@@ -83,6 +173,8 @@ class DetectionMAP(object):
                  evaluate_difficult=False):
         self.class_num = class_num
         self.overlap_thresh = overlap_thresh
+        self.overlap_threshs = list(overlap_thresh) if isinstance(
+            overlap_thresh, (list, tuple)) else [overlap_thresh]
         assert map_type in ['11point', 'integral'], \
                 "map_type currently only support '11point' "\
                 "and 'integral'"
@@ -96,122 +188,159 @@ class DetectionMAP(object):
         Update metric statics from given prediction and ground
         truth infomations.
         """
+        gt_label = np.asarray(gt_label).reshape(-1).astype(np.int64)
         if difficult is None:
             difficult = np.zeros_like(gt_label)
+        difficult = np.asarray(difficult).reshape(-1).astype(np.int64)
 
         # record class gt count
-        for gtl, diff in zip(gt_label, difficult):
-            if self.evaluate_difficult or int(diff) == 0:
-                self.class_gt_counts[int(np.array(gtl))] += 1
-
-        # record class score positive
-        visited = [False] * len(gt_label)
-        for b in bbox:
-            label, score, xmin, ymin, xmax, ymax = b.tolist()
-            pred = [xmin, ymin, xmax, ymax]
-            max_idx = -1
-            max_overlap = -1.0
-            for i, gl in enumerate(gt_label):
-                if int(gl) == int(label):
-                    overlap = jaccard_overlap(pred, gt_box[i],
-                                              self.is_bbox_normalized)
-                    if overlap > max_overlap:
-                        max_overlap = overlap
-                        max_idx = i
-
-            if max_overlap > self.overlap_thresh:
-                if self.evaluate_difficult or \
-                        int(np.array(difficult[max_idx])) == 0:
-                    if not visited[max_idx]:
-                        self.class_score_poss[int(label)].append([score, 1.0])
-                        visited[max_idx] = True
-                    else:
-                        self.class_score_poss[int(label)].append([score, 0.0])
+        counted = gt_label if self.evaluate_difficult else \
+            gt_label[difficult == 0]
+        self.class_gt_counts += np.bincount(
+            counted, minlength=self.class_num)[:self.class_num]
+
+        # record class score positive, 1 for true positive, 0 for false
+        # positive and -1 for ignored under each overlap threshold
+        bbox = np.asarray(bbox).reshape(-1, 6)
+        # rows labeled -1 are padding of some NMS ops, see bbox2out
+        bbox = bbox[bbox[:, 0] >= 0]
+        if len(bbox) == 0:
+            return
+        labels = bbox[:, 0].astype(np.int64)
+        tps = np.zeros((len(bbox), len(self.overlap_threshs)))
+        if len(gt_label) == 0:
+            self._record(labels, bbox[:, 1], tps)
+            return
+
+        # every prediction takes the first gt box of its own class with
+        # the largest overlap, the first prediction (in the given order)
+        # to take a gt box is a true positive, the later ones are false
+        # positives, and predictions taking a difficult gt box are ignored
+        overlaps = jaccard_overlap_matrix(bbox[:, 2:], gt_box,
+                                          self.is_bbox_normalized)
+        overlaps[labels[:, None] != gt_label[None, :]] = -1.
+        max_idx = overlaps.argmax(axis=1)
+        max_overlap = overlaps[np.arange(len(bbox)), max_idx]
+        for k, overlap_thresh in enumerate(self.overlap_threshs):
+            matched = max_overlap > overlap_thresh
+            if self.evaluate_difficult:
+                counted = matched
             else:
-                self.class_score_poss[int(label)].append([score, 0.0])
+                counted = matched & (difficult[max_idx] == 0)
+            inds = np.nonzero(counted)[0]
+            _, first = np.unique(max_idx[inds], return_index=True)
+            tps[inds[first], k] = 1.
+            tps[matched & ~counted, k] = -1.
+        self._record(labels, bbox[:, 1], tps)
+
+    def _record(self, labels, scores, tps):
+        """
+        Append [label, score, tp...] records to the growable record buffer
+        """
+        num = self._num_records + len(labels)
+        if num > len(self._records):
+            records = np.zeros((max(num, 2 * len(self._records)),
+                                self._records.shape[1]))
+            records[:self._num_records] = self._records[:self._num_records]
+            self._records = records
+        self._records[self._num_records:num, 0] = labels
+        self._records[self._num_records:num, 1] = scores
+        self._records[self._num_records:num, 2:] = tps
+        self._num_records = num
+
+    def _class_records(self):
+        """
+        Split [score, tp...] records by class, each sorted by descending
+        score and keeping the recording order on ties
+        """
+        records = self._records[:self._num_records]
+        labels = records[:, 0].astype(np.int64)
+        order = np.lexsort((-records[:, 1], labels))
+        counts = np.bincount(labels, minlength=self.class_num)
+        return np.split(records[order, 1:], np.cumsum(counts)[:-1])
 
     def reset(self):
         """
         Reset metric statics
         """
-        self.class_score_poss = [[] for _ in range(self.class_num)]
-        self.class_gt_counts = [0] * self.class_num
+        self._records = np.zeros((1024, 2 + len(self.overlap_threshs)))
+        self._num_records = 0
+        self.class_gt_counts = np.zeros(self.class_num, dtype=np.int64)
         self.mAP = None
+        self.class_aps = None
 
     def accumulate(self):
         """
         Accumulate metric results and calculate mAP
         """
-        mAP = 0.
-        valid_cnt = 0
-        for score_pos, count in zip(self.class_score_poss,
-                                    self.class_gt_counts):
-            if count == 0: continue
-            if len(score_pos) == 0:
-                valid_cnt += 1
-                continue
-
-            accum_tp_list, accum_fp_list = \
-                    self._get_tp_fp_accum(score_pos)
-            precision = []
-            recall = []
-            for ac_tp, ac_fp in zip(accum_tp_list, accum_fp_list):
-                precision.append(float(ac_tp) / (ac_tp + ac_fp))
-                recall.append(float(ac_tp) / count)
-
-            if self.map_type == '11point':
-                max_precisions = [0.] * 11
-                start_idx = len(precision) - 1
-                for j in range(10, -1, -1):
-                    for i in range(start_idx, -1, -1):
-                        if recall[i] < float(j) / 10.:
-                            start_idx = i
-                            if j > 0:
-                                max_precisions[j - 1] = max_precisions[j]
-                                break
-                        else:
-                            if max_precisions[j] < precision[i]:
-                                max_precisions[j] = precision[i]
-                mAP += sum(max_precisions) / 11.
-                valid_cnt += 1
-            elif self.map_type == 'integral':
-                import math
-                ap = 0.
-                prev_recall = 0.
-                for i in range(len(precision)):
-                    recall_gap = math.fabs(recall[i] - prev_recall)
-                    if recall_gap > 1e-6:
-                        ap += precision[i] * recall_gap
-                        prev_recall = recall[i]
-                mAP += ap
+        class_records = self._class_records()
+        class_gt_counts = self.class_gt_counts.tolist()
+        mAPs = []
+        class_aps = []
+        for k in range(len(self.overlap_threshs)):
+            mAP = 0.
+            valid_cnt = 0
+            # AP of classes without ground truth is nan
+            class_ap = np.full(self.class_num, np.nan)
+            for c, (records, count) in enumerate(
+                    zip(class_records, class_gt_counts)):
+                if count == 0: continue
+                tps = records[:, 1 + k]
+                tps = tps[tps >= 0]
+                if len(tps) == 0:
+                    class_ap[c] = 0.
+                    valid_cnt += 1
+                    continue
+
+                accum_tp, accum_fp = self._get_tp_fp_accum(tps)
+                precision = accum_tp / (accum_tp + accum_fp)
+                recall = accum_tp / float(count)
+                if self.map_type == '11point':
+                    class_ap[c] = _11point_ap(precision, recall)
+                elif self.map_type == 'integral':
+                    class_ap[c] = _integral_ap(precision, recall)
+                else:
+                    logger.error("Unspported mAP type {}".format(
+                        self.map_type))
+                    sys.exit(1)
+                mAP += class_ap[c]
                 valid_cnt += 1
-            else:
-                logger.error("Unspported mAP type {}".format(self.map_type))
-                sys.exit(1)
 
-        self.mAP = mAP / float(valid_cnt) if valid_cnt > 0 else mAP
+            mAPs.append(mAP / float(valid_cnt) if valid_cnt > 0 else mAP)
+            class_aps.append(class_ap)
+
+        if isinstance(self.overlap_thresh, (list, tuple)):
+            self.mAP = mAPs
+            self.class_aps = class_aps
+        else:
+            self.mAP = mAPs[0]
+            self.class_aps = class_aps[0]
 
     def get_map(self):
         """
-        Get mAP result
+        Get mAP result, a list aligned with overlap_thresh if several
+        thresholds are evaluated
         """
         if self.mAP is None:
             logger.error("mAP is not calculated.")
         return self.mAP
 
-    def _get_tp_fp_accum(self, score_pos_list):
+    def get_class_ap(self):
+        """
+        Get AP of each class, nan for classes without ground truth, a
+        list aligned with overlap_thresh if several thresholds are
+        evaluated
+        """
+        if self.class_aps is None:
+            logger.error("mAP is not calculated.")
+        return self.class_aps
+
+    def _get_tp_fp_accum(self, tps):
         """
         Calculate accumulating true/false positive results from
-        [score, pos] records
-        """
-        sorted_list = sorted(score_pos_list, key=lambda s: s[0], reverse=True)
-        accum_tp = 0
-        accum_fp = 0
-        accum_tp_list = []
-        accum_fp_list = []
-        for (score, pos) in sorted_list:
-            accum_tp += int(pos)
-            accum_tp_list.append(accum_tp)
-            accum_fp += 1 - int(pos)
-            accum_fp_list.append(accum_fp)
-        return accum_tp_list, accum_fp_list
+        tp records sorted by descending score
+        """
+        tps = tps.astype(np.int64)
+        accum_tp = np.cumsum(tps)
+        accum_fp = np.cumsum(1 - tps)
+        return accum_tp, accum_fp
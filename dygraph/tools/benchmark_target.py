@@ -0,0 +1,457 @@
+# Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark generate_rpn_anchor_target and generate_proposal_target of
+ppdet.py_op.target against the previous per-image implementation, and
+check that both give the same targets.
+
+The reference functions below are the previous ones without their bare
+@jit, which only ever ran them in object mode. They still call the
+compiled bbox_overlaps, so the IoU arithmetic is the one they had.
+
+    python tools/benchmark_target.py --batch_size 2 --gt_num 50
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os, sys
+# add python path of PadleDetection to sys.path
+parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 2)))
+if parent_path not in sys.path:
+    sys.path.append(parent_path)
+
+# ignore numba warning
+import warnings
+warnings.filterwarnings('ignore')
+import time
+import argparse
+import numpy as np
+
+from ppdet.py_op.bbox import (bbox2delta, bbox_overlaps, compute_bbox_targets,
+                              expand_bbox_targets)
+from ppdet.py_op.target import (generate_rpn_anchor_target,
+                                generate_proposal_target)
+
+
+def reference_generate_rpn_anchor_target(anchors,
+                                         gt_boxes,
+                                         is_crowd,
+                                         im_info,
+                                         rpn_straddle_thresh,
+                                         rpn_batch_size_per_im,
+                                         rpn_positive_overlap,
+                                         rpn_negative_overlap,
+                                         rpn_fg_fraction,
+                                         use_random=True,
+                                         anchor_reg_weights=[1., 1., 1., 1.]):
+    """Previous per-image generate_rpn_anchor_target."""
+    anchor_num = anchors.shape[0]
+    batch_size = gt_boxes.shape[0]
+
+    loc_indexes = []
+    cls_indexes = []
+    tgt_labels = []
+    tgt_deltas = []
+    anchor_inside_weights = []
+
+    for i in range(batch_size):
+
+        # TODO: move anchor filter into anchor generator 
+        im_height = im_info[i][0]
+        im_width = im_info[i][1]
+        im_scale = im_info[i][2]
+        if rpn_straddle_thresh >= 0:
+            anchor_inds = np.where((anchors[:, 0] >= -rpn_straddle_thresh) & (
+                anchors[:, 1] >= -rpn_straddle_thresh) & (
+                    anchors[:, 2] < im_width + rpn_straddle_thresh) & (
+                        anchors[:, 3] < im_height + rpn_straddle_thresh))[0]
+            anchor = anchors[anchor_inds, :]
+        else:
+            anchor_inds = np.arange(anchors.shape[0])
+            anchor = anchors
+
+        gt_bbox = gt_boxes[i] * im_scale
+        is_crowd_slice = is_crowd[i]
+        not_crowd_inds = np.where(is_crowd_slice == 0)[0]
+        gt_bbox = gt_bbox[not_crowd_inds]
+
+        # Step1: match anchor and gt_bbox
+        anchor_gt_bbox_inds, anchor_gt_bbox_iou, labels = \
+            reference_label_anchor(anchor, gt_bbox)
+
+        # Step2: sample anchor 
+        fg_inds, bg_inds, fg_fake_inds, fake_num = reference_sample_anchor(
+            anchor_gt_bbox_iou, labels, rpn_positive_overlap,
+            rpn_negative_overlap, rpn_batch_size_per_im, rpn_fg_fraction,
+            use_random)
+
+        # Step3: make output  
+        loc_inds = np.hstack([fg_fake_inds, fg_inds])
+        cls_inds = np.hstack([fg_inds, bg_inds])
+
+        sampled_labels = labels[cls_inds]
+
+        sampled_anchors = anchor[loc_inds]
+        sampled_gt_boxes = gt_bbox[anchor_gt_bbox_inds[loc_inds]]
+        sampled_deltas = bbox2delta(sampled_anchors, sampled_gt_boxes,
+                                    anchor_reg_weights)
+
+        anchor_inside_weight = np.zeros((len(loc_inds), 4), dtype=np.float32)
+        anchor_inside_weight[fake_num:, :] = 1
+
+        loc_indexes.append(anchor_inds[loc_inds] + i * anchor_num)
+        cls_indexes.append(anchor_inds[cls_inds] + i * anchor_num)
+        tgt_labels.append(sampled_labels)
+        tgt_deltas.append(sampled_deltas)
+        anchor_inside_weights.append(anchor_inside_weight)
+
+    loc_indexes = np.concatenate(loc_indexes)
+    cls_indexes = np.concatenate(cls_indexes)
+    tgt_labels = np.concatenate(tgt_labels).astype('float32')
+    tgt_deltas = np.vstack(tgt_deltas).astype('float32')
+    anchor_inside_weights = np.vstack(anchor_inside_weights)
+
+    return loc_indexes, cls_indexes, tgt_labels, tgt_deltas, anchor_inside_weights
+
+
+def reference_label_anchor(anchors, gt_boxes):
+    iou = bbox_overlaps(anchors, gt_boxes)
+    # every gt's anchor's index
+    gt_bbox_anchor_inds = iou.argmax(axis=0)
+    gt_bbox_anchor_iou = iou[gt_bbox_anchor_inds, np.arange(iou.shape[1])]
+    gt_bbox_anchor_iou_inds = np.where(iou == gt_bbox_anchor_iou)[0]
+
+    # every anchor's gt bbox's index 
+    anchor_gt_bbox_inds = iou.argmax(axis=1)
+    anchor_gt_bbox_iou = iou[np.arange(iou.shape[0]), anchor_gt_bbox_inds]
+
+    labels = np.ones((iou.shape[0], ), dtype=np.int32) * -1
+    labels[gt_bbox_anchor_iou_inds] = 1
+
+    return anchor_gt_bbox_inds, anchor_gt_bbox_iou, labels
+
+
+def reference_sample_anchor(anchor_gt_bbox_iou,
+                            labels,
+                            rpn_positive_overlap,
+                            rpn_negative_overlap,
+                            rpn_batch_size_per_im,
+                            rpn_fg_fraction,
+                            use_random=True):
+
+    labels[anchor_gt_bbox_iou >= rpn_positive_overlap] = 1
+    num_fg = int(rpn_fg_fraction * rpn_batch_size_per_im)
+    fg_inds = np.where(labels == 1)[0]
+    if len(fg_inds) > num_fg and use_random:
+        disable_inds = np.random.choice(
+            fg_inds, size=(len(fg_inds) - num_fg), replace=False)
+    else:
+        disable_inds = fg_inds[num_fg:]
+    labels[disable_inds] = -1
+    fg_inds = np.where(labels == 1)[0]
+
+    num_bg = rpn_batch_size_per_im - np.sum(labels == 1)
+    bg_inds = np.where(anchor_gt_bbox_iou < rpn_negative_overlap)[0]
+    if len(bg_inds) > num_bg and use_random:
+        enable_inds = bg_inds[np.random.randint(len(bg_inds), size=num_bg)]
+    else:
+        enable_inds = bg_inds[:num_bg]
+
+    fg_fake_inds = np.array([], np.int32)
+    fg_value = np.array([fg_inds[0]], np.int32)
+    fake_num = 0
+    for bg_id in enable_inds:
+        if bg_id in fg_inds:
+            fake_num += 1
+            fg_fake_inds = np.hstack([fg_fake_inds, fg_value])
+    labels[enable_inds] = 0
+
+    fg_inds = np.where(labels == 1)[0]
+    bg_inds = np.where(labels == 0)[0]
+
+    return fg_inds, bg_inds, fg_fake_inds, fake_num
+
+
+def reference_filter_roi(rois, max_overlap):
+    ws = rois[:, 2] - rois[:, 0] + 1
+    hs = rois[:, 3] - rois[:, 1] + 1
+    keep = np.where((ws > 0) & (hs > 0) & (max_overlap < 1))[0]
+    if len(keep) > 0:
+        return rois[keep, :]
+    return np.zeros((1, 4)).astype('float32')
+
+
+def reference_generate_proposal_target(rpn_rois,
+                                       rpn_rois_num,
+                                       gt_classes,
+                                       is_crowd,
+                                       gt_boxes,
+                                       im_info,
+                                       batch_size_per_im,
+                                       fg_fraction,
+                                       fg_thresh,
+                                       bg_thresh_hi,
+                                       bg_thresh_lo,
+                                       bbox_reg_weights,
+                                       class_nums=81,
+                                       use_random=True,
+                                       is_cls_agnostic=False,
+                                       is_cascade_rcnn=False,
+                                       max_overlaps=None):
+    """Previous per-image generate_proposal_target."""
+
+    rois = []
+    tgt_labels = []
+    tgt_deltas = []
+    rois_inside_weights = []
+    rois_outside_weights = []
+    sampled_max_overlaps = []
+    new_rois_num = []
+    st_num = 0
+    end_num = 0
+    for im_i in range(len(rpn_rois_num)):
+        length = rpn_rois_num[im_i]
+        end_num += length
+        rpn_roi = rpn_rois[st_num:end_num]
+        max_overlap = max_overlaps[st_num:end_num] if is_cascade_rcnn else None
+        im_scale = im_info[im_i][2]
+        rpn_roi = rpn_roi / im_scale
+        gt_bbox = gt_boxes[im_i]
+
+        if is_cascade_rcnn:
+            rpn_roi = reference_filter_roi(rpn_roi, max_overlap)
+        bbox = np.vstack([gt_bbox, rpn_roi]).astype('float32')
+
+        # Step1: label bbox 
+        roi_gt_bbox_inds, labels, max_overlap = reference_label_bbox(
+            bbox, gt_bbox, gt_classes[im_i], is_crowd[im_i])
+
+        # Step2: sample bbox 
+        fg_inds, bg_inds, fg_nums = reference_sample_bbox(
+            max_overlap, batch_size_per_im, fg_fraction, fg_thresh,
+            bg_thresh_hi, bg_thresh_lo, bbox_reg_weights, class_nums,
+            use_random, is_cls_agnostic, is_cascade_rcnn)
+
+        # Step3: make output 
+        sampled_inds = np.append(fg_inds, bg_inds)
+
+        sampled_labels = labels[sampled_inds]
+        sampled_labels[fg_nums:] = 0
+
+        sampled_boxes = bbox[sampled_inds]
+        sampled_max_overlap = max_overlap[sampled_inds]
+        sampled_gt_boxes = gt_bbox[roi_gt_bbox_inds[sampled_inds]]
+        sampled_gt_boxes[fg_nums:, :] = 0
+        sampled_deltas = compute_bbox_targets(sampled_boxes, sampled_gt_boxes,
+                                              sampled_labels, bbox_reg_weights)
+        sampled_deltas[fg_nums:, :] = 0
+        sampled_deltas, bbox_inside_weights = expand_bbox_targets(
+            sampled_deltas, class_nums, is_cls_agnostic)
+        bbox_outside_weights = np.array(
+            bbox_inside_weights > 0, dtype=bbox_inside_weights.dtype)
+
+        roi = sampled_boxes * im_scale
+        st_num += length
+
+        rois.append(roi)
+        new_rois_num.append(roi.shape[0])
+        tgt_labels.append(sampled_labels)
+        tgt_deltas.append(sampled_deltas)
+        rois_inside_weights.append(bbox_inside_weights)
+        rois_outside_weights.append(bbox_outside_weights)
+        sampled_max_overlaps.append(sampled_max_overlap)
+
+    rois = np.concatenate(rois, axis=0).astype(np.float32)
+    tgt_labels = np.concatenate(
+        tgt_labels, axis=0).astype(np.int32).reshape(-1, 1)
+    tgt_deltas = np.concatenate(tgt_deltas, axis=0).astype(np.float32)
+    rois_inside_weights = np.concatenate(
+        rois_inside_weights, axis=0).astype(np.float32)
+    rois_outside_weights = np.concatenate(
+        rois_outside_weights, axis=0).astype(np.float32)
+    sampled_max_overlaps = np.concatenate(
+        sampled_max_overlaps, axis=0).astype(np.float32)
+    new_rois_num = np.asarray(new_rois_num, np.int32)
+    return rois, tgt_labels, tgt_deltas, rois_inside_weights, rois_outside_weights, new_rois_num, sampled_max_overlaps
+
+
+def reference_label_bbox(boxes,
+                         gt_boxes,
+                         gt_classes,
+                         is_crowd,
+                         class_nums=81):
+
+    iou = bbox_overlaps(boxes, gt_boxes)
+
+    # every roi's gt box's index  
+    roi_gt_bbox_inds = np.zeros((boxes.shape[0]), dtype=np.int32)
+    roi_gt_bbox_iou = np.zeros((boxes.shape[0], class_nums), dtype=np.float32)
+
+    iou_argmax = iou.argmax(axis=1)
+    iou_max = iou.max(axis=1)
+    overlapped_boxes_ind = np.where(iou_max > 0)[0].astype('int32')
+    roi_gt_bbox_inds[overlapped_boxes_ind] = iou_argmax[overlapped_boxes_ind]
+    overlapped_boxes_gt_classes = gt_classes[iou_argmax[
+        overlapped_boxes_ind]].astype('int32')
+    roi_gt_bbox_iou[overlapped_boxes_ind,
+                    overlapped_boxes_gt_classes] = iou_max[overlapped_boxes_ind]
+
+    crowd_ind = np.where(is_crowd)[0]
+    roi_gt_bbox_iou[crowd_ind] = -1
+
+    max_overlap = roi_gt_bbox_iou.max(axis=1)
+    labels = roi_gt_bbox_iou.argmax(axis=1)
+
+    return roi_gt_bbox_inds, labels, max_overlap
+
+
+def reference_sample_bbox(max_overlap,
+                          batch_size_per_im,
+                          fg_fraction,
+                          fg_thresh,
+                          bg_thresh_hi,
+                          bg_thresh_lo,
+                          bbox_reg_weights,
+                          class_nums,
+                          use_random=True,
+                          is_cls_agnostic=False,
+                          is_cascade_rcnn=False):
+
+    rois_per_image = int(batch_size_per_im)
+    fg_rois_per_im = int(np.round(fg_fraction * rois_per_image))
+
+    if is_cascade_rcnn:
+        fg_inds = np.where(max_overlap >= fg_thresh)[0]
+        bg_inds = np.where((max_overlap < bg_thresh_hi) & (max_overlap >=
+                                                           bg_thresh_lo))[0]
+        fg_nums = fg_inds.shape[0]
+        bg_nums = bg_inds.shape[0]
+    else:
+        # sampe fg 
+        fg_inds = np.where(max_overlap >= fg_thresh)[0]
+        fg_nums = np.minimum(fg_rois_per_im, fg_inds.shape[0])
+        if (fg_inds.shape[0] > fg_nums) and use_random:
+            fg_inds = np.random.choice(fg_inds, size=fg_nums, replace=False)
+        fg_inds = fg_inds[:fg_nums]
+
+        # sample bg 
+        bg_inds = np.where((max_overlap < bg_thresh_hi) & (max_overlap >=
+                                                           bg_thresh_lo))[0]
+        bg_nums = rois_per_image - fg_nums
+        bg_nums = np.minimum(bg_nums, bg_inds.shape[0])
+        if (bg_inds.shape[0] > bg_nums) and use_random:
+            bg_inds = np.random.choice(bg_inds, size=bg_nums, replace=False)
+        bg_inds = bg_inds[:bg_nums]
+
+    return fg_inds, bg_inds, fg_nums
+
+
+def make_anchors(height, width, stride=16):
+    ys, xs = np.meshgrid(
+        np.arange(0, height, stride), np.arange(0, width, stride), indexing='ij')
+    anchors = []
+    for size in [32, 64, 128, 256, 512]:
+        for ratio in [0.5, 1., 2.]:
+            w = size / np.sqrt(ratio)
+            h = size * np.sqrt(ratio)
+            anchors.append(
+                np.stack(
+                    [xs - w / 2, ys - h / 2, xs + w / 2, ys + h / 2],
+                    axis=-1).reshape(-1, 4))
+    return np.concatenate(anchors).astype(np.float32)
+
+
+def make_boxes(num, height, width, min_size=8., max_size=400.):
+    x1 = np.random.uniform(0, width - min_size, num)
+    y1 = np.random.uniform(0, height - min_size, num)
+    w = np.random.uniform(min_size, max_size, num)
+    h = np.random.uniform(min_size, max_size, num)
+    return np.stack(
+        [x1, y1, np.minimum(x1 + w, width - 1), np.minimum(y1 + h, height - 1)],
+        axis=-1).astype(np.float32)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+def check_equal(ref, out, name):
+    assert len(ref) == len(out)
+    for k, (r, o) in enumerate(zip(ref, out)):
+        r = np.asarray(r)
+        o = np.asarray(o)
+        assert r.dtype == o.dtype and np.array_equal(r, o), \
+            '{} output {} mismatch'.format(name, k)
+
+
+def main(FLAGS):
+    np.random.seed(0)
+    bs = FLAGS.batch_size
+    height, width = FLAGS.height, FLAGS.width
+    anchors = make_anchors(height, width)
+    im_info = np.array([[height, width, 1.]] * bs, dtype=np.float32)
+    gt_boxes = np.stack(
+        [make_boxes(FLAGS.gt_num, height, width) for _ in range(bs)])
+    gt_classes = np.random.randint(1, 81, (bs, FLAGS.gt_num)).astype('int32')
+    is_crowd = (np.random.rand(bs, FLAGS.gt_num) < 0.05).astype('int32')
+    rois_num = np.array([FLAGS.rois_num] * bs, dtype=np.int32)
+    rois = np.concatenate(
+        [make_boxes(FLAGS.rois_num, height, width) for _ in range(bs)])
+
+    rpn_args = (anchors, gt_boxes, is_crowd, im_info, 0., 256, 0.7, 0.3, 0.5,
+                False)
+    rcnn_args = (rois, rois_num, gt_classes, is_crowd, gt_boxes, im_info, 512,
+                 0.25, 0.5, 0.5, 0., [0.1, 0.1, 0.2, 0.2], 81, False)
+
+    # check the targets against the previous implementation
+    ref = reference_generate_rpn_anchor_target(*rpn_args)
+    check_equal(ref, generate_rpn_anchor_target(*rpn_args), 'rpn target')
+    check_equal(ref,
+                generate_rpn_anchor_target(
+                    *rpn_args, prune=False), 'unpruned rpn target')
+    ref = reference_generate_proposal_target(*rcnn_args)
+    check_equal(ref, generate_proposal_target(*rcnn_args), 'rcnn target')
+
+    print('anchors: {}, gt per image: {}, rois per image: {}, batch: {}'.format(
+        anchors.shape[0], FLAGS.gt_num, FLAGS.rois_num, bs))
+    print('rpn  target, previous:  {:8.2f} ms'.format(
+        timeit(lambda: reference_generate_rpn_anchor_target(*rpn_args),
+               FLAGS.repeat)))
+    print('rpn  target, unpruned:  {:8.2f} ms'.format(
+        timeit(lambda: generate_rpn_anchor_target(*rpn_args, prune=False),
+               FLAGS.repeat)))
+    print('rpn  target, pruned:    {:8.2f} ms'.format(
+        timeit(lambda: generate_rpn_anchor_target(*rpn_args), FLAGS.repeat)))
+    print('rcnn target, previous:  {:8.2f} ms'.format(
+        timeit(lambda: reference_generate_proposal_target(*rcnn_args),
+               FLAGS.repeat)))
+    print('rcnn target, current:   {:8.2f} ms'.format(
+        timeit(lambda: generate_proposal_target(*rcnn_args), FLAGS.repeat)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--gt_num", type=int, default=50)
+    parser.add_argument("--rois_num", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--width", type=int, default=1216)
+    parser.add_argument("--repeat", type=int, default=10)
+    FLAGS = parser.parse_args()
+    main(FLAGS)
@@ -27,7 +27,8 @@ import logging
 from ppdet.core.workspace import register, serializable
 
 from .parallel_map import ParallelMap
-from .transform.batch_operators import Gt2YoloTarget
+from .transform.operators import MixupImage, CutmixImage
+from .transform.batch_operators import Gt2YoloTarget, RandomShape
 
 __all__ = ['Reader', 'create_reader']
 
@@ -170,6 +171,16 @@ class Reader(object):
             not use mixup.
         cutmix_epoch (int): cutmix epoc number. Default is -1, meaning
             not use cutmix.
+        mix_partner (str): how mixup/cutmix partners are chosen, one of
+            'random': copy and decode a random other sample (default),
+            'lazy': as 'random', but the mixing factor is drawn in the
+                reader first and the partner is not attached (nor
+                decoded) when the factor leaves one of the two images
+                unused or the partner's share is negligible (under one
+                gray level for mixup, an empty patch for cutmix at the
+                annotated image sizes), those samples are not mixed,
+            'in_batch': mix with another sample of the same batch, so no
+                extra image is decoded.
         class_aware_sampling (bool): whether use class-aware sampling or not.
             Default False.
         worker_num (int): number of working threads/processes.
@@ -196,6 +207,7 @@ class Reader(object):
                  drop_empty=True,
                  mixup_epoch=-1,
                  cutmix_epoch=-1,
+                 mix_partner='random',
                  class_aware_sampling=False,
                  worker_num=-1,
                  use_process=False,
@@ -214,6 +226,27 @@ class Reader(object):
         # transform
         self._sample_transforms = Compose(sample_transforms,
                                           {'fields': self._fields})
+
+        # mixup/cutmix partner
+        assert mix_partner in ['random', 'lazy', 'in_batch'], \
+            "unknown mix_partner: {}".format(mix_partner)
+        self._mix_partner = mix_partner
+        self._mix_ops = {}
+        sample_transforms = sample_transforms or []
+        mix_pos = len(sample_transforms)
+        for i, st in enumerate(sample_transforms):
+            key = 'mixup' if isinstance(st, MixupImage) else \
+                'cutmix' if isinstance(st, CutmixImage) else None
+            if key is not None:
+                self._mix_ops[key] = st
+                mix_pos = min(mix_pos, i)
+        if self._mix_partner == 'in_batch':
+            # transforms before the first mix op run on the whole batch
+            # before partners are picked, see `_mix_in_batch`
+            self._pre_mix_transforms = Compose(sample_transforms[:mix_pos],
+                                               {'fields': self._fields})
+            self._post_mix_transforms = Compose(sample_transforms[mix_pos:],
+                                                {'fields': self._fields})
         self._batch_transforms = None
 
         if use_fine_grained_loss:
@@ -226,9 +259,15 @@ class Reader(object):
                 if not isinstance(bt, Gt2YoloTarget)
             ]
 
+        # batch shape picked before sample transforms, see
+        # RandomShape.resize_in_sample
+        self._batch_shape_op = None
         if batch_transforms:
             self._batch_transforms = Compose(batch_transforms,
                                              {'fields': self._fields})
+            for bt in batch_transforms:
+                if isinstance(bt, RandomShape) and bt.resize_in_sample:
+                    self._batch_shape_op = bt
 
         # data
         if inputs_def and inputs_def.get('multi_scale', False):
@@ -332,12 +371,17 @@ class Reader(object):
     def _load_batch(self):
         batch = []
         bs = 0
+        batch_shape = None
+        if self._batch_shape_op is not None:
+            batch_shape = self._batch_shape_op.sample_shape()
         while bs != self._batch_size:
             if self._pos >= self.size():
                 break
             pos = self.indexes[self._pos]
             sample = copy.deepcopy(self._roidbs[pos])
             sample["curr_iter"] = self._curr_iter
+            if batch_shape is not None:
+                sample['batch_shape'] = batch_shape
             self._pos += 1
 
             if self._drop_empty and self._fields and 'gt_bbox' in sample:
@@ -357,34 +401,91 @@ class Reader(object):
                 sample['image'] = self._load_image(sample['im_file'])
 
             if self._epoch < self._mixup_epoch:
-                num = len(self.indexes)
-                mix_idx = np.random.randint(1, num)
-                mix_idx = self.indexes[(mix_idx + self._pos - 1) % num]
-                sample['mixup'] = copy.deepcopy(self._roidbs[mix_idx])
-                sample['mixup']["curr_iter"] = self._curr_iter
-                if self._load_img:
-                    sample['mixup']['image'] = self._load_image(sample['mixup'][
-                        'im_file'])
+                if self._mix_partner == 'in_batch':
+                    sample.setdefault('mix_in_batch', []).append('mixup')
+                else:
+                    num = len(self.indexes)
+                    mix_idx = np.random.randint(1, num)
+                    mix_idx = self.indexes[(mix_idx + self._pos - 1) % num]
+                    sample = self._attach_partner(sample, 'mixup', mix_idx)
             if self._epoch < self._cutmix_epoch:
-                num = len(self.indexes)
-                mix_idx = np.random.randint(1, num)
-                sample['cutmix'] = copy.deepcopy(self._roidbs[mix_idx])
-                sample['cutmix']["curr_iter"] = self._curr_iter
-                if self._load_img:
-                    sample['cutmix']['image'] = self._load_image(sample[
-                        'cutmix']['im_file'])
+                if self._mix_partner == 'in_batch':
+                    sample.setdefault('mix_in_batch', []).append('cutmix')
+                else:
+                    num = len(self.indexes)
+                    mix_idx = np.random.randint(1, num)
+                    sample = self._attach_partner(sample, 'cutmix', mix_idx)
 
             batch.append(sample)
             bs += 1
         return batch
 
+    def _attach_partner(self, sample, key, mix_idx):
+        """
+        attach roidb `mix_idx` as the `key` ('mixup' or 'cutmix') partner of
+        sample, in 'lazy' mode the mixing factor is drawn here and the
+        partner is only attached if both images contribute to the result.
+        """
+        factor = None
+        if self._mix_partner == 'lazy' and key in self._mix_ops:
+            op = self._mix_ops[key]
+            factor = op.sample_factor()
+            rec = self._roidbs[mix_idx]
+            h = max(sample.get('h') or 0, rec.get('h') or 0)
+            w = max(sample.get('w') or 0, rec.get('w') or 0)
+            if op.partner_negligible(factor, h, w):
+                return sample
+
+        partner = copy.deepcopy(self._roidbs[mix_idx])
+        partner["curr_iter"] = self._curr_iter
+        if self._load_img:
+            partner['image'] = self._load_image(partner['im_file'])
+
+        if factor is not None and factor <= 0.0:
+            # only the partner is kept, use it in place of the sample
+            for k in ['batch_shape', 'mixup', 'mixup_factor']:
+                if k in sample:
+                    partner[k] = sample[k]
+            return partner
+
+        sample[key] = partner
+        if factor is not None:
+            sample[key + '_factor'] = factor
+        return sample
+
+    def _mix_in_batch(self, batch_samples):
+        """
+        run the sample transforms before MixupImage/CutmixImage on the whole
+        batch, then pick the mix partners among the decoded samples.
+        """
+        samples = [self._pre_mix_transforms(s) for s in batch_samples]
+        num = len(samples)
+        mix_keys = [s.pop('mix_in_batch', []) for s in samples]
+        for i, sample in enumerate(samples):
+            if num < 2:
+                break
+            for key in mix_keys[i]:
+                j = (i + np.random.randint(1, num)) % num
+                # the decoded image is shared read-only, MixupImage and
+                # CutmixImage write the mixed result to a new array
+                sample[key] = {
+                    k: v if k == 'image' else copy.deepcopy(v)
+                    for k, v in samples[j].items()
+                    if k not in ['mixup', 'cutmix']
+                }
+        return samples
+
     def worker(self, drop_empty=True, batch_samples=None):
         """
         sample transform and batch transform.
         """
+        sample_transforms = self._sample_transforms
+        if self._mix_partner == 'in_batch':
+            batch_samples = self._mix_in_batch(batch_samples)
+            sample_transforms = self._post_mix_transforms
         batch = []
         for sample in batch_samples:
-            sample = self._sample_transforms(sample)
+            sample = sample_transforms(sample)
             if drop_empty and 'gt_bbox' in sample:
                 if _has_empty(sample['gt_bbox']):
                     #logger.warn('gt_bbox {} is empty or not valid in {}, '
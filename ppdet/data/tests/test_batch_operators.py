@@ -0,0 +1,168 @@
+#   Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import copy
+import unittest
+import numpy as np
+# add python path of PadleDetection to sys.path
+parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 4)))
+if parent_path not in sys.path:
+    sys.path.append(parent_path)
+
+from ppdet.data.transform.batch_operators import Gt2YoloTarget, \
+    PadMultiScaleTest
+from ppdet.data.transform.op_helper import jaccard_overlap
+
+ANCHORS = [[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119],
+           [116, 90], [156, 198], [373, 326]]
+ANCHOR_MASKS = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
+DOWNSAMPLE_RATIOS = [32, 16, 8]
+
+
+def ref_gt2yolotarget(samples, anchors, anchor_masks, downsample_ratios,
+                      num_classes, iou_thresh):
+    # previous per gt box loop of Gt2YoloTarget
+    h, w = samples[0]['image'].shape[1:3]
+    an_hw = np.array(anchors) / np.array([[w, h]])
+    for sample in samples:
+        gt_bbox = sample['gt_bbox']
+        gt_class = sample['gt_class']
+        gt_score = sample['gt_score']
+        for i, (mask, downsample_ratio
+                ) in enumerate(zip(anchor_masks, downsample_ratios)):
+            grid_h = int(h / downsample_ratio)
+            grid_w = int(w / downsample_ratio)
+            target = np.zeros(
+                (len(mask), 6 + num_classes, grid_h, grid_w),
+                dtype=np.float32)
+            for b in range(gt_bbox.shape[0]):
+                gx, gy, gw, gh = gt_bbox[b, :]
+                cls = gt_class[b]
+                score = gt_score[b]
+                if gw <= 0. or gh <= 0. or score <= 0.:
+                    continue
+                best_iou = 0.
+                best_idx = -1
+                for an_idx in range(an_hw.shape[0]):
+                    iou = jaccard_overlap(
+                        [0., 0., gw, gh],
+                        [0., 0., an_hw[an_idx, 0], an_hw[an_idx, 1]])
+                    if iou > best_iou:
+                        best_iou = iou
+                        best_idx = an_idx
+                gi = int(gx * grid_w)
+                gj = int(gy * grid_h)
+                if best_idx in mask:
+                    best_n = mask.index(best_idx)
+                    target[best_n, 0, gj, gi] = gx * grid_w - gi
+                    target[best_n, 1, gj, gi] = gy * grid_h - gj
+                    target[best_n, 2, gj, gi] = np.log(
+                        gw * w / anchors[best_idx][0])
+                    target[best_n, 3, gj, gi] = np.log(
+                        gh * h / anchors[best_idx][1])
+                    target[best_n, 4, gj, gi] = 2.0 - gw * gh
+                    target[best_n, 5, gj, gi] = score
+                    target[best_n, 6 + cls, gj, gi] = 1.
+                if iou_thresh < 1:
+                    for idx, mask_i in enumerate(mask):
+                        if mask_i == best_idx: continue
+                        iou = jaccard_overlap(
+                            [0., 0., gw, gh],
+                            [0., 0., an_hw[mask_i, 0], an_hw[mask_i, 1]])
+                        if iou > iou_thresh and target[idx, 5, gj, gi] == 0.:
+                            target[idx, 0, gj, gi] = gx * grid_w - gi
+                            target[idx, 1, gj, gi] = gy * grid_h - gj
+                            target[idx, 2, gj, gi] = np.log(
+                                gw * w / anchors[mask_i][0])
+                            target[idx, 3, gj, gi] = np.log(
+                                gh * h / anchors[mask_i][1])
+                            target[idx, 4, gj, gi] = 2.0 - gw * gh
+                            target[idx, 5, gj, gi] = score
+                            target[idx, 6 + cls, gj, gi] = 1.
+            sample['target{}'.format(i)] = target
+    return samples
+
+
+class TestGt2YoloTarget(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.num_classes = 20
+
+    def make_samples(self, batch_size, size, num_max_boxes=50):
+        samples = []
+        for _ in range(batch_size):
+            num = np.random.randint(0, num_max_boxes)
+            # centers on and just below the cell borders of every layer
+            # besides random ones
+            grid = np.random.choice([size // 32, size // 16, size // 8], num)
+            xy = np.random.randint(1, 8, (num, 2)) / grid[:, None]
+            xy[::2] -= 1e-7
+            xy[1::3] = np.random.rand(len(xy[1::3]), 2)
+            wh = np.random.uniform(0.01, 0.9, (num, 2))
+            gt_bbox = np.zeros((num_max_boxes, 4), dtype=np.float32)
+            gt_bbox[:num] = np.hstack([xy, wh])
+            gt_class = np.zeros((num_max_boxes, ), dtype=np.int32)
+            gt_class[:num] = np.random.randint(0, self.num_classes, num)
+            gt_score = np.zeros((num_max_boxes, ), dtype=np.float32)
+            gt_score[:num] = np.random.choice([1., 0.5, 0.], num)
+            samples.append({
+                'image': np.zeros((3, size, size), dtype=np.float32),
+                'gt_bbox': gt_bbox,
+                'gt_class': gt_class,
+                'gt_score': gt_score,
+            })
+        return samples
+
+    def test_targets(self):
+        for iou_thresh in [1., 0.5, 0.2]:
+            for size in [320, 608]:
+                op = Gt2YoloTarget(ANCHORS, ANCHOR_MASKS, DOWNSAMPLE_RATIOS,
+                                   self.num_classes, iou_thresh)
+                samples = self.make_samples(4, size)
+                ref = ref_gt2yolotarget(
+                    copy.deepcopy(samples), ANCHORS, ANCHOR_MASKS,
+                    DOWNSAMPLE_RATIOS, self.num_classes, iou_thresh)
+                out = op(samples)
+                for r, o in zip(ref, out):
+                    for i in range(len(ANCHOR_MASKS)):
+                        key = 'target{}'.format(i)
+                        self.assertTrue(np.array_equal(r[key], o[key]))
+
+
+class TestPadMultiScaleTest(unittest.TestCase):
+    def test_im_info(self):
+        op = PadMultiScaleTest(pad_to_stride=32)
+        shapes = [(300, 500), (800, 1000), (640, 33)]
+        samples = [{
+            'image': np.ones((3, h, w), dtype=np.float32),
+            'im_info': np.array([h, w, 1.], dtype=np.float32)
+        } for h, w in shapes]
+        samples = op(samples)
+        for sample, (h, w) in zip(samples, shapes):
+            # the array is padded to the batch, im_info to the image itself
+            self.assertEqual(sample['image'].shape, (3, 800, 1024))
+            self.assertEqual(sample['image'][:, :h, :w].sum(), 3 * h * w)
+            self.assertEqual(sample['image'].sum(), 3 * h * w)
+            single = op([{
+                'image': np.ones((3, h, w), dtype=np.float32),
+                'im_info': np.array([h, w, 1.], dtype=np.float32)
+            }])[0]
+            self.assertTrue(np.array_equal(sample['im_info'], single[
+                'im_info']))
+
+
+if __name__ == '__main__':
+    unittest.main()
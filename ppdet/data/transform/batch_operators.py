@@ -24,10 +24,10 @@ except Exception:
 import logging
 import cv2
 import numpy as np
-from scipy import ndimage
+from collections import OrderedDict
 
 from .operators import register_op, BaseOperator
-from .op_helper import jaccard_overlap, gaussian2D
+from .op_helper import cached_gaussian2D
 
 logger = logging.getLogger(__name__)
 
@@ -111,9 +111,20 @@ class RandomShape(BaseOperator):
     Args:
         sizes (list): list of int, random choose a size from these
         random_inter (bool): whether to randomly interpolation, defalut true.
+        resize_in_sample (bool): if True, the reader picks the size and
+            interpolation of each batch before dispatching its samples and
+            stores them as `sample['batch_shape']`, so that a sample level
+            `Resize` or `RandomInterpImage` resizes every image only once,
+            directly to the final shape. Images already at the batch shape
+            are not resized again here. Without random_inter the sample
+            level op keeps its own interpolation.
     """
 
-    def __init__(self, sizes=[], random_inter=False, resize_box=False):
+    def __init__(self,
+                 sizes=[],
+                 random_inter=False,
+                 resize_box=False,
+                 resize_in_sample=False):
         super(RandomShape, self).__init__()
         self.sizes = sizes
         self.random_inter = random_inter
@@ -125,14 +136,30 @@ class RandomShape(BaseOperator):
             cv2.INTER_LANCZOS4,
         ] if random_inter else []
         self.resize_box = resize_box
+        self.resize_in_sample = resize_in_sample
 
-    def __call__(self, samples, context=None):
+    def sample_shape(self):
+        """
+        randomly choose the [size, interpolation] of one batch, the
+        interpolation is None if it is not random
+        """
         shape = np.random.choice(self.sizes)
-        method = np.random.choice(self.interps) if self.random_inter \
-            else cv2.INTER_NEAREST
+        if not self.random_inter:
+            return [int(shape), None]
+        return [int(shape), int(np.random.choice(self.interps))]
+
+    def __call__(self, samples, context=None):
+        if 'batch_shape' in samples[0]:
+            shape, method = samples[0]['batch_shape']
+        else:
+            shape, method = self.sample_shape()
+        if method is None:
+            method = cv2.INTER_NEAREST
         for i in range(len(samples)):
             im = samples[i]['image']
             h, w = im.shape[:2]
+            if h == shape and w == shape:
+                continue
             scale_x = float(shape) / w
             scale_y = float(shape) / h
             im = cv2.resize(
@@ -151,7 +178,10 @@ class RandomShape(BaseOperator):
 class PadMultiScaleTest(BaseOperator):
     """
     Pad the image so they can be divisible by a stride for multi-scale testing.
- 
+    As a batch transform, every image field is padded to the largest size of
+    that field in the batch, while the im_info of each sample keeps its own
+    stride padded size, which the heads clip the boxes to.
+
     Args:
         pad_to_stride (int): If `pad_to_stride > 0`, pad zeros to ensure
             height and width is divisible by `pad_to_stride`.
@@ -170,28 +200,33 @@ class PadMultiScaleTest(BaseOperator):
         if not isinstance(samples, Sequence):
             batch_input = False
             samples = [samples]
-        if len(samples) != 1:
-            raise ValueError("Batch size must be 1 when using multiscale test, "
-                             "but now batch size is {}".format(len(samples)))
+        # pad each image field to the largest one of that field in the batch
+        max_shapes = {}
+        for k in samples[0].keys():
+            # hard code
+            if k.startswith('image'):
+                max_shape = np.array([sample[k].shape
+                                      for sample in samples]).max(axis=0)
+                max_h = int(
+                    np.ceil(max_shape[1] / coarsest_stride) * coarsest_stride)
+                max_w = int(
+                    np.ceil(max_shape[2] / coarsest_stride) * coarsest_stride)
+                max_shapes[k] = (max_h, max_w)
         for i in range(len(samples)):
             sample = samples[i]
-            for k in sample.keys():
-                # hard code
-                if k.startswith('image'):
-                    im = sample[k]
-                    im_c, im_h, im_w = im.shape
-                    max_h = int(
-                        np.ceil(im_h / coarsest_stride) * coarsest_stride)
-                    max_w = int(
-                        np.ceil(im_w / coarsest_stride) * coarsest_stride)
-                    padding_im = np.zeros(
-                        (im_c, max_h, max_w), dtype=np.float32)
-
-                    padding_im[:, :im_h, :im_w] = im
-                    sample[k] = padding_im
-                    info_name = 'im_info' if k == 'image' else 'im_info_' + k
-                    # update im_info
-                    sample[info_name][:2] = [max_h, max_w]
+            for k, (max_h, max_w) in max_shapes.items():
+                im = sample[k]
+                im_c, im_h, im_w = im.shape
+                padding_im = np.zeros((im_c, max_h, max_w), dtype=np.float32)
+
+                padding_im[:, :im_h, :im_w] = im
+                sample[k] = padding_im
+                info_name = 'im_info' if k == 'image' else 'im_info_' + k
+                # update im_info, as if the image were padded on its own
+                sample[info_name][:2] = [
+                    int(np.ceil(im_h / coarsest_stride) * coarsest_stride),
+                    int(np.ceil(im_w / coarsest_stride) * coarsest_stride)
+                ]
         if not batch_input:
             samples = samples[0]
         return samples
@@ -223,12 +258,26 @@ class Gt2YoloTarget(BaseOperator):
 
         h, w = samples[0]['image'].shape[1:3]
         an_hw = np.array(self.anchors) / np.array([[w, h]])
-        for sample in samples:
-            # im, gt_bbox, gt_class, gt_score = sample
-            im = sample['image']
-            gt_bbox = sample['gt_bbox']
-            gt_class = sample['gt_class']
-            gt_score = sample['gt_score']
+
+        # gt box vs anchor shape IoU of the whole batch in one matrix
+        gt_nums = [sample['gt_bbox'].shape[0] for sample in samples]
+        gt_offsets = np.cumsum([0] + gt_nums)
+        gt_wh = np.concatenate(
+            [sample['gt_bbox'].reshape((-1, 4)) for sample in samples],
+            axis=0)[:, 2:4].astype(np.float64)
+        gt_score = np.concatenate(
+            [sample['gt_score'].reshape((-1, )) for sample in samples])
+        valid = (gt_wh[:, 0] > 0.) & (gt_wh[:, 1] > 0.) & (gt_score > 0.)
+        inter = np.minimum(gt_wh[:, None, 0], an_hw[None, :, 0]) * \
+            np.minimum(gt_wh[:, None, 1], an_hw[None, :, 1])
+        union = (gt_wh[:, 0] * gt_wh[:, 1])[:, None] + \
+            (an_hw[:, 0] * an_hw[:, 1])[None, :] - inter
+        ious = np.zeros_like(inter)
+        ious[valid] = inter[valid] / union[valid]
+        best_idx = np.argmax(ious, axis=1)
+
+        for s_id, sample in enumerate(samples):
+            gt_slice = slice(gt_offsets[s_id], gt_offsets[s_id + 1])
             for i, (
                     mask, downsample_ratio
             ) in enumerate(zip(self.anchor_masks, self.downsample_ratios)):
@@ -237,86 +286,115 @@ class Gt2YoloTarget(BaseOperator):
                 target = np.zeros(
                     (len(mask), 6 + self.num_classes, grid_h, grid_w),
                     dtype=np.float32)
-                for b in range(gt_bbox.shape[0]):
-                    gx, gy, gw, gh = gt_bbox[b, :]
-                    cls = gt_class[b]
-                    score = gt_score[b]
-                    if gw <= 0. or gh <= 0. or score <= 0.:
-                        continue
-
-                    # find best match anchor index
-                    best_iou = 0.
-                    best_idx = -1
-                    for an_idx in range(an_hw.shape[0]):
-                        iou = jaccard_overlap(
-                            [0., 0., gw, gh],
-                            [0., 0., an_hw[an_idx, 0], an_hw[an_idx, 1]])
-                        if iou > best_iou:
-                            best_iou = iou
-                            best_idx = an_idx
-
-                    gi = int(gx * grid_w)
-                    gj = int(gy * grid_h)
-
-                    # gtbox should be regresed in this layes if best match 
-                    # anchor index in anchor mask of this layer
-                    if best_idx in mask:
-                        best_n = mask.index(best_idx)
-
-                        # x, y, w, h, scale
-                        target[best_n, 0, gj, gi] = gx * grid_w - gi
-                        target[best_n, 1, gj, gi] = gy * grid_h - gj
-                        target[best_n, 2, gj, gi] = np.log(
-                            gw * w / self.anchors[best_idx][0])
-                        target[best_n, 3, gj, gi] = np.log(
-                            gh * h / self.anchors[best_idx][1])
-                        target[best_n, 4, gj, gi] = 2.0 - gw * gh
-
-                        # objectness record gt_score
-                        target[best_n, 5, gj, gi] = score
-
-                        # classification
-                        target[best_n, 6 + cls, gj, gi] = 1.
-
-                    # For non-matched anchors, calculate the target if the iou 
-                    # between anchor and gt is larger than iou_thresh
-                    if self.iou_thresh < 1:
-                        for idx, mask_i in enumerate(mask):
-                            if mask_i == best_idx: continue
-                            iou = jaccard_overlap(
-                                [0., 0., gw, gh],
-                                [0., 0., an_hw[mask_i, 0], an_hw[mask_i, 1]])
-                            if iou > self.iou_thresh and target[idx, 5, gj,
-                                                                gi] == 0.:
-                                # x, y, w, h, scale
-                                target[idx, 0, gj, gi] = gx * grid_w - gi
-                                target[idx, 1, gj, gi] = gy * grid_h - gj
-                                target[idx, 2, gj, gi] = np.log(
-                                    gw * w / self.anchors[mask_i][0])
-                                target[idx, 3, gj, gi] = np.log(
-                                    gh * h / self.anchors[mask_i][1])
-                                target[idx, 4, gj, gi] = 2.0 - gw * gh
-
-                                # objectness record gt_score
-                                target[idx, 5, gj, gi] = score
-
-                                # classification
-                                target[idx, 6 + cls, gj, gi] = 1.
+                self._assign_layer(target, sample, mask, valid[gt_slice],
+                                   ious[gt_slice], best_idx[gt_slice], h, w)
                 sample['target{}'.format(i)] = target
         return samples
 
+    def _assign_layer(self, target, sample, mask, valid, ious, best_idx, h,
+                      w):
+        """
+        Fill the target of one output layer of one sample.
+
+        Each gt box is regressed by its best matched anchor if the anchor is
+        in the mask of this layer, and, if iou_thresh < 1, by the other
+        anchors of the layer whose shape IoU with it is above iou_thresh,
+        unless their grid cell has already been assigned. In both cases
+        later gt boxes override earlier ones and the class one-hot labels
+        accumulate, as gt boxes are processed in order.
+        """
+        # float64 like the scalar arithmetic of a per box loop, the cell of
+        # a center close to a cell border depends on it
+        gt_bbox = sample['gt_bbox'].reshape((-1, 4))
+        gt_scale = gt_bbox[:, 2] * gt_bbox[:, 3]
+        gt_bbox = gt_bbox.astype(np.float64)
+        gt_class = sample['gt_class'].reshape((-1, ))
+        gt_score = sample['gt_score'].reshape((-1, ))
+        num_mask, _, grid_h, grid_w = target.shape
+
+        # position of each anchor in the mask of this layer, -1 if absent
+        mask_pos = np.full((ious.shape[1], ), -1, dtype=np.int64)
+        mask_pos[np.array(mask)] = np.arange(num_mask)
+
+        # (gt index, mask position) of every assignment, best matches first
+        best_n = mask_pos[best_idx]
+        gt_ids = [np.nonzero(valid & (best_n >= 0))[0]]
+        mask_ids = [best_n[gt_ids[0]]]
+        if self.iou_thresh < 1:
+            mask = np.array(mask)
+            extra = valid[:, None] & (ious[:, mask] > self.iou_thresh) & \
+                (mask[None, :] != best_idx[:, None])
+            extra_gt, extra_n = np.nonzero(extra)
+            gt_ids.append(extra_gt)
+            mask_ids.append(extra_n)
+        is_best = np.concatenate(
+            [np.ones_like(gt_ids[0], dtype=bool)] +
+            [np.zeros_like(g, dtype=bool) for g in gt_ids[1:]])
+        gt_ids = np.concatenate(gt_ids)
+        mask_ids = np.concatenate(mask_ids)
+        if gt_ids.size == 0:
+            return
+
+        gx = gt_bbox[gt_ids, 0]
+        gy = gt_bbox[gt_ids, 1]
+        gi = (gx * grid_w).astype(np.int64)
+        gj = (gy * grid_h).astype(np.int64)
+        cell = (mask_ids * grid_h + gj) * grid_w + gi
+
+        # replay the assignments in gt order per cell: a best match always
+        # writes, an iou_thresh match only writes to an unassigned cell
+        order = np.lexsort((gt_ids, cell))
+        cell = cell[order]
+        first = np.ones_like(cell, dtype=bool)
+        first[1:] = cell[1:] != cell[:-1]
+        keep = order[is_best[order] | first]
+        cell = cell[is_best[order] | first]
+        last = np.ones_like(cell, dtype=bool)
+        last[:-1] = cell[1:] != cell[:-1]
+
+        # classification of every effective assignment
+        target[mask_ids[keep], 6 + gt_class[gt_ids[keep]], gj[keep], gi[
+            keep]] = 1.
+
+        # x, y, w, h, scale and objectness of the last one in each cell
+        keep = keep[last]
+        b, n = gt_ids[keep], mask_ids[keep]
+        anchors = np.array(self.anchors)[np.array(mask)[n]]
+        gw, gh = gt_bbox[b, 2], gt_bbox[b, 3]
+        target[n, 0, gj[keep], gi[keep]] = gx[keep] * grid_w - gi[keep]
+        target[n, 1, gj[keep], gi[keep]] = gy[keep] * grid_h - gj[keep]
+        target[n, 2, gj[keep], gi[keep]] = np.log(gw * w / anchors[:, 0])
+        target[n, 3, gj[keep], gi[keep]] = np.log(gh * h / anchors[:, 1])
+        target[n, 4, gj[keep], gi[keep]] = 2.0 - gt_scale[b].astype(
+            np.float64)
+        # objectness record gt_score
+        target[n, 5, gj[keep], gi[keep]] = gt_score[b]
+
 
 @register_op
 class Gt2FCOSTarget(BaseOperator):
     """
     Generate FCOS targets by groud truth data
+    Args:
+        object_sizes_boundary (list): the boundaries of object sizes of
+            each feature map level
+        center_sampling_radius (float): radius of center sampling in stride
+        downsample_ratios (list): strides of the feature map levels
+        norm_reg_targets (bool): whether to divide regression targets by
+            the stride
+        pair_chunk_size (int): max number of (point, gt box) pairs evaluated
+            at once, which bounds the peak memory of the assignment
     """
 
+    # number of image sizes whose points are cached
+    _points_cache_size = 32
+
     def __init__(self,
                  object_sizes_boundary,
                  center_sampling_radius,
                  downsample_ratios,
-                 norm_reg_targets=False):
+                 norm_reg_targets=False,
+                 pair_chunk_size=1 << 20):
         super(Gt2FCOSTarget, self).__init__()
         self.center_sampling_radius = center_sampling_radius
         self.downsample_ratios = downsample_ratios
@@ -329,6 +407,8 @@ class Gt2FCOSTarget(BaseOperator):
             ])
         self.object_sizes_of_interest = object_sizes_of_interest
         self.norm_reg_targets = norm_reg_targets
+        self.pair_chunk_size = pair_chunk_size
+        self._points_cache = OrderedDict()
 
     def _compute_points(self, w, h):
         """
@@ -350,6 +430,17 @@ class Gt2FCOSTarget(BaseOperator):
         locations = np.concatenate(locations, axis=0)
         return locations, num_points_each_level
 
+    def _get_points(self, w, h):
+        """
+        cached `_compute_points`, points only depend on the image size
+        """
+        key = (w, h)
+        if key not in self._points_cache:
+            if len(self._points_cache) >= self._points_cache_size:
+                self._points_cache.popitem(last=False)
+            self._points_cache[key] = self._compute_points(w, h)
+        return self._points_cache[key]
+
     def _convert_xywh2xyxy(self, gt_bbox, w, h):
         """
         convert the bounding box from style xywh to xyxy
@@ -365,41 +456,61 @@ class Gt2FCOSTarget(BaseOperator):
         bboxes[:, 3] = bboxes[:, 1] + bboxes[:, 3]
         return bboxes
 
-    def _check_inside_boxes_limited(self, gt_bbox, xs, ys,
-                                    num_points_each_level):
+    def _check_inside_boxes_limited(self, gt_bbox, xs, ys, stride):
         """
         check if points is within the clipped boxes
         :param gt_bbox: bounding boxes
-        :param xs: horizontal coordinate of points
-        :param ys: vertical coordinate of points
+        :param xs: horizontal coordinate of points, in shape [num_points, 1]
+        :param ys: vertical coordinate of points, in shape [num_points, 1]
+        :param stride: stride of the feature map level of the points
         :return: the mask of points is within gt_box or not
         """
-        bboxes = np.reshape(
-            gt_bbox, newshape=[1, gt_bbox.shape[0], gt_bbox.shape[1]])
-        bboxes = np.tile(bboxes, reps=[xs.shape[0], 1, 1])
-        ct_x = (bboxes[:, :, 0] + bboxes[:, :, 2]) / 2
-        ct_y = (bboxes[:, :, 1] + bboxes[:, :, 3]) / 2
-        beg = 0
-        clipped_box = bboxes.copy()
-        for lvl, stride in enumerate(self.downsample_ratios):
-            end = beg + num_points_each_level[lvl]
-            stride_exp = self.center_sampling_radius * stride
-            clipped_box[beg:end, :, 0] = np.maximum(
-                bboxes[beg:end, :, 0], ct_x[beg:end, :] - stride_exp)
-            clipped_box[beg:end, :, 1] = np.maximum(
-                bboxes[beg:end, :, 1], ct_y[beg:end, :] - stride_exp)
-            clipped_box[beg:end, :, 2] = np.minimum(
-                bboxes[beg:end, :, 2], ct_x[beg:end, :] + stride_exp)
-            clipped_box[beg:end, :, 3] = np.minimum(
-                bboxes[beg:end, :, 3], ct_y[beg:end, :] + stride_exp)
-            beg = end
-        l_res = xs - clipped_box[:, :, 0]
-        r_res = clipped_box[:, :, 2] - xs
-        t_res = ys - clipped_box[:, :, 1]
-        b_res = clipped_box[:, :, 3] - ys
-        clipped_box_reg_targets = np.stack([l_res, t_res, r_res, b_res], axis=2)
-        inside_gt_box = np.min(clipped_box_reg_targets, axis=2) > 0
-        return inside_gt_box
+        ct_x = (gt_bbox[:, 0] + gt_bbox[:, 2]) / 2
+        ct_y = (gt_bbox[:, 1] + gt_bbox[:, 3]) / 2
+        stride_exp = self.center_sampling_radius * stride
+        x0 = np.maximum(gt_bbox[:, 0], ct_x - stride_exp)
+        y0 = np.maximum(gt_bbox[:, 1], ct_y - stride_exp)
+        x1 = np.minimum(gt_bbox[:, 2], ct_x + stride_exp)
+        y1 = np.minimum(gt_bbox[:, 3], ct_y + stride_exp)
+        return (xs - x0 > 0) & (ys - y0 > 0) & (x1 - xs > 0) & (y1 - ys > 0)
+
+    def _assign_level(self, bboxes, gt_area, points, lvl):
+        """
+        match the points of one feature map level to the gt box of minimal
+        area which contains them and whose size fits the level, the points
+        are processed in chunks of at most `pair_chunk_size` pairs
+        :return: index of the matched gt box and its area, INF if unmatched
+        """
+        num_pts = points.shape[0]
+        lower_bound, high_bound = self.object_sizes_of_interest[lvl]
+        stride = self.downsample_ratios[lvl]
+        chunk = max(1, self.pair_chunk_size // max(1, bboxes.shape[0]))
+        min_area_ind = np.zeros((num_pts, ), dtype=np.int64)
+        min_area = np.full((num_pts, ), self.INF)
+        for beg in range(0, num_pts, chunk):
+            end = min(beg + chunk, num_pts)
+            xs = points[beg:end, 0:1]
+            ys = points[beg:end, 1:2]
+            l_res = xs - bboxes[:, 0]
+            r_res = bboxes[:, 2] - xs
+            t_res = ys - bboxes[:, 1]
+            b_res = bboxes[:, 3] - ys
+            if self.center_sampling_radius > 0:
+                is_inside_box = self._check_inside_boxes_limited(bboxes, xs,
+                                                                 ys, stride)
+            else:
+                is_inside_box = (l_res > 0) & (t_res > 0) & (r_res > 0) & \
+                    (b_res > 0)
+            # check if the targets is inside the corresponding level
+            max_reg_targets = np.maximum(
+                np.maximum(l_res, t_res), np.maximum(r_res, b_res))
+            is_match = is_inside_box & (max_reg_targets > lower_bound) & \
+                (max_reg_targets < high_bound)
+            points2gtarea = np.where(is_match, gt_area, self.INF)
+            ind = points2gtarea.argmin(axis=1)
+            min_area_ind[beg:end] = ind
+            min_area[beg:end] = points2gtarea[np.arange(end - beg), ind]
+        return min_area_ind, min_area
 
     def __call__(self, samples, context=None):
         assert len(self.object_sizes_of_interest) == len(self.downsample_ratios), \
@@ -418,91 +529,56 @@ class Gt2FCOSTarget(BaseOperator):
                 np.floor(im_info[0] / im_info[2])
             # calculate the locations
             h, w = sample['image'].shape[1:3]
-            points, num_points_each_level = self._compute_points(w, h)
-            object_scale_exp = []
-            for i, num_pts in enumerate(num_points_each_level):
-                object_scale_exp.append(
-                    np.tile(
-                        np.array([self.object_sizes_of_interest[i]]),
-                        reps=[num_pts, 1]))
-            object_scale_exp = np.concatenate(object_scale_exp, axis=0)
-
+            points, num_points_each_level = self._get_points(w, h)
             gt_area = (bboxes[:, 2] - bboxes[:, 0]) * (
                 bboxes[:, 3] - bboxes[:, 1])
-            xs, ys = points[:, 0], points[:, 1]
-            xs = np.reshape(xs, newshape=[xs.shape[0], 1])
-            xs = np.tile(xs, reps=[1, bboxes.shape[0]])
-            ys = np.reshape(ys, newshape=[ys.shape[0], 1])
-            ys = np.tile(ys, reps=[1, bboxes.shape[0]])
 
-            l_res = xs - bboxes[:, 0]
-            r_res = bboxes[:, 2] - xs
-            t_res = ys - bboxes[:, 1]
-            b_res = bboxes[:, 3] - ys
-            reg_targets = np.stack([l_res, t_res, r_res, b_res], axis=2)
-            if self.center_sampling_radius > 0:
-                is_inside_box = self._check_inside_boxes_limited(
-                    bboxes, xs, ys, num_points_each_level)
-            else:
-                is_inside_box = np.min(reg_targets, axis=2) > 0
-            # check if the targets is inside the corresponding level
-            max_reg_targets = np.max(reg_targets, axis=2)
-            lower_bound = np.tile(
-                np.expand_dims(
-                    object_scale_exp[:, 0], axis=1),
-                reps=[1, max_reg_targets.shape[1]])
-            high_bound = np.tile(
-                np.expand_dims(
-                    object_scale_exp[:, 1], axis=1),
-                reps=[1, max_reg_targets.shape[1]])
-            is_match_current_level = \
-                (max_reg_targets > lower_bound) & \
-                (max_reg_targets < high_bound)
-            points2gtarea = np.tile(
-                np.expand_dims(
-                    gt_area, axis=0), reps=[xs.shape[0], 1])
-            points2gtarea[is_inside_box == 0] = self.INF
-            points2gtarea[is_match_current_level == 0] = self.INF
-            points2min_area = points2gtarea.min(axis=1)
-            points2min_area_ind = points2gtarea.argmin(axis=1)
-            labels = gt_class[points2min_area_ind] + 1
-            labels[points2min_area == self.INF] = 0
-            reg_targets = reg_targets[range(xs.shape[0]), points2min_area_ind]
-            ctn_targets = np.sqrt((reg_targets[:, [0, 2]].min(axis=1) / \
-                                  reg_targets[:, [0, 2]].max(axis=1)) * \
-                                  (reg_targets[:, [1, 3]].min(axis=1) / \
-                                   reg_targets[:, [1, 3]].max(axis=1))).astype(np.float32)
-            ctn_targets = np.reshape(
-                ctn_targets, newshape=[ctn_targets.shape[0], 1])
-            ctn_targets[labels <= 0] = 0
-            pos_ind = np.nonzero(labels != 0)
-            reg_targets_pos = reg_targets[pos_ind[0], :]
-            split_sections = []
             beg = 0
-            for lvl in range(len(num_points_each_level)):
+            for lvl in range(len(self.downsample_ratios)):
                 end = beg + num_points_each_level[lvl]
-                split_sections.append(end)
+                level_points = points[beg:end]
                 beg = end
-            labels_by_level = np.split(labels, split_sections, axis=0)
-            reg_targets_by_level = np.split(reg_targets, split_sections, axis=0)
-            ctn_targets_by_level = np.split(ctn_targets, split_sections, axis=0)
-            for lvl in range(len(self.downsample_ratios)):
+                if bboxes.shape[0] > 0:
+                    points2min_area_ind, points2min_area = \
+                        self._assign_level(bboxes, gt_area, level_points, lvl)
+                    labels = gt_class[points2min_area_ind] + 1
+                    labels[points2min_area == self.INF] = 0
+                    matched = bboxes[points2min_area_ind]
+                else:
+                    labels = np.zeros(
+                        (level_points.shape[0], ), dtype=gt_class.dtype)
+                    matched = np.zeros(
+                        (level_points.shape[0], 4), dtype=bboxes.dtype)
+                xs, ys = level_points[:, 0], level_points[:, 1]
+                reg_targets = np.stack(
+                    [
+                        xs - matched[:, 0], ys - matched[:, 1],
+                        matched[:, 2] - xs, matched[:, 3] - ys
+                    ],
+                    axis=1)
+                ctn_targets = np.sqrt((reg_targets[:, [0, 2]].min(axis=1) / \
+                                      reg_targets[:, [0, 2]].max(axis=1)) * \
+                                      (reg_targets[:, [1, 3]].min(axis=1) / \
+                                       reg_targets[:, [1, 3]].max(axis=1))).astype(np.float32)
+                ctn_targets = np.reshape(
+                    ctn_targets, newshape=[ctn_targets.shape[0], 1])
+                ctn_targets[labels <= 0] = 0
+
                 grid_w = int(np.ceil(w / self.downsample_ratios[lvl]))
                 grid_h = int(np.ceil(h / self.downsample_ratios[lvl]))
                 if self.norm_reg_targets:
                     sample['reg_target{}'.format(lvl)] = \
                         np.reshape(
-                            reg_targets_by_level[lvl] / \
+                            reg_targets / \
                             self.downsample_ratios[lvl],
                             newshape=[grid_h, grid_w, 4])
                 else:
                     sample['reg_target{}'.format(lvl)] = np.reshape(
-                        reg_targets_by_level[lvl],
-                        newshape=[grid_h, grid_w, 4])
+                        reg_targets, newshape=[grid_h, grid_w, 4])
                 sample['labels{}'.format(lvl)] = np.reshape(
-                    labels_by_level[lvl], newshape=[grid_h, grid_w, 1])
+                    labels, newshape=[grid_h, grid_w, 1])
                 sample['centerness{}'.format(lvl)] = np.reshape(
-                    ctn_targets_by_level[lvl], newshape=[grid_h, grid_w, 1])
+                    ctn_targets, newshape=[grid_h, grid_w, 1])
         return samples
 
 
@@ -560,45 +636,65 @@ class Gt2TTFTarget(BaseOperator):
             h_radiuses_alpha = (feat_hs / 2. * self.alpha).astype('int32')
             w_radiuses_alpha = (feat_ws / 2. * self.alpha).astype('int32')
 
+            # every box only touches the window of its gaussian
             for k in range(len(gt_bbox)):
                 cls_id = gt_class[k]
-                fake_heatmap = np.zeros((feat_size, feat_size), dtype='float32')
-                self.draw_truncate_gaussian(fake_heatmap, ct_inds[k],
-                                            h_radiuses_alpha[k],
-                                            w_radiuses_alpha[k])
+                window = self._gaussian_window(ct_inds[k], h_radiuses_alpha[k],
+                                               w_radiuses_alpha[k], feat_size,
+                                               feat_size)
+                if window is None:
+                    continue
+                (y0, y1, x0, x1), local_heatmap = window
+                local_heatmap = local_heatmap.astype('float32')
 
-                heatmap[cls_id] = np.maximum(heatmap[cls_id], fake_heatmap)
-                box_target_inds = fake_heatmap > 0
-                box_target[:, box_target_inds] = gt_bbox[k][:, None]
+                heatmap[cls_id, y0:y1, x0:x1] = np.maximum(
+                    heatmap[cls_id, y0:y1, x0:x1], local_heatmap)
+                box_target_inds = local_heatmap > 0
+                box_target[:, y0:y1, x0:x1][:, box_target_inds] = \
+                    gt_bbox[k][:, None]
 
-                local_heatmap = fake_heatmap[box_target_inds]
+                local_heatmap = local_heatmap[box_target_inds]
                 ct_div = np.sum(local_heatmap)
                 local_heatmap *= boxes_area_topk_log[k]
-                reg_weight[0, box_target_inds] = local_heatmap / ct_div
+                reg_weight[0, y0:y1, x0:x1][box_target_inds] = \
+                    local_heatmap / ct_div
             sample['ttf_heatmap'] = heatmap
             sample['ttf_box_target'] = box_target
             sample['ttf_reg_weight'] = reg_weight
         return samples
 
-    def draw_truncate_gaussian(self, heatmap, center, h_radius, w_radius):
+    def _gaussian_window(self, center, h_radius, w_radius, height, width):
+        """
+        locate the truncated gaussian of a box on a (height, width) map
+        :return: (y0, y1, x0, x1) of the window on the map and the gaussian
+            values inside it, None if the window is empty
+        """
         h, w = 2 * h_radius + 1, 2 * w_radius + 1
         sigma_x = w / 6
         sigma_y = h / 6
-        gaussian = gaussian2D((h, w), sigma_x, sigma_y)
+        gaussian = cached_gaussian2D((h, w), sigma_x, sigma_y)
 
         x, y = int(center[0]), int(center[1])
 
-        height, width = heatmap.shape[0:2]
-
         left, right = min(x, w_radius), min(width - x, w_radius + 1)
         top, bottom = min(y, h_radius), min(height - y, h_radius + 1)
 
-        masked_heatmap = heatmap[y - top:y + bottom, x - left:x + right]
+        masked_shape = (len(range(*slice(y - top, y + bottom).indices(height))),
+                        len(range(*slice(x - left, x + right).indices(width))))
         masked_gaussian = gaussian[h_radius - top:h_radius + bottom, w_radius -
                                    left:w_radius + right]
-        if min(masked_gaussian.shape) > 0 and min(masked_heatmap.shape) > 0:
-            heatmap[y - top:y + bottom, x - left:x + right] = np.maximum(
-                masked_heatmap, masked_gaussian)
+        if min(masked_gaussian.shape) > 0 and min(masked_shape) > 0:
+            return (y - top, y + bottom, x - left, x + right), masked_gaussian
+        return None
+
+    def draw_truncate_gaussian(self, heatmap, center, h_radius, w_radius):
+        height, width = heatmap.shape[0:2]
+        window = self._gaussian_window(center, h_radius, w_radius, height,
+                                       width)
+        if window is not None:
+            (y0, y1, x0, x1), masked_gaussian = window
+            heatmap[y0:y1, x0:x1] = np.maximum(heatmap[y0:y1, x0:x1],
+                                               masked_gaussian)
         return heatmap
 
 
@@ -631,6 +727,20 @@ class Gt2Solov2Target(BaseOperator):
             im, None, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
         return resized_img
 
+    def _mass_centers(self, masks):
+        """
+        Mass centers of all instance masks, the same values as
+        ndimage.measurements.center_of_mass per mask, which are exact for
+        binary masks as all moments are integers.
+        """
+        rows = masks.sum(axis=2, dtype=np.int64)
+        cols = masks.sum(axis=1, dtype=np.int64)
+        mask_sums = rows.sum(axis=1)
+        normalizer = np.maximum(mask_sums, 1)
+        center_hs = rows.dot(np.arange(masks.shape[1])) / normalizer
+        center_ws = cols.dot(np.arange(masks.shape[2])) / normalizer
+        return mask_sums, center_hs, center_ws
+
     def __call__(self, samples, context=None):
         sample_id = 0
         for sample in samples:
@@ -643,6 +753,9 @@ class Gt2Solov2Target(BaseOperator):
             ]
             gt_areas = np.sqrt((gt_bboxes_raw[:, 2] - gt_bboxes_raw[:, 0]) *
                                (gt_bboxes_raw[:, 3] - gt_bboxes_raw[:, 1]))
+            mask_sums, center_hs, center_ws = self._mass_centers(gt_masks_raw)
+            # downsampled masks, shared by the overlapping scale ranges
+            scaled_masks = {}
             ins_ind_label_list = []
             idx = 0
             for (lower_bound, upper_bound), num_grid \
@@ -652,40 +765,28 @@ class Gt2Solov2Target(BaseOperator):
                                (gt_areas <= upper_bound)).nonzero()[0]
                 num_ins = len(hit_indices)
 
-                ins_label = []
-                grid_order = []
                 cate_label = np.zeros([num_grid, num_grid], dtype=np.int64)
                 ins_ind_label = np.zeros([num_grid**2], dtype=np.bool)
 
-                if num_ins == 0:
-                    ins_label = np.zeros(
-                        [1, mask_feat_size[0], mask_feat_size[1]],
-                        dtype=np.uint8)
-                    ins_ind_label_list.append(ins_ind_label)
-                    sample['cate_label{}'.format(idx)] = cate_label.flatten()
-                    sample['ins_label{}'.format(idx)] = ins_label
-                    sample['grid_order{}'.format(idx)] = np.asarray(
-                        [sample_id * num_grid * num_grid + 0])
-                    idx += 1
-                    continue
                 gt_bboxes = gt_bboxes_raw[hit_indices]
                 gt_labels = gt_labels_raw[hit_indices]
-                gt_masks = gt_masks_raw[hit_indices, ...]
 
                 half_ws = 0.5 * (
                     gt_bboxes[:, 2] - gt_bboxes[:, 0]) * self.coord_sigma
                 half_hs = 0.5 * (
                     gt_bboxes[:, 3] - gt_bboxes[:, 1]) * self.coord_sigma
 
-                for seg_mask, gt_label, half_h, half_w in zip(
-                        gt_masks, gt_labels, half_hs, half_ws):
-                    if seg_mask.sum() == 0:
+                # grid cells [top, down] x [left, right] of each instance
+                ins_cells = []
+                for ins_id, gt_label, half_h, half_w in zip(
+                        hit_indices, gt_labels, half_hs, half_ws):
+                    if mask_sums[ins_id] == 0:
                         continue
                     # mass center
                     upsampled_size = (mask_feat_size[0] * 4,
                                       mask_feat_size[1] * 4)
-                    center_h, center_w = ndimage.measurements.center_of_mass(
-                        seg_mask)
+                    center_h = center_hs[ins_id]
+                    center_w = center_ws[ins_id]
                     coord_w = int(
                         (center_w / upsampled_size[1]) // (1. / num_grid))
                     coord_h = int(
@@ -711,21 +812,12 @@ class Gt2Solov2Target(BaseOperator):
                     right = min(right_box, coord_w + 1)
 
                     cate_label[top:(down + 1), left:(right + 1)] = gt_label
-                    seg_mask = self._scale_size(
-                        seg_mask, scale=1. / self.sampling_ratio)
-                    for i in range(top, down + 1):
-                        for j in range(left, right + 1):
-                            label = int(i * num_grid + j)
-                            cur_ins_label = np.zeros(
-                                [mask_feat_size[0], mask_feat_size[1]],
-                                dtype=np.uint8)
-                            cur_ins_label[:seg_mask.shape[0], :seg_mask.shape[
-                                1]] = seg_mask
-                            ins_label.append(cur_ins_label)
-                            ins_ind_label[label] = True
-                            grid_order.append(
-                                [sample_id * num_grid * num_grid + label])
-                if ins_label == []:
+                    ins_cells.append((ins_id, top, down, left, right))
+
+                num_cells = sum(
+                    max(0, down - top + 1) * max(0, right - left + 1)
+                    for _, top, down, left, right in ins_cells)
+                if num_cells == 0:
                     ins_label = np.zeros(
                         [1, mask_feat_size[0], mask_feat_size[1]],
                         dtype=np.uint8)
@@ -734,13 +826,35 @@ class Gt2Solov2Target(BaseOperator):
                     sample['ins_label{}'.format(idx)] = ins_label
                     sample['grid_order{}'.format(idx)] = np.asarray(
                         [sample_id * num_grid * num_grid + 0])
-                else:
-                    ins_label = np.stack(ins_label, axis=0)
-                    ins_ind_label_list.append(ins_ind_label)
-                    sample['cate_label{}'.format(idx)] = cate_label.flatten()
-                    sample['ins_label{}'.format(idx)] = ins_label
-                    sample['grid_order{}'.format(idx)] = np.asarray(grid_order)
-                    assert len(grid_order) > 0
+                    idx += 1
+                    continue
+
+                ins_label = np.zeros(
+                    [num_cells, mask_feat_size[0], mask_feat_size[1]],
+                    dtype=np.uint8)
+                grid_order = np.zeros([num_cells, 1], dtype=np.int64)
+                beg = 0
+                for ins_id, top, down, left, right in ins_cells:
+                    labels = (np.arange(top, down + 1)[:, None] * num_grid +
+                              np.arange(left, right + 1)[None, :]).flatten()
+                    if labels.size == 0:
+                        continue
+                    if ins_id not in scaled_masks:
+                        scaled_masks[ins_id] = self._scale_size(
+                            gt_masks_raw[ins_id],
+                            scale=1. / self.sampling_ratio)
+                    seg_mask = scaled_masks[ins_id]
+                    end = beg + labels.size
+                    ins_label[beg:end, :seg_mask.shape[0], :seg_mask.shape[
+                        1]] = seg_mask
+                    ins_ind_label[labels] = True
+                    grid_order[beg:end, 0] = \
+                        sample_id * num_grid * num_grid + labels
+                    beg = end
+                ins_ind_label_list.append(ins_ind_label)
+                sample['cate_label{}'.format(idx)] = cate_label.flatten()
+                sample['ins_label{}'.format(idx)] = ins_label
+                sample['grid_order{}'.format(idx)] = grid_order
                 idx += 1
             ins_ind_labels = np.concatenate([
                 ins_ind_labels_level_img
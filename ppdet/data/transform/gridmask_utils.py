@@ -16,6 +16,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import collections
+
 import numpy as np
 from PIL import Image
 
@@ -46,13 +48,18 @@ class GridMask(object):
         if np.random.rand() > self.prob:
             return x
         _, h, w = x.shape
+        d = np.random.randint(2, h)
+        st_h = np.random.randint(d)
+        st_w = np.random.randint(d)
+        r = np.random.randint(self.rotate)
+        mask = self._gen_mask(h, w, d, st_h, st_w, r).astype(np.float32)
+        return self._apply_mask(x, mask)
+
+    def _gen_mask(self, h, w, d, st_h, st_w, r):
         hh = int(1.5 * h)
         ww = int(1.5 * w)
-        d = np.random.randint(2, h)
         self.l = min(max(int(d * self.ratio + 0.5), 1), d - 1)
         mask = np.ones((hh, ww), np.float32)
-        st_h = np.random.randint(d)
-        st_w = np.random.randint(d)
         if self.use_h:
             for i in range(hh // d):
                 s = d * i + st_h
@@ -64,15 +71,18 @@ class GridMask(object):
                 t = min(s + self.l, ww)
                 mask[:, s:t] *= 0
 
-        r = np.random.randint(self.rotate)
         mask = Image.fromarray(np.uint8(mask))
         mask = mask.rotate(r)
         mask = np.asarray(mask)
         mask = mask[(hh - h) // 2:(hh - h) // 2 + h, (ww - w) // 2:(ww - w) // 2
-                    + w].astype(np.float32)
+                    + w]
 
         if self.mode == 1:
             mask = 1 - mask
+        return mask
+
+    def _apply_mask(self, x, mask):
+        h, w = mask.shape
         mask = np.expand_dims(mask, axis=0)
         if self.offset:
             offset = (2 * (np.random.rand(h, w) - 0.5)).astype(np.float32)
@@ -81,3 +91,106 @@ class GridMask(object):
             x = (x * mask).astype(x.dtype)
 
         return x
+
+
+class GridMaskBank(GridMask):
+    """
+    GridMask drawing its masks from a precomputed bank instead of building
+    a new grid for every sample.
+
+    Images are grouped into size buckets (rounded up to `bucket`). For each
+    bucket `bank_size` masks are generated with random grid unit `d` and
+    rotation and a margin of `d` pixels, so that the random grid start of
+    GridMask becomes a random crop offset into a banked mask. Applying the
+    op is then a crop plus a single multiply. Masks are stored as uint8 and
+    only the crop is cast to float32, and at most `max_buckets` banks are
+    kept, evicting the least recently used bucket.
+
+    Args:
+        bank_size (int): number of masks kept per size bucket
+        bucket (int): image height/width are rounded up to a multiple of
+            this value to select the bank
+        refresh_interval (int): regenerate one random mask of a bucket after
+            this many draws from it, 0 to never refresh
+        bank_shapes (list): [h, w] shapes whose banks are built at
+            construction instead of on first use
+        max_buckets (int): number of size buckets kept, 0 for no limit
+    """
+
+    def __init__(self,
+                 use_h=True,
+                 use_w=True,
+                 rotate=1,
+                 offset=False,
+                 ratio=0.5,
+                 mode=1,
+                 prob=0.7,
+                 upper_iter=360000,
+                 bank_size=16,
+                 bucket=64,
+                 refresh_interval=0,
+                 bank_shapes=[],
+                 max_buckets=16):
+        super(GridMaskBank, self).__init__(
+            use_h,
+            use_w,
+            rotate=rotate,
+            offset=offset,
+            ratio=ratio,
+            mode=mode,
+            prob=prob,
+            upper_iter=upper_iter)
+        assert bank_size > 0, "bank_size should be positive"
+        self.bank_size = bank_size
+        self.bucket = bucket
+        self.refresh_interval = refresh_interval
+        self.max_buckets = max_buckets
+        self._banks = collections.OrderedDict()
+        self._draws = {}
+        for h, w in bank_shapes:
+            self._get_bank(h, w)
+
+    def _bucket_key(self, h, w):
+        bh = (h + self.bucket - 1) // self.bucket * self.bucket
+        bw = (w + self.bucket - 1) // self.bucket * self.bucket
+        return bh, bw
+
+    def _gen_bank_mask(self, key):
+        bh, bw = key
+        d = np.random.randint(2, max(bh, 3))
+        r = np.random.randint(self.rotate)
+        mask = self._gen_mask(bh + d, bw + d, d, 0, 0, r)
+        return np.ascontiguousarray(mask, dtype=np.uint8), d
+
+    def _get_bank(self, h, w):
+        key = self._bucket_key(h, w)
+        if key in self._banks:
+            # move to the end, the front is the least recently used
+            self._banks[key] = self._banks.pop(key)
+            return key, self._banks[key]
+        if self.max_buckets > 0 and len(self._banks) >= self.max_buckets:
+            old_key, _ = self._banks.popitem(last=False)
+            self._draws.pop(old_key)
+        self._banks[key] = [
+            self._gen_bank_mask(key) for _ in range(self.bank_size)
+        ]
+        self._draws[key] = 0
+        return key, self._banks[key]
+
+    def __call__(self, x, curr_iter):
+        self.prob = self.st_prob * min(1, 1.0 * curr_iter / self.upper_iter)
+        if np.random.rand() > self.prob:
+            return x
+        _, h, w = x.shape
+        key, bank = self._get_bank(h, w)
+
+        self._draws[key] += 1
+        if self.refresh_interval > 0 and \
+                self._draws[key] % self.refresh_interval == 0:
+            bank[np.random.randint(len(bank))] = self._gen_bank_mask(key)
+
+        mask, d = bank[np.random.randint(len(bank))]
+        off_h = np.random.randint(d)
+        off_w = np.random.randint(d)
+        mask = mask[off_h:off_h + h, off_w:off_w + w].astype(np.float32)
+        return self._apply_mask(x, mask)
@@ -21,6 +21,11 @@ import numpy as np
 import random
 import math
 import cv2
+from collections import OrderedDict
+
+# gaussian kernels shared by the heatmap target generators
+_gaussian_cache = OrderedDict()
+_GAUSSIAN_CACHE_SIZE = 512
 
 
 def meet_emit_constraint(src_bbox, sample_bbox):
@@ -439,7 +444,8 @@ def gaussian_radius(bbox_size, min_overlap):
 def draw_gaussian(heatmap, center, radius, k=1, delte=6):
     diameter = 2 * radius + 1
     sigma = diameter / delte
-    gaussian = gaussian2D((diameter, diameter), sigma_x=sigma, sigma_y=sigma)
+    gaussian = cached_gaussian2D(
+        (diameter, diameter), sigma_x=sigma, sigma_y=sigma)
 
     x, y = center
 
@@ -462,3 +468,21 @@ def gaussian2D(shape, sigma_x=1, sigma_y=1):
                                                             sigma_y)))
     h[h < np.finfo(h.dtype).eps * h.max()] = 0
     return h
+
+
+def cached_gaussian2D(shape, sigma_x=1, sigma_y=1):
+    """
+    gaussian2D with kernels cached by shape and sigma, the least recently
+    used kernel is dropped when the cache is full. The returned kernel is
+    shared between calls and read-only.
+    """
+    key = (int(shape[0]), int(shape[1]), float(sigma_x), float(sigma_y))
+    kernel = _gaussian_cache.pop(key, None)
+    if kernel is None:
+        kernel = gaussian2D(shape, sigma_x, sigma_y)
+        kernel.setflags(write=False)
+        if len(_gaussian_cache) >= _GAUSSIAN_CACHE_SIZE:
+            _gaussian_cache.popitem(last=False)
+    # (re)insert at the end, the front is the least recently used
+    _gaussian_cache[key] = kernel
+    return kernel
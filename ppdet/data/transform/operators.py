@@ -581,7 +581,12 @@ class GridMaskOp(BaseOperator):
                  ratio=0.5,
                  mode=1,
                  prob=0.7,
-                 upper_iter=360000):
+                 upper_iter=360000,
+                 bank_size=0,
+                 bank_bucket=64,
+                 bank_refresh=0,
+                 bank_shapes=[],
+                 bank_max_buckets=16):
         """
         GridMask Data Augmentation, see https://arxiv.org/abs/2001.04086
         Args:
@@ -593,6 +598,17 @@ class GridMaskOp(BaseOperator):
             mode (int): gridmask mode
             prob (float): max probability to carry out gridmask
             upper_iter (int): suggested to be equal to global max_iter
+            bank_size (int): if > 0, draw masks from a bank of this many
+                precomputed masks per size bucket instead of building a new
+                mask per sample
+            bank_bucket (int): size bucket granularity of the mask bank
+            bank_refresh (int): regenerate one banked mask of a bucket after
+                this many draws from it, 0 to keep the bank fixed
+            bank_shapes (list): [h, w] shapes to precompute banks for at
+                startup, other sizes are built on first use
+            bank_max_buckets (int): number of size buckets whose banks are
+                kept, the least recently used one is dropped beyond it,
+                0 for no limit
         """
         super(GridMaskOp, self).__init__()
         self.use_h = use_h
@@ -603,17 +619,38 @@ class GridMaskOp(BaseOperator):
         self.mode = mode
         self.prob = prob
         self.upper_iter = upper_iter
-
-        from .gridmask_utils import GridMask
-        self.gridmask_op = GridMask(
-            use_h,
-            use_w,
-            rotate=rotate,
-            offset=offset,
-            ratio=ratio,
-            mode=mode,
-            prob=prob,
-            upper_iter=upper_iter)
+        self.bank_size = bank_size
+        self.bank_bucket = bank_bucket
+        self.bank_refresh = bank_refresh
+        self.bank_shapes = bank_shapes
+        self.bank_max_buckets = bank_max_buckets
+
+        from .gridmask_utils import GridMask, GridMaskBank
+        if bank_size > 0:
+            self.gridmask_op = GridMaskBank(
+                use_h,
+                use_w,
+                rotate=rotate,
+                offset=offset,
+                ratio=ratio,
+                mode=mode,
+                prob=prob,
+                upper_iter=upper_iter,
+                bank_size=bank_size,
+                bucket=bank_bucket,
+                refresh_interval=bank_refresh,
+                bank_shapes=bank_shapes,
+                max_buckets=bank_max_buckets)
+        else:
+            self.gridmask_op = GridMask(
+                use_h,
+                use_w,
+                rotate=rotate,
+                offset=offset,
+                ratio=ratio,
+                mode=mode,
+                prob=prob,
+                upper_iter=upper_iter)
 
     def __call__(self, sample, context=None):
         samples = sample
@@ -1281,11 +1318,24 @@ class MixupImage(BaseOperator):
             img2.astype('float32') * (1.0 - factor)
         return img.astype('uint8')
 
+    def sample_factor(self):
+        factor = np.random.beta(self.alpha, self.beta)
+        return max(0.0, min(1.0, factor))
+
+    def partner_negligible(self, factor, h=0, w=0):
+        """
+        whether the partner adds less than one gray level to the mixed
+        image, h and w are unused and only kept for the CutmixImage api.
+        """
+        return (1.0 - factor) * 255. < 1.
+
     def __call__(self, sample, context=None):
         if 'mixup' not in sample:
             return sample
-        factor = np.random.beta(self.alpha, self.beta)
-        factor = max(0.0, min(1.0, factor))
+        # the factor may be drawn by the reader before decoding the partner
+        factor = sample.pop('mixup_factor', None)
+        if factor is None:
+            factor = self.sample_factor()
         if factor >= 1.0:
             sample.pop('mixup')
             return sample
@@ -1337,64 +1387,81 @@ class CutmixImage(BaseOperator):
         if self.beta <= 0.0:
             raise ValueError("beta shold be positive in {}".format(self))
 
-        def _rand_bbox(self, img1, img2, factor):
-            """ _rand_bbox """
-            h = max(img1.shape[0], img2.shape[0])
-            w = max(img1.shape[1], img2.shape[1])
-            cut_rat = np.sqrt(1. - factor)
-
-            cut_w = np.int(w * cut_rat)
-            cut_h = np.int(h * cut_rat)
-
-            # uniform
-            cx = np.random.randint(w)
-            cy = np.random.randint(h)
-
-            bbx1 = np.clip(cx - cut_w // 2, 0, w)
-            bby1 = np.clip(cy - cut_h // 2, 0, h)
-            bbx2 = np.clip(cx + cut_w // 2, 0, w)
-            bby2 = np.clip(cy + cut_h // 2, 0, h)
-
-            img_1 = np.zeros((h, w, img1.shape[2]), 'float32')
-            img_1[:img1.shape[0], :img1.shape[1], :] = \
-                img1.astype('float32')
-            img_2 = np.zeros((h, w, img2.shape[2]), 'float32')
-            img_2[:img2.shape[0], :img2.shape[1], :] = \
-                img2.astype('float32')
-            img_1[bby1:bby2, bbx1:bbx2, :] = img2[bby1:bby2, bbx1:bbx2, :]
-            return img_1
-
-        def __call__(self, sample, context=None):
-            if 'cutmix' not in sample:
-                return sample
-            factor = np.random.beta(self.alpha, self.beta)
-            factor = max(0.0, min(1.0, factor))
-            if factor >= 1.0:
-                sample.pop('cutmix')
-                return sample
-            if factor <= 0.0:
-                return sample['cutmix']
-            img1 = sample['image']
-            img2 = sample['cutmix']['image']
-            img = self._rand_bbox(img1, img2, factor)
-            gt_bbox1 = sample['gt_bbox']
-            gt_bbox2 = sample['cutmix']['gt_bbox']
-            gt_bbox = np.concatenate((gt_bbox1, gt_bbox2), axis=0)
-            gt_class1 = sample['gt_class']
-            gt_class2 = sample['cutmix']['gt_class']
-            gt_class = np.concatenate((gt_class1, gt_class2), axis=0)
-            gt_score1 = sample['gt_score']
-            gt_score2 = sample['cutmix']['gt_score']
-            gt_score = np.concatenate(
-                (gt_score1 * factor, gt_score2 * (1. - factor)), axis=0)
-            sample['image'] = img
-            sample['gt_bbox'] = gt_bbox
-            sample['gt_score'] = gt_score
-            sample['gt_class'] = gt_class
-            sample['h'] = img.shape[0]
-            sample['w'] = img.shape[1]
+    def _rand_bbox(self, img1, img2, factor):
+        """ _rand_bbox """
+        h = max(img1.shape[0], img2.shape[0])
+        w = max(img1.shape[1], img2.shape[1])
+        cut_rat = np.sqrt(1. - factor)
+
+        cut_w = int(w * cut_rat)
+        cut_h = int(h * cut_rat)
+
+        # uniform
+        cx = np.random.randint(w)
+        cy = np.random.randint(h)
+
+        bbx1 = np.clip(cx - cut_w // 2, 0, w)
+        bby1 = np.clip(cy - cut_h // 2, 0, h)
+        bbx2 = np.clip(cx + cut_w // 2, 0, w)
+        bby2 = np.clip(cy + cut_h // 2, 0, h)
+
+        img_1 = np.zeros((h, w, img1.shape[2]), 'float32')
+        img_1[:img1.shape[0], :img1.shape[1], :] = \
+            img1.astype('float32')
+        img_2 = np.zeros((h, w, img2.shape[2]), 'float32')
+        img_2[:img2.shape[0], :img2.shape[1], :] = \
+            img2.astype('float32')
+        img_1[bby1:bby2, bbx1:bbx2, :] = img_2[bby1:bby2, bbx1:bbx2, :]
+        return img_1
+
+    def sample_factor(self):
+        factor = np.random.beta(self.alpha, self.beta)
+        return max(0.0, min(1.0, factor))
+
+    def partner_negligible(self, factor, h=0, w=0):
+        """
+        whether the patch cut from the partner is empty on a h x w canvas
+        (see `_rand_bbox`), h or w of 0 means the size is unknown.
+        """
+        if factor >= 1.0:
+            return True
+        cut_rat = np.sqrt(1. - factor)
+        return (h > 0 and int(h * cut_rat) // 2 == 0) or \
+            (w > 0 and int(w * cut_rat) // 2 == 0)
+
+    def __call__(self, sample, context=None):
+        if 'cutmix' not in sample:
+            return sample
+        # the factor may be drawn by the reader before decoding the partner
+        factor = sample.pop('cutmix_factor', None)
+        if factor is None:
+            factor = self.sample_factor()
+        if factor >= 1.0:
             sample.pop('cutmix')
             return sample
+        if factor <= 0.0:
+            return sample['cutmix']
+        img1 = sample['image']
+        img2 = sample['cutmix']['image']
+        img = self._rand_bbox(img1, img2, factor)
+        gt_bbox1 = sample['gt_bbox']
+        gt_bbox2 = sample['cutmix']['gt_bbox']
+        gt_bbox = np.concatenate((gt_bbox1, gt_bbox2), axis=0)
+        gt_class1 = sample['gt_class']
+        gt_class2 = sample['cutmix']['gt_class']
+        gt_class = np.concatenate((gt_class1, gt_class2), axis=0)
+        gt_score1 = sample['gt_score']
+        gt_score2 = sample['cutmix']['gt_score']
+        gt_score = np.concatenate(
+            (gt_score1 * factor, gt_score2 * (1. - factor)), axis=0)
+        sample['image'] = img
+        sample['gt_bbox'] = gt_bbox
+        sample['gt_score'] = gt_score
+        sample['gt_class'] = gt_class
+        sample['h'] = img.shape[0]
+        sample['w'] = img.shape[1]
+        sample.pop('cutmix')
+        return sample
 
 
 @register_op
@@ -1425,6 +1492,14 @@ class RandomInterpImage(BaseOperator):
 
     def __call__(self, sample, context=None):
         """Resise the image numpy by random resizer."""
+        if 'batch_shape' in sample:
+            # the reader has picked the final square shape of this batch,
+            # see `RandomShape.resize_in_sample`
+            dim, interp = sample['batch_shape']
+            if interp is None:
+                interp = random.choice(self.resizers).interp
+            # the same fields as the resizers give, for a square target
+            return ResizeImage(dim, 0, interp)(sample, context)
         resizer = random.choice(self.resizers)
         return resizer(sample, context)
 
@@ -1438,6 +1513,11 @@ class Resize(BaseOperator):
         interp (int or str): interpolation method, can be an integer or
             'random' (for randomized interpolation).
             default to `cv2.INTER_LINEAR`.
+
+    If the sample carries a `batch_shape` picked by the reader (see
+    `RandomShape.resize_in_sample`), its size, and its interpolation unless
+    that is None, are used instead, so all images of the batch share the
+    same shape.
     """
 
     def __init__(self, target_dim=[], interp=cv2.INTER_LINEAR):
@@ -1449,14 +1529,19 @@ class Resize(BaseOperator):
         w = sample['w']
         h = sample['h']
 
-        interp = self.interp
-        if interp == 'random':
-            interp = np.random.choice(range(5))
-
-        if isinstance(self.target_dim, Sequence):
-            dim = np.random.choice(self.target_dim)
+        if 'batch_shape' in sample:
+            dim, interp = sample['batch_shape']
         else:
-            dim = self.target_dim
+            dim, interp = None, None
+        if interp is None:
+            interp = self.interp
+            if interp == 'random':
+                interp = np.random.choice(range(5))
+        if dim is None:
+            if isinstance(self.target_dim, Sequence):
+                dim = np.random.choice(self.target_dim)
+            else:
+                dim = self.target_dim
         resize_w = resize_h = dim
         scale_x = dim / w
         scale_y = dim / h
@@ -1610,6 +1695,149 @@ class ColorDistort(BaseOperator):
         return sample
 
 
+@register_op
+class FusedColorDistort(ColorDistort):
+    """Random color distortion applied in a single uint8 pass.
+
+    Draws the same random parameters as `ColorDistort` (RGB mode), but
+    instead of running brightness, contrast, saturation and hue as separate
+    float32 passes, they are composed into one affine color transform
+    `img @ M + b`, which is applied once to the uint8 image: as a per-channel
+    lookup table when `M` is diagonal (only brightness/contrast sampled),
+    otherwise as a single 3x4 `cv2.transform`. The result is rounded and
+    saturated to uint8, whereas `ColorDistort` leaves unclipped float32.
+
+    Args:
+        hue (list): hue settings.
+            in [lower, upper, probability] format.
+        saturation (list): saturation settings.
+            in [lower, upper, probability] format.
+        contrast (list): contrast settings.
+            in [lower, upper, probability] format.
+        brightness (list): brightness settings.
+            in [lower, upper, probability] format.
+        random_apply (bool): whether to apply in random (yolo) or fixed (SSD)
+            order.
+        random_channel (bool): whether to swap channels randomly
+    """
+
+    _gray_coef = np.array([0.299, 0.587, 0.114])
+
+    def __init__(self,
+                 hue=[-18, 18, 0.5],
+                 saturation=[0.5, 1.5, 0.5],
+                 contrast=[0.5, 1.5, 0.5],
+                 brightness=[0.5, 1.5, 0.5],
+                 random_apply=True,
+                 random_channel=False):
+        super(FusedColorDistort, self).__init__(
+            hue=hue,
+            saturation=saturation,
+            contrast=contrast,
+            brightness=brightness,
+            random_apply=random_apply,
+            hsv_format=False,
+            random_channel=random_channel)
+
+    def apply_hue(self, affine):
+        low, high, prob = self.hue
+        if np.random.uniform(0., 1.) < prob:
+            return affine
+        delta = np.random.uniform(low, high)
+        u = np.cos(delta * np.pi)
+        w = np.sin(delta * np.pi)
+        bt = np.array([[1.0, 0.0, 0.0], [0.0, u, -w], [0.0, w, u]])
+        tyiq = np.array([[0.299, 0.587, 0.114], [0.596, -0.274, -0.321],
+                         [0.211, -0.523, 0.311]])
+        ityiq = np.array([[1.0, 0.956, 0.621], [1.0, -0.272, -0.647],
+                          [1.0, -1.107, 1.705]])
+        t = np.dot(np.dot(ityiq, bt), tyiq).T
+        return self._compose(affine, t)
+
+    def apply_saturation(self, affine):
+        low, high, prob = self.saturation
+        if np.random.uniform(0., 1.) < prob:
+            return affine
+        delta = np.random.uniform(low, high)
+        # out = delta * img + (1 - delta) * gray(img), gray broadcast to RGB
+        t = delta * np.eye(3) + (1.0 - delta) * np.outer(self._gray_coef,
+                                                          np.ones(3))
+        return self._compose(affine, t)
+
+    def apply_contrast(self, affine):
+        low, high, prob = self.contrast
+        if np.random.uniform(0., 1.) < prob:
+            return affine
+        delta = np.random.uniform(low, high)
+        return self._compose(affine, delta * np.eye(3))
+
+    def apply_brightness(self, affine):
+        low, high, prob = self.brightness
+        if np.random.uniform(0., 1.) < prob:
+            return affine
+        delta = np.random.uniform(low, high)
+        return self._compose(affine, np.eye(3), np.full(3, delta))
+
+    @staticmethod
+    def _compose(affine, t, offset=None):
+        """apply `x @ t + offset` after the affine transform (m, b)"""
+        m, b = affine
+        m = np.dot(m, t)
+        b = np.dot(b, t)
+        if offset is not None:
+            b = b + offset
+        return m, b
+
+    def _apply_affine(self, img, affine):
+        m, b = affine
+        if np.allclose(m, np.eye(3)) and np.allclose(b, 0.):
+            return img
+        if img.dtype != np.uint8:
+            return (np.dot(img.astype(np.float32), m.astype(np.float32)) +
+                    b.astype(np.float32))
+        if np.count_nonzero(m - np.diag(np.diag(m))) == 0:
+            lut = np.arange(256, dtype=np.float32)[:, None] * np.diag(m) + b
+            lut = np.clip(np.round(lut), 0, 255).astype(np.uint8)
+            return cv2.LUT(img, lut[None, :, :])
+        return cv2.transform(img, np.hstack([m.T, b[:, None]]))
+
+    def __call__(self, sample, context=None):
+        img = sample['image']
+        if img.ndim != 3 or img.shape[2] != 3:
+            raise ImageError("{}: image is not 3-channel.".format(self))
+
+        affine = (np.eye(3), np.zeros(3))
+        if self.random_apply:
+            functions = [
+                self.apply_brightness,
+                self.apply_contrast,
+                self.apply_saturation,
+                self.apply_hue,
+            ]
+            distortions = np.random.permutation(functions)
+            for func in distortions:
+                affine = func(affine)
+        else:
+            affine = self.apply_brightness(affine)
+            if np.random.randint(0, 2):
+                affine = self.apply_contrast(affine)
+                affine = self.apply_saturation(affine)
+                affine = self.apply_hue(affine)
+            else:
+                affine = self.apply_saturation(affine)
+                affine = self.apply_hue(affine)
+                affine = self.apply_contrast(affine)
+
+            if self.random_channel:
+                if np.random.randint(0, 2):
+                    order = np.random.permutation(3)
+                    affine = (affine[0][:, order], affine[1][order])
+
+        sample['image'] = np.ascontiguousarray(
+            self._apply_affine(img, affine))
+        return sample
+
+
 @register_op
 class CornerRandColor(ColorDistort):
     """Random color for CornerNet series models.
@@ -25,6 +25,7 @@ from paddle.fluid.param_attr import ParamAttr
 from paddle.fluid.regularizer import L2Decay
 from ppdet.core.workspace import register, serializable
 from ppdet.utils.bbox_utils import bbox_overlaps, box_to_delta
+from ppdet.utils.post_process import soft_nms
 
 __all__ = [
     'AnchorGenerator', 'AnchorGrid', 'DropBlock', 'RPNTargetAssign',
@@ -562,35 +563,9 @@ class MultiClassSoftNMS(object):
 
         def _soft_nms_for_cls(dets, sigma, thres):
             """soft_nms_for_cls"""
-            dets_final = []
-            while len(dets) > 0:
-                maxpos = np.argmax(dets[:, 0])
-                dets_final.append(dets[maxpos].copy())
-                ts, tx1, ty1, tx2, ty2 = dets[maxpos]
-                scores = dets[:, 0]
-                # force remove bbox at maxpos
-                scores[maxpos] = -1
-                x1 = dets[:, 1]
-                y1 = dets[:, 2]
-                x2 = dets[:, 3]
-                y2 = dets[:, 4]
-                eta = 0 if self.normalized else 1
-                areas = (x2 - x1 + eta) * (y2 - y1 + eta)
-                xx1 = np.maximum(tx1, x1)
-                yy1 = np.maximum(ty1, y1)
-                xx2 = np.minimum(tx2, x2)
-                yy2 = np.minimum(ty2, y2)
-                w = np.maximum(0.0, xx2 - xx1 + eta)
-                h = np.maximum(0.0, yy2 - yy1 + eta)
-                inter = w * h
-                ovr = inter / (areas + areas[maxpos] - inter)
-                weight = np.exp(-(ovr * ovr) / sigma)
-                scores = scores * weight
-                idx_keep = np.where(scores >= thres)
-                dets[:, 0] = scores
-                dets = dets[idx_keep]
-            dets_final = np.array(dets_final).reshape(-1, 5)
-            return dets_final
+            eta = 0 if self.normalized else 1
+            return soft_nms(
+                dets, sigma, thres, eta=eta, top_k=self.keep_top_k)
 
         def _soft_nms(bboxes, scores):
             class_nums = scores.shape[-1]
@@ -0,0 +1,169 @@
+#   Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import os
+import sys
+# add python path of PadleDetection to sys.path
+parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 4)))
+if parent_path not in sys.path:
+    sys.path.append(parent_path)
+
+from ppdet.utils.coco_eval import parallel_evaluate, save_results
+
+
+def make_coco(num_images, num_cats):
+    """Random COCO ground truth and [N, 7] bbox results around it"""
+    from pycocotools.coco import COCO
+    images = [{
+        'id': i * 3 + 1,
+        'height': 200,
+        'width': 300
+    } for i in range(num_images)]
+    cats = [{'id': c * 2 + 1, 'name': str(c)} for c in range(num_cats)]
+    anns = []
+    dets = []
+    for im in images:
+        for _ in range(np.random.randint(0, 6)):
+            x, y = np.random.uniform(0, 200, 2)
+            w, h = np.random.uniform(2, 80, 2)
+            cat = cats[np.random.randint(num_cats)]['id']
+            anns.append({
+                'id': len(anns) + 1,
+                'image_id': im['id'],
+                'category_id': cat,
+                'bbox': [x, y, w, h],
+                'area': w * h,
+                'iscrowd': int(np.random.rand() < 0.05)
+            })
+            for _ in range(np.random.randint(0, 3)):
+                dets.append([
+                    im['id'], cat, x + np.random.normal(0, 4),
+                    y + np.random.normal(0, 4), w, h, np.random.rand()
+                ])
+        for _ in range(np.random.randint(0, 3)):
+            dets.append([
+                im['id'], cats[np.random.randint(num_cats)]['id'],
+                np.random.uniform(0, 250), np.random.uniform(0, 150),
+                np.random.uniform(2, 50), np.random.uniform(2, 50),
+                np.random.rand()
+            ])
+    coco_gt = COCO()
+    coco_gt.dataset = {
+        'images': images,
+        'categories': cats,
+        'annotations': anns
+    }
+    coco_gt.createIndex()
+    # loadRes takes [image_id, x, y, w, h, score, category_id] rows
+    dets = np.array(dets, dtype=np.float64)[:, [0, 2, 3, 4, 5, 6, 1]]
+    return coco_gt, coco_gt.loadRes(dets)
+
+
+class TestParallelEvaluate(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_stats(self):
+        from pycocotools.cocoeval import COCOeval
+        coco_gt, coco_dt = make_coco(60, 5)
+        for use_cats in [1, 0]:
+            ref = COCOeval(coco_gt, coco_dt, 'bbox')
+            ref.params.useCats = use_cats
+            ref.evaluate()
+            ref.accumulate()
+            out = COCOeval(coco_gt, coco_dt, 'bbox')
+            out.params.useCats = use_cats
+            parallel_evaluate(out, num_workers=3)
+            out.accumulate()
+            # the per image results are merged back in COCOeval's order
+            self.assertEqual(len(ref.evalImgs), len(out.evalImgs))
+            for r, o in zip(ref.evalImgs, out.evalImgs):
+                self.assertEqual(r is None, o is None)
+                if r is None:
+                    continue
+                self.assertEqual(sorted(r.keys()), sorted(o.keys()))
+                for k in r:
+                    self.assertTrue(
+                        np.array_equal(r[k], o[k]), (use_cats, k))
+            for k in ['precision', 'recall', 'scores']:
+                self.assertTrue(
+                    np.array_equal(ref.eval[k], out.eval[k]), (use_cats, k))
+
+
+class TestSaveResults(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check(self, results, ref):
+        for chunk_size in [1, 3, 10000]:
+            outfile = os.path.join(self.tmp_dir, 'result.json')
+            save_results(outfile, results, chunk_size)
+            with open(outfile) as f:
+                self.assertEqual(f.read(), json.dumps(ref))
+
+    def test_bbox(self):
+        for num in [0, 1, 7]:
+            dets = np.hstack([
+                np.random.randint(0, 1000, (num, 2)),
+                np.random.uniform(-10, 1000, (num, 4)),
+                np.random.rand(num, 1)
+            ])
+            if num > 0:
+                # non-finite values are written the way json.dump does
+                dets[0, 2:5] = [np.nan, np.inf, -np.inf]
+            ref = [{
+                'image_id': int(d[0]),
+                'category_id': int(d[1]),
+                'bbox': d[2:6],
+                'score': d[6]
+            } for d in dets.tolist()]
+            self.check(dets, ref)
+
+    def test_segm(self):
+        import pycocotools.mask as mask_util
+        for num in [0, 1, 7]:
+            info = np.hstack([
+                np.random.randint(0, 1000, (num, 2)), np.random.rand(num, 1)
+            ])
+            segms = []
+            for _ in range(num):
+                mask = (np.random.rand(20, 30) < 0.3).astype(np.uint8)
+                rle = mask_util.encode(np.asfortranarray(mask))
+                rle['counts'] = rle['counts'].decode('utf8')
+                segms.append(rle)
+            ref = [{
+                'image_id': int(im_id),
+                'category_id': int(catid),
+                'segmentation': segm,
+                'score': score
+            } for (im_id, catid, score), segm in zip(info.tolist(), segms)]
+            self.check((info, segms), ref)
+
+
+if __name__ == '__main__':
+    unittest.main()
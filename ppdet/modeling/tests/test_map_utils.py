@@ -0,0 +1,206 @@
+#   Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import unittest
+import numpy as np
+
+import os
+import sys
+# add python path of PadleDetection to sys.path
+parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 4)))
+if parent_path not in sys.path:
+    sys.path.append(parent_path)
+
+from ppdet.utils.map_utils import DetectionMAP, jaccard_overlap
+
+
+class RefDetectionMAP(object):
+    """Previous per box DetectionMAP, mAP of a single threshold"""
+
+    def __init__(self,
+                 class_num,
+                 overlap_thresh=0.5,
+                 map_type='11point',
+                 is_bbox_normalized=False,
+                 evaluate_difficult=False):
+        self.class_num = class_num
+        self.overlap_thresh = overlap_thresh
+        self.map_type = map_type
+        self.is_bbox_normalized = is_bbox_normalized
+        self.evaluate_difficult = evaluate_difficult
+        self.class_score_poss = [[] for _ in range(self.class_num)]
+        self.class_gt_counts = [0] * self.class_num
+
+    def update(self, bbox, gt_box, gt_label, difficult):
+        for gtl, diff in zip(gt_label, difficult):
+            if self.evaluate_difficult or int(diff) == 0:
+                self.class_gt_counts[int(np.array(gtl))] += 1
+        visited = [False] * len(gt_label)
+        for b in bbox:
+            label, score, xmin, ymin, xmax, ymax = b.tolist()
+            pred = [xmin, ymin, xmax, ymax]
+            max_idx = -1
+            max_overlap = -1.0
+            for i, gl in enumerate(gt_label):
+                if int(gl) == int(label):
+                    overlap = jaccard_overlap(pred, gt_box[i],
+                                              self.is_bbox_normalized)
+                    if overlap > max_overlap:
+                        max_overlap = overlap
+                        max_idx = i
+            if max_overlap > self.overlap_thresh:
+                if self.evaluate_difficult or \
+                        int(np.array(difficult[max_idx])) == 0:
+                    if not visited[max_idx]:
+                        self.class_score_poss[int(label)].append([score, 1.0])
+                        visited[max_idx] = True
+                    else:
+                        self.class_score_poss[int(label)].append([score, 0.0])
+            else:
+                self.class_score_poss[int(label)].append([score, 0.0])
+
+    def get_map(self):
+        mAP = 0.
+        valid_cnt = 0
+        for score_pos, count in zip(self.class_score_poss,
+                                    self.class_gt_counts):
+            if count == 0: continue
+            if len(score_pos) == 0:
+                valid_cnt += 1
+                continue
+            sorted_list = sorted(score_pos, key=lambda s: s[0], reverse=True)
+            precision = []
+            recall = []
+            accum_tp = 0
+            accum_fp = 0
+            for (score, pos) in sorted_list:
+                accum_tp += int(pos)
+                accum_fp += 1 - int(pos)
+                precision.append(float(accum_tp) / (accum_tp + accum_fp))
+                recall.append(float(accum_tp) / count)
+            if self.map_type == '11point':
+                max_precisions = [0.] * 11
+                start_idx = len(precision) - 1
+                for j in range(10, -1, -1):
+                    for i in range(start_idx, -1, -1):
+                        if recall[i] < float(j) / 10.:
+                            start_idx = i
+                            if j > 0:
+                                max_precisions[j - 1] = max_precisions[j]
+                                break
+                        else:
+                            if max_precisions[j] < precision[i]:
+                                max_precisions[j] = precision[i]
+                mAP += sum(max_precisions) / 11.
+            else:
+                ap = 0.
+                prev_recall = 0.
+                for i in range(len(precision)):
+                    recall_gap = math.fabs(recall[i] - prev_recall)
+                    if recall_gap > 1e-6:
+                        ap += precision[i] * recall_gap
+                        prev_recall = recall[i]
+                mAP += ap
+            valid_cnt += 1
+        return mAP / float(valid_cnt) if valid_cnt > 0 else mAP
+
+
+def make_image(num_classes, num_gt, num_det):
+    """Random [label, score, box] detections around random gt boxes"""
+    xy = np.random.uniform(0, 400, (num_gt, 2))
+    gt_box = np.hstack([xy, xy + np.random.uniform(10, 200, (num_gt, 2))])
+    gt_label = np.random.randint(0, num_classes, num_gt)
+    difficult = (np.random.rand(num_gt) < 0.2).astype(np.int32)
+    if num_gt > 0:
+        src = np.random.randint(0, num_gt, num_det)
+        boxes = gt_box[src] + np.random.normal(0, 15, (num_det, 4))
+        labels = np.where(
+            np.random.rand(num_det) < 0.8, gt_label[src],
+            np.random.randint(0, num_classes, num_det))
+    else:
+        xy = np.random.uniform(0, 400, (num_det, 2))
+        boxes = np.hstack([xy, xy + np.random.uniform(10, 200, (num_det, 2))])
+        labels = np.random.randint(0, num_classes, num_det)
+    # rounded scores tie, which exercises the order of equal scores
+    scores = np.round(np.random.rand(num_det), 2)
+    bbox = np.hstack([labels[:, None], scores[:, None], boxes])
+    return bbox, gt_box, gt_label, difficult
+
+
+class TestDetectionMAP(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.num_classes = 5
+
+    def test_map(self):
+        threshs = [0.3, 0.5, 0.75]
+        for k in range(24):
+            map_type = ['11point', 'integral'][k % 2]
+            evaluate_difficult = k % 4 >= 2
+            refs = [
+                RefDetectionMAP(
+                    self.num_classes,
+                    t,
+                    map_type,
+                    evaluate_difficult=evaluate_difficult) for t in threshs
+            ]
+            out = DetectionMAP(
+                self.num_classes,
+                threshs,
+                map_type,
+                evaluate_difficult=evaluate_difficult)
+            for _ in range(np.random.randint(1, 30)):
+                image = make_image(self.num_classes,
+                                   np.random.randint(0, 10),
+                                   np.random.randint(0, 30))
+                out.update(*image)
+                for ref in refs:
+                    ref.update(*image)
+            out.accumulate()
+            self.assertEqual([ref.get_map() for ref in refs], out.get_map())
+
+    def test_padding_label(self):
+        for map_type in ['11point', 'integral']:
+            ref = DetectionMAP(self.num_classes, map_type=map_type)
+            out = DetectionMAP(self.num_classes, map_type=map_type)
+            for _ in range(20):
+                bbox, gt_box, gt_label, difficult = make_image(
+                    self.num_classes, np.random.randint(0, 8),
+                    np.random.randint(0, 20))
+                ref.update(bbox, gt_box, gt_label, difficult)
+                # rows labeled -1 are NMS padding and should be skipped
+                pad = np.zeros((np.random.randint(1, 5), 6))
+                pad[:, 0] = -1
+                pad[:, 1] = np.random.rand(len(pad))
+                is_pad = np.zeros(len(bbox) + len(pad), dtype=bool)
+                is_pad[np.random.choice(len(is_pad), len(pad), False)] = True
+                padded = np.zeros((len(is_pad), 6))
+                padded[is_pad] = pad
+                padded[~is_pad] = bbox
+                out.update(padded, gt_box, gt_label, difficult)
+            ref.accumulate()
+            out.accumulate()
+            self.assertEqual(ref.get_map(), out.get_map())
+            self.assertTrue(
+                np.array_equal(
+                    ref.get_class_ap(), out.get_class_ap(), equal_nan=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#   Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+
+import os
+import sys
+# add python path of PadleDetection to sys.path
+parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 4)))
+if parent_path not in sys.path:
+    sys.path.append(parent_path)
+
+from ppdet.utils.post_process import nms, multiclass_nms, crop_mask_rle
+
+
+def reference_nms(dets, thresh):
+    """Pairwise greedy NMS loop, returns the kept row indices."""
+    scores = dets[:, 0]
+    x1 = dets[:, 1]
+    y1 = dets[:, 2]
+    x2 = dets[:, 3]
+    y2 = dets[:, 4]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+    suppressed = np.zeros((dets.shape[0]), dtype=np.int32)
+    for _i in range(dets.shape[0]):
+        i = order[_i]
+        if suppressed[i] == 1:
+            continue
+        for _j in range(_i + 1, dets.shape[0]):
+            j = order[_j]
+            if suppressed[j] == 1:
+                continue
+            w = max(0.0, min(x2[i], x2[j]) - max(x1[i], x1[j]) + 1)
+            h = max(0.0, min(y2[i], y2[j]) - max(y1[i], y1[j]) + 1)
+            inter = w * h
+            if inter / (areas[i] + areas[j] - inter) >= thresh:
+                suppressed[j] = 1
+    return np.where(suppressed == 0)[0]
+
+
+class TestMulticlassNMS(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def make_case(self, num, tie_scores):
+        xy = np.random.uniform(0, 100, (num, 2))
+        boxes = np.hstack([xy, xy + np.random.uniform(1, 50, (num, 2))])
+        scores = np.random.rand(num)
+        # rounded scores or boxes tie a lot, which exercises the order
+        # equal scores are visited in
+        if tie_scores:
+            scores = np.round(scores, 1)
+        else:
+            boxes = np.round(boxes / 10) * 10
+        return boxes.astype(np.float32), scores.astype(np.float32)
+
+    def test_ties(self):
+        for k in range(40):
+            num = np.random.randint(1, 300)
+            num_classes = np.random.choice([2, 5, 20])
+            boxes, scores = self.make_case(num, k % 2 == 1)
+            labels = np.random.randint(0, num_classes, num)
+            batch_inds = np.random.randint(0, 2, num)
+            keep = multiclass_nms(boxes, scores, labels, 0.5, -1, batch_inds)
+            ref = []
+            for i in range(2):
+                for c in range(num_classes):
+                    inds = np.where((batch_inds == i) & (labels == c))[0]
+                    if len(inds) == 0:
+                        continue
+                    dets = np.hstack([scores[inds, np.newaxis], boxes[inds]])
+                    ref_keep = inds[reference_nms(dets, 0.5)]
+                    self.assertTrue(
+                        np.array_equal(dets[np.isin(inds, ref_keep)],
+                                       nms(dets, 0.5)))
+                    ref.append(ref_keep)
+            self.assertTrue(np.array_equal(keep, np.concatenate(ref)))
+
+
+class TestCropMaskRLE(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def check(self, crop, x0, y0, im_h, im_w):
+        import pycocotools.mask as mask_util
+        full = np.zeros((im_h, im_w), dtype=np.uint8)
+        h, w = crop.shape
+        full[y0:y0 + h, x0:x0 + w] = crop
+        ref = mask_util.encode(np.asfortranarray(full))
+        rle = crop_mask_rle(crop, x0, y0, im_h, im_w)
+        self.assertEqual(rle['size'], ref['size'])
+        self.assertEqual(rle['counts'], ref['counts'])
+
+    def test_random_crops(self):
+        for _ in range(500):
+            im_h, im_w = np.random.randint(1, 40, 2)
+            h = np.random.randint(1, im_h + 1)
+            w = np.random.randint(1, im_w + 1)
+            x0 = np.random.randint(0, im_w - w + 1)
+            y0 = np.random.randint(0, im_h - h + 1)
+            crop = (np.random.rand(h, w) < np.random.rand()).astype(np.uint8)
+            self.check(crop, x0, y0, im_h, im_w)
+
+    def test_edge_cases(self):
+        im_h, im_w = 20, 30
+        for h, w, x0, y0 in [(20, 5, 0, 0), (20, 5, 25, 0), (20, 30, 0, 0),
+                             (3, 4, 26, 17), (1, 1, 29, 19), (1, 1, 0, 0),
+                             (20, 1, 10, 0), (7, 30, 0, 13)]:
+            # full, empty, full height columns and mixed crops
+            for crop in [
+                    np.ones((h, w), dtype=np.uint8),
+                    np.zeros((h, w), dtype=np.uint8),
+                    (np.random.rand(h, w) < 0.5).astype(np.uint8)
+            ]:
+                self.check(crop, x0, y0, im_h, im_w)
+            crop = np.ones((h, w), dtype=np.uint8)
+            crop[:, ::2] = 0
+            self.check(crop, x0, y0, im_h, im_w)
+
+
+if __name__ == '__main__':
+    unittest.main()
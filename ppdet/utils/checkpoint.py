@@ -36,6 +36,7 @@ __all__ = [
     'load_and_fusebn',
     'load_params',
     'save',
+    'copy_model',
 ]
 
 
@@ -200,6 +201,19 @@ def save(exe, prog, path):
     fluid.save(prog, path)
 
 
+def copy_model(src, dst):
+    """
+    Copy the model saved by save from src to dst.
+    Args:
+        src (string): the path the model is saved to.
+        dst (string): the path to copy model to.
+    """
+    logger.info('Copy model from {} to {}.'.format(src, dst))
+    for ext in ['.pdparams', '.pdopt', '.pdmodel']:
+        if os.path.exists(src + ext):
+            shutil.copyfile(src + ext, dst + ext)
+
+
 def load_and_fusebn(exe, prog, path):
     """
     Fuse params of batch norm to scale and bias.
@@ -19,7 +19,9 @@ from __future__ import unicode_literals
 
 import os
 import sys
+import copy
 import json
+import multiprocessing
 import cv2
 import numpy as np
 
@@ -31,9 +33,16 @@ __all__ = [
     'mask_eval',
     'bbox2out',
     'mask2out',
+    'bbox2array',
+    'bbox2out_array',
+    'mask2rle',
+    'segm2rle',
+    'rle2out_array',
+    'save_results',
     'get_category_info',
     'proposal_eval',
     'cocoapi_eval',
+    'parallel_evaluate',
 ]
 
 
@@ -47,19 +56,27 @@ def clip_bbox(bbox, im_size=None):
     return xmin, ymin, xmax, ymax
 
 
-def proposal_eval(results, anno_file, outfile, max_dets=(100, 300, 1000)):
-    assert 'proposal' in results[0]
-    assert outfile.endswith('.json')
+def proposal_eval(results,
+                  anno_file,
+                  outfile,
+                  max_dets=(100, 300, 1000),
+                  num_workers=0):
+    assert 'proposal' in results[0] or 'proposal_xywh' in results[0]
+    assert outfile.endswith('.json') or outfile.endswith('.npz')
 
-    xywh_results = proposal2out(results)
+    dets = proposal2out_array(results)
     assert len(
-        xywh_results) > 0, "The number of valid proposal detected is zero.\n \
+        dets) > 0, "The number of valid proposal detected is zero.\n \
         Please use reasonable model and check input data."
 
-    with open(outfile, 'w') as f:
-        json.dump(xywh_results, f)
+    save_results(outfile, dets)
 
-    cocoapi_eval(outfile, 'proposal', anno_file=anno_file, max_dets=max_dets)
+    cocoapi_eval(
+        dets,
+        'proposal',
+        anno_file=anno_file,
+        max_dets=max_dets,
+        num_workers=num_workers)
     # flush coco evaluation result
     sys.stdout.flush()
 
@@ -69,9 +86,10 @@ def bbox_eval(results,
               outfile,
               with_background=True,
               is_bbox_normalized=False,
-              save_only=False):
-    assert 'bbox' in results[0]
-    assert outfile.endswith('.json')
+              save_only=False,
+              num_workers=0):
+    assert 'bbox' in results[0] or 'bbox_xywh' in results[0]
+    assert outfile.endswith('.json') or outfile.endswith('.npz')
     from pycocotools.coco import COCO
 
     coco_gt = COCO(anno_file)
@@ -83,23 +101,23 @@ def bbox_eval(results,
         {i + int(with_background): catid
          for i, catid in enumerate(cat_ids)})
 
-    xywh_results = bbox2out(
+    dets = bbox2out_array(
         results, clsid2catid, is_bbox_normalized=is_bbox_normalized)
 
-    if len(xywh_results) == 0:
+    if len(dets) == 0:
         logger.warning("The number of valid bbox detected is zero.\n \
             Please use reasonable model and check input data.\n \
             stop eval!")
         return [0.0]
-    with open(outfile, 'w') as f:
-        json.dump(xywh_results, f)
+    save_results(outfile, dets)
 
     if save_only:
         logger.info('The bbox result is saved to {} and do not '
                     'evaluate the mAP.'.format(outfile))
         return
 
-    map_stats = cocoapi_eval(outfile, 'bbox', coco_gt=coco_gt)
+    map_stats = cocoapi_eval(
+        dets, 'bbox', coco_gt=coco_gt, num_workers=num_workers)
     # flush coco evaluation result
     sys.stdout.flush()
     return map_stats
@@ -110,107 +128,64 @@ def mask_eval(results,
               outfile,
               resolution,
               thresh_binarize=0.5,
-              save_only=False):
+              save_only=False,
+              num_workers=0):
     """
     Format the output of mask and get mask ap by coco api evaluation.
     It will be used in Mask-RCNN.
     """
-    assert 'mask' in results[0]
-    assert outfile.endswith('.json')
+    assert 'mask' in results[0] or 'mask_rle' in results[0]
+    assert outfile.endswith('.json') or outfile.endswith('.npz')
     from pycocotools.coco import COCO
 
     coco_gt = COCO(anno_file)
     clsid2catid = {i + 1: v for i, v in enumerate(coco_gt.getCatIds())}
 
-    segm_results = []
-    for t in results:
-        im_ids = np.array(t['im_id'][0])
-        bboxes = t['bbox'][0]
-        lengths = t['bbox'][1][0]
-        masks = t['mask']
-        if bboxes.shape == (1, 1) or bboxes is None:
-            continue
-        if len(bboxes.tolist()) == 0:
-            continue
-        s = 0
-        for i in range(len(lengths)):
-            num = lengths[i]
-            im_id = int(im_ids[i][0])
-            clsid_scores = bboxes[s:s + num][:, 0:2]
-            mask = masks[s:s + num]
-            s += num
-            for j in range(num):
-                clsid, score = clsid_scores[j].tolist()
-                catid = int(clsid2catid[clsid])
-                segm = mask[j]
-                segm['counts'] = segm['counts'].decode('utf8')
-                coco_res = {
-                    'image_id': im_id,
-                    'category_id': int(catid),
-                    'segmentation': segm,
-                    'score': score
-                }
-                segm_results.append(coco_res)
-
-    if len(segm_results) == 0:
+    segm_results = rle2out_array(results, clsid2catid, 'mask')
+
+    if len(segm_results[1]) == 0:
         logger.warning("The number of valid mask detected is zero.\n \
             Please use reasonable model and check input data.")
         return
 
-    with open(outfile, 'w') as f:
-        json.dump(segm_results, f)
+    save_results(outfile, segm_results)
 
     if save_only:
         logger.info('The mask result is saved to {} and do not '
                     'evaluate the mAP.'.format(outfile))
         return
 
-    cocoapi_eval(outfile, 'segm', coco_gt=coco_gt)
+    cocoapi_eval(
+        segm_results, 'segm', coco_gt=coco_gt, num_workers=num_workers)
 
 
-def segm_eval(results, anno_file, outfile, save_only=False):
+def segm_eval(results, anno_file, outfile, save_only=False, num_workers=0):
     """
     Format the output of segmentation, category_id and score in mask.josn, and
     get mask ap by coco api evaluation. It will be used in instance segmentation
     networks, such as: SOLOv2.
     """
-    assert 'segm' in results[0]
-    assert outfile.endswith('.json')
+    assert 'segm' in results[0] or 'segm_rle' in results[0]
+    assert outfile.endswith('.json') or outfile.endswith('.npz')
     from pycocotools.coco import COCO
     coco_gt = COCO(anno_file)
     clsid2catid = {i: v for i, v in enumerate(coco_gt.getCatIds())}
-    segm_results = []
-    for t in results:
-        im_id = int(t['im_id'][0][0])
-        segs = t['segm']
-        for mask in segs:
-            catid = int(clsid2catid[mask[0]])
-            masks = mask[1]
-            mask_score = masks[1]
-            segm = masks[0]
-            segm['counts'] = segm['counts'].decode('utf8')
-            coco_res = {
-                'image_id': im_id,
-                'category_id': catid,
-                'segmentation': segm,
-                'score': mask_score
-            }
-            segm_results.append(coco_res)
+    segm_results = rle2out_array(results, clsid2catid, 'segm')
 
-    if len(segm_results) == 0:
+    if len(segm_results[1]) == 0:
         logger.warning("The number of valid mask detected is zero.\n \
             Please use reasonable model and check input data.")
         return
 
-    with open(outfile, 'w') as f:
-        json.dump(segm_results, f)
+    save_results(outfile, segm_results)
 
     if save_only:
         logger.info('The mask result is saved to {} and do not '
                     'evaluate the mAP.'.format(outfile))
         return
 
-    map_stats = cocoapi_eval(outfile, 'segm', coco_gt=coco_gt)
+    map_stats = cocoapi_eval(
+        segm_results, 'segm', coco_gt=coco_gt, num_workers=num_workers)
     return map_stats
 
 
@@ -218,15 +193,23 @@ def cocoapi_eval(jsonfile,
                  style,
                  coco_gt=None,
                  anno_file=None,
-                 max_dets=(100, 300, 1000)):
+                 max_dets=(100, 300, 1000),
+                 num_workers=0):
     """
     Args:
-        jsonfile: Evaluation json file, eg: bbox.json, mask.json.
+        jsonfile: Evaluation json file, eg: bbox.json, mask.json, or the
+                  results themselves, as a list of COCO result dicts, a
+                  [N, 7] array of [image_id, category_id, x, y, w, h,
+                  score] rows, or a tuple of [N, 3] array of [image_id,
+                  category_id, score] rows and N RLEs for masks.
         style: COCOeval style, can be `bbox` , `segm` and `proposal`.
         coco_gt: Whether to load COCOAPI through anno_file,
                  eg: coco_gt = COCO(anno_file)
         anno_file: COCO annotations file.
         max_dets: COCO evaluation maxDets.
+        num_workers: number of processes for the per image evaluation,
+                 0 (default) or 1 to evaluate in the current process, -1
+                 for min(cpu count, 8), see parallel_evaluate.
     """
     assert coco_gt != None or anno_file != None
     from pycocotools.coco import COCO
@@ -235,6 +218,17 @@ def cocoapi_eval(jsonfile,
     if coco_gt == None:
         coco_gt = COCO(anno_file)
     logger.info("Start evaluate...")
+    if isinstance(jsonfile, np.ndarray):
+        # loadRes takes [image_id, x, y, w, h, score, category_id] rows
+        jsonfile = jsonfile[:, [0, 2, 3, 4, 5, 6, 1]]
+    elif isinstance(jsonfile, tuple):
+        info, segms = jsonfile
+        jsonfile = [{
+            'image_id': int(im_id),
+            'category_id': int(catid),
+            'segmentation': segm,
+            'score': score
+        } for (im_id, catid, score), segm in zip(info.tolist(), segms)]
     coco_dt = coco_gt.loadRes(jsonfile)
     if style == 'proposal':
         coco_eval = COCOeval(coco_gt, coco_dt, 'bbox')
@@ -242,49 +236,129 @@ def cocoapi_eval(jsonfile,
         coco_eval.params.maxDets = list(max_dets)
     else:
         coco_eval = COCOeval(coco_gt, coco_dt, style)
-    coco_eval.evaluate()
+    parallel_evaluate(coco_eval, num_workers)
     coco_eval.accumulate()
     coco_eval.summarize()
     return coco_eval.stats
 
 
+_eval_worker_state = None
+
+
+def _init_eval_worker(coco_gt, coco_dt, params):
+    global _eval_worker_state
+    _eval_worker_state = (coco_gt, coco_dt, params)
+    # every shard prints the COCOeval progress messages
+    sys.stdout = open(os.devnull, 'w')
+
+
+def _evaluate_shard(img_ids):
+    from pycocotools.cocoeval import COCOeval
+    coco_gt, coco_dt, params = _eval_worker_state
+    coco_eval = COCOeval(coco_gt, coco_dt, params.iouType)
+    coco_eval.params = copy.deepcopy(params)
+    coco_eval.params.imgIds = img_ids
+    coco_eval.evaluate()
+    return coco_eval.evalImgs
+
+
+def parallel_evaluate(coco_eval, num_workers=0):
+    """
+    Run COCOeval.evaluate with the images split into shards evaluated on
+    a process pool. The per image results are merged back in the order
+    COCOeval.evaluate gives, so accumulate and summarize get the same
+    stats.
+
+    The pool forks the calling process, which is only safe when no
+    threads (e.g. reader or device threads) are running in it, so the
+    pool is opt-in.
+
+    Args:
+        coco_eval (COCOeval): evaluator with its params set.
+        num_workers (int): number of processes, 0 (default) or 1 to run
+            COCOeval.evaluate in the current process, -1 for
+            min(cpu count, 8).
+    """
+    if num_workers < 0:
+        num_workers = min(multiprocessing.cpu_count(), 8)
+    p = coco_eval.params
+    img_ids = list(np.unique(p.imgIds))
+    if num_workers <= 1 or len(img_ids) < 2 * num_workers:
+        coco_eval.evaluate()
+        return
+
+    logger.info("Evaluating {} images with {} processes...".format(
+        len(img_ids), num_workers))
+    p.imgIds = img_ids
+    if p.useCats:
+        p.catIds = list(np.unique(p.catIds))
+    p.maxDets = sorted(p.maxDets)
+    num_cats = len(p.catIds) if p.useCats else 1
+    num_areas = len(p.areaRng)
+
+    # several contiguous shards per process to balance the load
+    shards = [
+        shard.tolist()
+        for shard in np.array_split(np.array(img_ids), num_workers * 4)
+    ]
+    pool = multiprocessing.Pool(
+        num_workers,
+        initializer=_init_eval_worker,
+        initargs=(coco_eval.cocoGt, coco_eval.cocoDt, p))
+    try:
+        shard_evals = pool.map(_evaluate_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+
+    # each shard is ordered by category, area range, then image
+    eval_imgs = []
+    for k in range(num_cats):
+        for a in range(num_areas):
+            for shard, evals in zip(shards, shard_evals):
+                start = (k * num_areas + a) * len(shard)
+                eval_imgs.extend(evals[start:start + len(shard)])
+    coco_eval.evalImgs = eval_imgs
+    coco_eval._paramsEval = copy.deepcopy(p)
+
+
+def proposal2out_array(results, is_bbox_normalized=False):
+    """
+    Convert proposal results to a float64 array of [image_id, 1, x, y,
+    w, h, 1.] rows, see bbox2out_array.
+    """
+    dets = [
+        t['proposal_xywh'] if 'proposal_xywh' in t else proposal2array(
+            t, is_bbox_normalized) for t in results
+    ]
+    return np.concatenate(dets + [np.zeros((0, 7))])
+
+
 def proposal2out(results, is_bbox_normalized=False):
-    xywh_res = []
-    for t in results:
-        bboxes = t['proposal'][0]
-        lengths = t['proposal'][1][0]
-        im_ids = np.array(t['im_id'][0]).flatten()
-        assert len(lengths) == im_ids.size
-        if bboxes.shape == (1, 1) or bboxes is None:
-            continue
+    return _xywh2out(proposal2out_array(results, is_bbox_normalized))
 
-        k = 0
-        for i in range(len(lengths)):
-            num = lengths[i]
-            im_id = int(im_ids[i])
-            for j in range(num):
-                dt = bboxes[k]
-                xmin, ymin, xmax, ymax = dt.tolist()
-
-                if is_bbox_normalized:
-                    xmin, ymin, xmax, ymax = \
-                            clip_bbox([xmin, ymin, xmax, ymax])
-                    w = xmax - xmin
-                    h = ymax - ymin
-                else:
-                    w = xmax - xmin + 1
-                    h = ymax - ymin + 1
-
-                bbox = [xmin, ymin, w, h]
-                coco_res = {
-                    'image_id': im_id,
-                    'category_id': 1,
-                    'bbox': bbox,
-                    'score': 1.0
-                }
-                xywh_res.append(coco_res)
-                k += 1
-    return xywh_res
+
+def bbox2out_array(results, clsid2catid, is_bbox_normalized=False):
+    """
+    Convert bbox results to a float64 array of [image_id, category_id, x,
+    y, w, h, score] rows, the array form of bbox2out.
+
+    Args:
+        results: request a dict, should include: `bbox`, `im_id`,
+                 if is_bbox_normalized=True, also need `im_shape`.
+                 Results already converted by bbox2array are given
+                 as `bbox_xywh`.
+        clsid2catid: class id to category id map of COCO2017 dataset.
+        is_bbox_normalized: whether or not bbox is normalized.
+    """
+    dets = [
+        t['bbox_xywh'] if 'bbox_xywh' in t else bbox2array(
+            t, is_bbox_normalized) for t in results
+    ]
+    dets = np.concatenate(dets + [np.zeros((0, 7))])
+    dets[:, 1] = np.take(
+        _catid_table(clsid2catid), dets[:, 1].astype(np.int64))
+    return dets
 
 
 def bbox2out(results, clsid2catid, is_bbox_normalized=False):
@@ -295,61 +369,237 @@ def bbox2out(results, clsid2catid, is_bbox_normalized=False):
         clsid2catid: class id to category id map of COCO2017 dataset.
         is_bbox_normalized: whether or not bbox is normalized.
     """
-    xywh_res = []
+    return _xywh2out(
+        bbox2out_array(results, clsid2catid, is_bbox_normalized))
+
+
+def _xywh2out(dets):
+    return [{
+        'image_id': int(im_id),
+        'category_id': int(catid),
+        'bbox': [xmin, ymin, w, h],
+        'score': score
+    } for im_id, catid, xmin, ymin, w, h, score in dets.tolist()]
+
+
+def _catid_table(clsid2catid):
+    # class id to category id lookup table for np.take
+    table = np.full(max(clsid2catid) + 1, -1, dtype=np.int64)
+    for clsid, catid in clsid2catid.items():
+        table[clsid] = catid
+    return table
+
+
+def rle2out_array(results, clsid2catid, style='mask'):
+    """
+    Collect the mask results of Mask R-CNN (style `mask`) or SOLOv2
+    (style `segm`).
+
+    Returns:
+        (info, segms): float64 rows of [image_id, category_id, score]
+            and the RLE of each row, with str counts.
+    """
+    key, convert = ('mask_rle', mask2rle) if style == 'mask' else \
+        ('segm_rle', segm2rle)
+    infos = [np.zeros((0, 3))]
+    segms = []
     for t in results:
-        bboxes = t['bbox'][0]
-        if len(t['bbox'][1]) == 0: continue
-        lengths = t['bbox'][1][0]
-        im_ids = np.array(t['im_id'][0]).flatten()
-        if bboxes.shape == (1, 1) or bboxes is None or len(bboxes) == 0:
-            continue
+        info, rles = t[key] if key in t else convert(t)
+        infos.append(info)
+        segms.extend(rles)
+    info = np.concatenate(infos)
+    info[:, 1] = np.take(
+        _catid_table(clsid2catid), info[:, 1].astype(np.int64))
+    for segm in segms:
+        if isinstance(segm['counts'], bytes):
+            segm['counts'] = segm['counts'].decode('utf8')
+    return info, segms
 
-        k = 0
-        for i in range(len(lengths)):
-            num = lengths[i]
-            im_id = int(im_ids[i])
-            for j in range(num):
-                dt = bboxes[k]
-                clsid, score, xmin, ymin, xmax, ymax = dt.tolist()
-                if clsid < 0: continue
-                catid = (clsid2catid[int(clsid)])
-
-                if is_bbox_normalized:
-                    xmin, ymin, xmax, ymax = \
-                            clip_bbox([xmin, ymin, xmax, ymax])
-                    w = xmax - xmin
-                    h = ymax - ymin
-                    im_shape = t['im_shape'][0][i].tolist()
-                    im_height, im_width = int(im_shape[0]), int(im_shape[1])
-                    xmin *= im_width
-                    ymin *= im_height
-                    w *= im_width
-                    h *= im_height
-                else:
-                    # for yolov4
-                    # w = xmax - xmin
-                    # h = ymax - ymin
-                    w = xmax - xmin + 1
-                    h = ymax - ymin + 1
-
-                bbox = [xmin, ymin, w, h]
-                coco_res = {
-                    'image_id': im_id,
-                    'category_id': catid,
-                    'bbox': bbox,
-                    'score': score
-                }
-                xywh_res.append(coco_res)
-                k += 1
-    return xywh_res
+
+def _json_float(x):
+    # as json.dump writes a float, which allows NaN and Infinity
+    if x != x:
+        return 'NaN'
+    if x == float('inf'):
+        return 'Infinity'
+    if x == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(x)
+
+
+def save_results(outfile, results, chunk_size=10000):
+    """
+    Save COCO results to a `.npz` file of the arrays, or write them to a
+    COCO result `.json` file chunk by chunk, without a dict per result.
+
+    Args:
+        outfile (str): result file path, ends with `.json` or `.npz`.
+        results: [N, 7] array of bbox results, see bbox2out_array, or the
+            (info, segms) tuple of mask results, see rle2out_array.
+        chunk_size (int): number of results formatted per write.
+    """
+    if outfile.endswith('.npz'):
+        if isinstance(results, tuple):
+            info, segms = results
+            np.savez_compressed(
+                outfile,
+                segm_info=info,
+                segm_size=np.array(
+                    [segm['size'] for segm in segms],
+                    dtype=np.int64).reshape(-1, 2),
+                segm_counts=np.array([segm['counts'] for segm in segms]))
+        else:
+            np.savez_compressed(outfile, bbox=results)
+        return
+
+    # the same text json.dump gives for the list of result dicts
+    if isinstance(results, tuple):
+        info, segms = results
+        rows = info.tolist()
+        fmt = '{{"image_id": {}, "category_id": {}, "segmentation": ' \
+              '{{"size": [{}, {}], "counts": {}}}, "score": {}}}'
+
+        def format_row(i):
+            im_id, catid, score = rows[i]
+            segm = segms[i]
+            return fmt.format(
+                int(im_id),
+                int(catid), segm['size'][0], segm['size'][1],
+                json.dumps(segm['counts']), _json_float(score))
+    else:
+        rows = results.tolist()
+        fmt = '{{"image_id": {}, "category_id": {}, "bbox": ' \
+              '[{}, {}, {}, {}], "score": {}}}'
+
+        def format_row(i):
+            im_id, catid, xmin, ymin, w, h, score = rows[i]
+            return fmt.format(
+                int(im_id),
+                int(catid), *map(_json_float, (xmin, ymin, w, h, score)))
+
+    with open(outfile, 'w') as f:
+        f.write('[')
+        for start in range(0, len(rows), chunk_size):
+            if start > 0:
+                f.write(', ')
+            f.write(', '.join(
+                format_row(i)
+                for i in range(start, min(start + chunk_size, len(rows)))))
+        f.write(']')
+
+
+def _xyxy2xywh(dets, lengths, im_shapes, is_bbox_normalized):
+    # same float64 arithmetic as the per box python code did on dt.tolist()
+    xmin, ymin, xmax, ymax = [dets[:, i] for i in range(4)]
+    if is_bbox_normalized:
+        xmin, ymin, xmax, ymax = [
+            np.clip(v, 0., 1.) for v in (xmin, ymin, xmax, ymax)
+        ]
+        w = xmax - xmin
+        h = ymax - ymin
+        if im_shapes is not None:
+            im_shapes = np.repeat(
+                np.asarray(im_shapes)[:len(lengths), :2], lengths, axis=0)
+            im_height = im_shapes[:, 0].astype(np.int64)
+            im_width = im_shapes[:, 1].astype(np.int64)
+            xmin = xmin * im_width
+            ymin = ymin * im_height
+            w = w * im_width
+            h = h * im_height
+    else:
+        # for yolov4
+        # w = xmax - xmin
+        # h = ymax - ymin
+        w = xmax - xmin + 1
+        h = ymax - ymin + 1
+    return np.stack([xmin, ymin, w, h], axis=1)
+
+
+def bbox2array(t, is_bbox_normalized=False):
+    """
+    Convert the bbox output of one batch to compact COCO results.
+
+    Args:
+        t (dict): batch result, should include `bbox` and `im_id`,
+            if is_bbox_normalized=True, also need `im_shape`.
+        is_bbox_normalized (bool): whether or not bbox is normalized.
+
+    Returns:
+        dets (np.ndarray): float64 rows of [image_id, class_id, x, y,
+            w, h, score], detections of negative class are dropped.
+    """
+    bboxes = t['bbox'][0]
+    if bboxes is None or bboxes.shape == (1, 1) or len(bboxes) == 0 or \
+            len(t['bbox'][1]) == 0:
+        return np.zeros((0, 7))
+    lengths = np.asarray(t['bbox'][1][0], dtype=np.int64)
+    im_ids = np.array(t['im_id'][0]).flatten()
+    dets = bboxes[:lengths.sum()].astype(np.float64)
+    im_ids = np.repeat(im_ids[:len(lengths)].astype(np.float64), lengths)
+    im_shapes = t['im_shape'][0] if is_bbox_normalized else None
+    xywh = _xyxy2xywh(dets[:, 2:6], lengths, im_shapes, is_bbox_normalized)
+    out = np.concatenate(
+        [im_ids[:, None], dets[:, :1], xywh, dets[:, 1:2]], axis=1)
+    return out[dets[:, 0] >= 0]
+
+
+def proposal2array(t, is_bbox_normalized=False):
+    """
+    Convert the proposal output of one batch to compact COCO results,
+    rows of [image_id, 1, x, y, w, h, 1.].
+    """
+    bboxes = t['proposal'][0]
+    if bboxes is None or bboxes.shape == (1, 1):
+        return np.zeros((0, 7))
+    lengths = np.asarray(t['proposal'][1][0], dtype=np.int64)
+    im_ids = np.array(t['im_id'][0]).flatten()
+    assert len(lengths) == im_ids.size
+    dets = bboxes[:lengths.sum()].astype(np.float64)
+    im_ids = np.repeat(im_ids.astype(np.float64), lengths)
+    xywh = _xyxy2xywh(dets, lengths, None, is_bbox_normalized)
+    ones = np.ones((len(dets), 1))
+    return np.concatenate([im_ids[:, None], ones, xywh, ones], axis=1)
+
+
+def mask2rle(t):
+    """
+    Collect the RLEs mask_encode made for one batch with their image id,
+    class id and score.
+
+    Returns:
+        (info, segms): float64 rows of [image_id, class_id, score] and
+            the RLE of each row.
+    """
+    bboxes = t['bbox'][0]
+    if bboxes is None or bboxes.shape == (1, 1) or len(bboxes) == 0:
+        return np.zeros((0, 3)), []
+    lengths = np.asarray(t['bbox'][1][0], dtype=np.int64)
+    im_ids = np.array(t['im_id'][0]).flatten()
+    im_ids = np.repeat(im_ids[:len(lengths)].astype(np.float64), lengths)
+    clsid_scores = bboxes[:len(im_ids), 0:2].astype(np.float64)
+    info = np.concatenate([im_ids[:, None], clsid_scores], axis=1)
+    return info, list(t['mask'][:len(im_ids)])
+
+
+def segm2rle(t):
+    """
+    Collect the RLEs get_masks made for one image with the image id,
+    class id and score, see mask2rle.
+    """
+    im_id = int(t['im_id'][0][0])
+    segms = [mask[1][0] for mask in t['segm']]
+    info = np.array(
+        [[im_id, mask[0], mask[1][1]] for mask in t['segm']],
+        dtype=np.float64).reshape(-1, 3)
+    return info, segms
 
 
 def mask2out(results, clsid2catid, resolution, thresh_binarize=0.5):
-    import pycocotools.mask as mask_util
+    from ppdet.utils.post_process import map_images, paste_mask_rles
     scale = (resolution + 2.0) / resolution
 
-    segm_res = []
-
+    args = []
+    dets = []
     # for each batch
     for t in results:
         bboxes = t['bbox'][0]
@@ -372,7 +622,8 @@ def mask2out(results, clsid2catid, resolution, thresh_binarize=0.5):
 
             bbox = bboxes[s:s + num][:, 2:]
             clsid_scores = bboxes[s:s + num][:, 0:2]
-            mask = masks[s:s + num]
+            clsids = clsid_scores[:, 0].astype(np.int32)
+            mask = masks[s:s + num][np.arange(num), clsids]
             s += num
 
             im_h = int(im_shape[0])
@@ -380,76 +631,48 @@ def mask2out(results, clsid2catid, resolution, thresh_binarize=0.5):
 
             expand_bbox = expand_boxes(bbox, scale)
             expand_bbox = expand_bbox.astype(np.int32)
+            args.append((expand_bbox, mask, im_h, im_w, thresh_binarize))
+            dets.append((im_id, clsid_scores))
 
-            padded_mask = np.zeros(
-                (resolution + 2, resolution + 2), dtype=np.float32)
-
-            for j in range(num):
-                xmin, ymin, xmax, ymax = expand_bbox[j].tolist()
-                clsid, score = clsid_scores[j].tolist()
-                clsid = int(clsid)
-                padded_mask[1:-1, 1:-1] = mask[j, clsid, :, :]
-
-                catid = clsid2catid[clsid]
-
-                w = xmax - xmin + 1
-                h = ymax - ymin + 1
-                w = np.maximum(w, 1)
-                h = np.maximum(h, 1)
-
-                resized_mask = cv2.resize(padded_mask, (w, h))
-                resized_mask = np.array(
-                    resized_mask > thresh_binarize, dtype=np.uint8)
-                im_mask = np.zeros((im_h, im_w), dtype=np.uint8)
-
-                x0 = min(max(xmin, 0), im_w)
-                x1 = min(max(xmax + 1, 0), im_w)
-                y0 = min(max(ymin, 0), im_h)
-                y1 = min(max(ymax + 1, 0), im_h)
-
-                im_mask[y0:y1, x0:x1] = resized_mask[(y0 - ymin):(y1 - ymin), (
-                    x0 - xmin):(x1 - xmin)]
-                segm = mask_util.encode(
-                    np.array(
-                        im_mask[:, :, np.newaxis], order='F'))[0]
-                catid = clsid2catid[clsid]
-                segm['counts'] = segm['counts'].decode('utf8')
-                coco_res = {
-                    'image_id': im_id,
-                    'category_id': catid,
-                    'segmentation': segm,
-                    'score': score
-                }
-                segm_res.append(coco_res)
+    segm_res = []
+    for (im_id, clsid_scores), segms in zip(dets,
+                                            map_images(paste_mask_rles, args)):
+        for j, segm in enumerate(segms):
+            clsid, score = clsid_scores[j].tolist()
+            catid = clsid2catid[int(clsid)]
+            segm['counts'] = segm['counts'].decode('utf8')
+            coco_res = {
+                'image_id': im_id,
+                'category_id': catid,
+                'segmentation': segm,
+                'score': score
+            }
+            segm_res.append(coco_res)
     return segm_res
 
 
 def segm2out(results, clsid2catid, thresh_binarize=0.5):
     import pycocotools.mask as mask_util
+    catid_table = _catid_table(clsid2catid)
     segm_res = []
 
     # for each batch
     for t in results:
         segms = t['segm'][0].astype(np.uint8)
-        clsid_labels = t['cate_label'][0]
-        clsid_scores = t['cate_score'][0]
         lengths = segms.shape[0]
-        im_id = int(t['im_id'][0][0])
-        im_shape = t['im_shape'][0][0]
         if lengths == 0 or segms is None:
             continue
-        # for each sample
-        for i in range(lengths - 1):
-            im_h = int(im_shape[0])
-            im_w = int(im_shape[1])
-
-            clsid = int(clsid_labels[i]) + 1
-            catid = clsid2catid[clsid]
-            score = clsid_scores[i]
-            mask = segms[i]
-            segm = mask_util.encode(
-                np.array(
-                    mask[:, :, np.newaxis], order='F'))[0]
+        im_id = int(t['im_id'][0][0])
+        # the last mask is left out, same as get_masks does
+        num = lengths - 1
+        if num == 0:
+            continue
+        rles = mask_util.encode(
+            np.asfortranarray(segms[:num].transpose(1, 2, 0)))
+        catids = np.take(catid_table,
+                         t['cate_label'][0][:num].astype(np.int64) + 1)
+        scores = t['cate_score'][0][:num]
+        for segm, catid, score in zip(rles, catids.tolist(), scores):
             segm['counts'] = segm['counts'].decode('utf8')
             coco_res = {
                 'image_id': im_id,
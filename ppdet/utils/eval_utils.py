@@ -16,17 +16,28 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import logging
 import numpy as np
 import os
+import subprocess
+import sys
 import time
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 import paddle.fluid as fluid
 
 from .voc_eval import bbox_eval as voc_bbox_eval
 from .post_process import mstest_box_post_process, mstest_mask_post_process, box_flip
 
-__all__ = ['parse_fetches', 'eval_run', 'eval_results', 'json_eval_results']
+__all__ = [
+    'parse_fetches', 'eval_run', 'eval_results', 'json_eval_results',
+    'COCOResultCollector', 'AsyncEvaluator'
+]
 
 logger = logging.getLogger(__name__)
 
@@ -113,6 +124,86 @@ def get_masks(result):
     return masks
 
 
+class COCOResultCollector(object):
+    """
+    Convert each fetched eval batch to compact COCO results on a
+    background thread, so that the raw outputs of a batch can be dropped
+    as soon as it is fetched instead of being kept for the whole eval.
+
+    Boxes and proposals are kept as [image_id, class_id, x, y, w, h,
+    score] float64 arrays, see coco_eval.bbox2array, and masks as RLEs
+    with [image_id, class_id, score] rows, see coco_eval.mask2rle.
+
+    Args:
+        is_bbox_normalized (bool): whether or not bbox is normalized.
+        resolution (int): mask resolution of Mask R-CNN.
+        max_pending (int): max number of fetched batches waiting for
+            conversion, put blocks when the worker falls behind.
+    """
+
+    def __init__(self, is_bbox_normalized=False, resolution=None,
+                 max_pending=8):
+        self.is_bbox_normalized = is_bbox_normalized
+        self.resolution = resolution
+        self.results = []
+        self._error = None
+        self._queue = Queue(max_pending)
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, res):
+        """
+        Hand a fetched batch over to the conversion worker
+        """
+        self._queue.put(res)
+
+    def close(self):
+        """
+        Wait for the pending batches and return the converted results
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.results
+
+    def _work(self):
+        while True:
+            res = self._queue.get()
+            if res is None:
+                break
+            # keep draining the queue after a failure so put never blocks
+            if self._error is not None:
+                continue
+            try:
+                self.results.append(self.convert(res))
+            except Exception as e:
+                logger.error("Converting eval results failed: {}".format(e))
+                self._error = e
+
+    def convert(self, res):
+        """
+        Convert the fetched outputs of one batch
+        """
+        from ppdet.utils.coco_eval import (bbox2array, proposal2array,
+                                           mask2rle, segm2rle)
+        out = {}
+        if 'bbox' in res:
+            out['bbox_xywh'] = bbox2array(res, self.is_bbox_normalized)
+        if 'proposal' in res:
+            out['proposal_xywh'] = proposal2array(res,
+                                                  self.is_bbox_normalized)
+        if 'mask' in res:
+            from ppdet.utils.post_process import mask_encode
+            res['mask'] = mask_encode(res, self.resolution)
+            out['mask_rle'] = mask2rle(res)
+        if 'segm' in res:
+            res['segm'] = get_masks(res)
+            out['segm_rle'] = segm2rle(res)
+        return out
+
+
 def eval_run(exe,
              compile_program,
              loader,
@@ -123,9 +214,12 @@ def eval_run(exe,
              sub_prog=None,
              sub_keys=None,
              sub_values=None,
-             resolution=None):
+             resolution=None,
+             collector=None):
     """
-    Run evaluation program, return program outputs.
+    Run evaluation program, return program outputs. If a
+    COCOResultCollector is given, each batch is handed over to it once
+    fetched and its compact results are returned instead.
     """
     iter_id = 0
     results = []
@@ -168,12 +262,13 @@ def eval_run(exe,
                     k: (np.array(v), v.recursive_sequence_lengths())
                     for k, v in zip(sub_keys, sub_prog_outs)
                 }
-                post_res = mstest_mask_post_process(sub_prog_res, cfg)
+                post_res = mstest_mask_post_process(sub_prog_res, cfg,
+                                                    res['bbox'][1][0])
                 res.update(post_res)
             if multi_scale_test:
                 res = clean_res(
                     res, ['im_info', 'bbox', 'im_id', 'im_shape', 'mask'])
-            if 'mask' in res:
+            if 'mask' in res and collector is None:
                 from ppdet.utils.post_process import mask_encode
                 res['mask'] = mask_encode(res, resolution)
             post_config = getattr(cfg, 'PostProcess', None)
@@ -182,18 +277,24 @@ def eval_run(exe,
                 corner_post_process(res, post_config, cfg.num_classes)
             if 'TTFNet' in cfg.architecture:
                 res['bbox'][1].append([len(res['bbox'][0])])
-            if 'segm' in res:
-                res['segm'] = get_masks(res)
-            results.append(res)
-            if iter_id % 100 == 0:
-                logger.info('Test iter {}'.format(iter_id))
-            iter_id += 1
             if 'bbox' not in res or len(res['bbox'][1]) == 0:
                 has_bbox = False
             images_num += len(res['bbox'][1][0]) if has_bbox else 1
+            if collector is not None:
+                collector.put(res)
+                res = None
+            else:
+                if 'segm' in res:
+                    res['segm'] = get_masks(res)
+                results.append(res)
+            if iter_id % 100 == 0:
+                logger.info('Test iter {}'.format(iter_id))
+            iter_id += 1
     except (StopIteration, fluid.core.EOFException):
         loader.reset()
     logger.info('Test finish iter {}'.format(iter_id))
+    if collector is not None:
+        results = collector.close()
 
     end_time = time.time()
     fps = images_num / (end_time - start_time)
@@ -207,6 +308,12 @@ def eval_run(exe,
     return results
 
 
+def _has_result(results, name):
+    # raw outputs or compact results of COCOResultCollector
+    return name in results[0] or name + '_xywh' in results[0] or \
+        name + '_rle' in results[0]
+
+
 def eval_results(results,
                  metric,
                  num_classes,
@@ -215,22 +322,30 @@ def eval_results(results,
                  output_directory=None,
                  map_type='11point',
                  dataset=None,
-                 save_only=False):
+                 save_only=False,
+                 overlap_thresh=0.5,
+                 num_workers=0,
+                 classwise=False,
+                 result_format='json'):
     """Evaluation for evaluation program results"""
     box_ap_stats = []
     if metric == 'COCO':
+        # COCO results are saved to e.g. bbox.json, or bbox.npz of arrays
+        assert result_format in ['json', 'npz'], \
+            "unknown result format {}".format(result_format)
         from ppdet.utils.coco_eval import proposal_eval, bbox_eval, mask_eval, segm_eval
         anno_file = dataset.get_anno()
         with_background = dataset.with_background
-        if 'proposal' in results[0]:
-            output = 'proposal.json'
+        if _has_result(results, 'proposal'):
+            output = 'proposal.' + result_format
             if output_directory:
-                output = os.path.join(output_directory, 'proposal.json')
-            proposal_eval(results, anno_file, output)
-        if 'bbox' in results[0]:
-            output = 'bbox.json'
+                output = os.path.join(output_directory, output)
+            proposal_eval(
+                results, anno_file, output, num_workers=num_workers)
+        if _has_result(results, 'bbox'):
+            output = 'bbox.' + result_format
             if output_directory:
-                output = os.path.join(output_directory, 'bbox.json')
+                output = os.path.join(output_directory, output)
 
             box_ap_stats = bbox_eval(
                 results,
@@ -238,20 +353,30 @@ def eval_results(results,
                 output,
                 with_background,
                 is_bbox_normalized=is_bbox_normalized,
-                save_only=save_only)
+                save_only=save_only,
+                num_workers=num_workers)
 
-        if 'mask' in results[0]:
-            output = 'mask.json'
+        if _has_result(results, 'mask'):
+            output = 'mask.' + result_format
             if output_directory:
-                output = os.path.join(output_directory, 'mask.json')
+                output = os.path.join(output_directory, output)
             mask_eval(
-                results, anno_file, output, resolution, save_only=save_only)
-        if 'segm' in results[0]:
-            output = 'segm.json'
+                results,
+                anno_file,
+                output,
+                resolution,
+                save_only=save_only,
+                num_workers=num_workers)
+        if _has_result(results, 'segm'):
+            output = 'segm.' + result_format
             if output_directory:
                 output = os.path.join(output_directory, output)
             mask_ap_stats = segm_eval(
-                results, anno_file, output, save_only=save_only)
+                results,
+                anno_file,
+                output,
+                save_only=save_only,
+                num_workers=num_workers)
             if len(box_ap_stats) == 0:
                 box_ap_stats = mask_ap_stats
     else:
@@ -263,13 +388,136 @@ def eval_results(results,
             box_ap = voc_bbox_eval(
                 results,
                 num_classes,
+                overlap_thresh=overlap_thresh,
                 is_bbox_normalized=is_bbox_normalized,
-                map_type=map_type)
-            box_ap_stats.append(box_ap)
+                map_type=map_type,
+                classwise=classwise)
+            if isinstance(box_ap, list):
+                box_ap_stats.extend(box_ap)
+            else:
+                box_ap_stats.append(box_ap)
     return box_ap_stats
 
 
-def json_eval_results(metric, json_directory=None, dataset=None):
+class AsyncEvaluator(object):
+    """
+    Evaluate saved snapshots in separate local processes running
+    tools/eval.py, so that training goes on while a snapshot is evaluated.
+    The eval outputs and log of a snapshot are written to a sub directory
+    of output_dir named after it.
+
+    Args:
+        eval_script (str): path of tools/eval.py.
+        config (str): config file of the training job.
+        opts (dict): config options set by -o in training, which are
+            passed on to the eval process.
+        output_dir (str): directory of the eval outputs.
+        device (str): 'cpu', or the GPU id to evaluate on, e.g. '1'. Like
+            the device ids of the training job, it indexes the devices in
+            CUDA_VISIBLE_DEVICES when that is set.
+    """
+
+    def __init__(self, eval_script, config, opts=None, output_dir='.',
+                 device='cpu'):
+        self.eval_script = eval_script
+        self.config = config
+        self.opts = opts or {}
+        self.output_dir = output_dir
+        self.device = self._visible_device(str(device).strip().lower())
+        # [iter, weights, stats file, process], in submitting order
+        self.pending = []
+
+    def _visible_device(self, device):
+        """
+        Map a GPU id of this process to the one of the machine, as the eval
+        process gets it in CUDA_VISIBLE_DEVICES, '' for CPU.
+        """
+        if device == 'cpu':
+            return ''
+        assert device.isdigit(), \
+            "async eval device should be 'cpu' or a GPU id, got {}".format(
+                device)
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        if visible is None:
+            return device
+        visible = [d.strip() for d in visible.split(',') if d.strip()]
+        assert int(device) < len(visible), \
+            "async eval device {} is not in CUDA_VISIBLE_DEVICES={}".format(
+                device, ','.join(visible))
+        return visible[int(device)]
+
+    def _eval_opts(self, weights):
+        opts = dict(self.opts)
+        opts['weights'] = weights
+        opts['use_gpu'] = bool(self.device)
+        opts['use_xpu'] = False
+        # json is valid yaml, which ArgsParser loads the values with
+        return ['{}={}'.format(k, json.dumps(v)) for k, v in opts.items()]
+
+    def submit(self, it, weights):
+        """
+        Start evaluating the snapshot saved to weights in iteration it
+        """
+        output = os.path.join(self.output_dir,
+                              'eval_' + os.path.basename(weights))
+        if not os.path.exists(output):
+            os.makedirs(output)
+        stats_file = os.path.join(output, 'stats.json')
+        if os.path.exists(stats_file):
+            os.remove(stats_file)
+        cmd = [sys.executable, self.eval_script, '-c', self.config, '-o'] \
+            + self._eval_opts(weights) \
+            + ['-f', output, '--stats_file', stats_file]
+        env = dict(os.environ)
+        env['CUDA_VISIBLE_DEVICES'] = self.device
+        if not self.device:
+            env['CPU_NUM'] = '1'
+        with open(os.path.join(output, 'eval.log'), 'w') as log:
+            proc = subprocess.Popen(
+                cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        logger.info("Evaluating {} in process {}, see {}".format(
+            weights, proc.pid, output))
+        self.pending.append([it, weights, stats_file, proc])
+
+    def poll(self):
+        """
+        Return [iter, weights, box_ap_stats] of the finished evaluations
+        """
+        finished = []
+        pending = []
+        for it, weights, stats_file, proc in self.pending:
+            ret = proc.poll()
+            if ret is None:
+                pending.append([it, weights, stats_file, proc])
+            elif ret != 0 or not os.path.exists(stats_file):
+                logger.error("Evaluating {} failed with exit code {}, see "
+                             "{}".format(weights, ret,
+                                         os.path.dirname(stats_file)))
+            else:
+                with open(stats_file) as f:
+                    box_ap_stats = json.load(f)['box_ap_stats']
+                finished.append([it, weights, box_ap_stats])
+        self.pending = pending
+        return finished
+
+    def wait(self, max_pending=0):
+        """
+        Block until at most max_pending evaluations are running, and
+        return the finished ones as poll does
+        """
+        finished = self.poll()
+        while len(self.pending) > max_pending:
+            logger.info("Waiting for the evaluation of {}".format(
+                self.pending[0][1]))
+            self.pending[0][-1].wait()
+            finished.extend(self.poll())
+        return finished
+
+
+def json_eval_results(metric,
+                      json_directory=None,
+                      dataset=None,
+                      num_workers=0):
     """
     cocoapi eval with already exists proposal.json, bbox.json or mask.json
     """
@@ -287,6 +535,10 @@ def json_eval_results(metric, json_directory=None, dataset=None):
     coco_eval_style = ['proposal', 'bbox', 'segm']
     for i, v_json in enumerate(json_file_list):
         if os.path.exists(v_json):
-            cocoapi_eval(v_json, coco_eval_style[i], anno_file=anno_file)
+            cocoapi_eval(
+                v_json,
+                coco_eval_style[i],
+                anno_file=anno_file,
+                num_workers=num_workers)
         else:
             logger.info("{} not exists!".format(v_json))
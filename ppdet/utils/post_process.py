@@ -17,17 +17,28 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
+import multiprocessing
 import numpy as np
 import cv2
 import paddle.fluid as fluid
 
-__all__ = ['nms']
+__all__ = [
+    'nms', 'multiclass_nms', 'soft_nms', 'multiclass_soft_nms', 'nms_clusters'
+]
 
 logger = logging.getLogger(__name__)
 
 
-def box_flip(boxes, im_shape):
-    im_width = im_shape[0][1]
+def box_flip(boxes, im_shape, lengths=None):
+    """
+    Flip boxes horizontally. With lengths, the number of boxes of every
+    image, each image is flipped with its own width, otherwise all boxes
+    belong to the first image.
+    """
+    if lengths is None:
+        im_width = im_shape[0][1]
+    else:
+        im_width = np.repeat(im_shape[:, 1], lengths)[:, np.newaxis]
     flipped_boxes = boxes.copy()
 
     flipped_boxes[:, 0::4] = im_width - boxes[:, 2::4] - 1
@@ -48,80 +59,127 @@ def nms(dets, thresh):
     areas = (x2 - x1 + 1) * (y2 - y1 + 1)
     order = scores.argsort()[::-1]
 
-    ndets = dets.shape[0]
-    suppressed = np.zeros((ndets), dtype=np.int)
-
-    # nominal indices
-    # _i, _j
-    # sorted indices
-    # i, j
-    # temp variables for box i's (the box currently under consideration)
-    # ix1, iy1, ix2, iy2, iarea
-
-    # variables for computing overlap with box j (lower scoring box)
-    # xx1, yy1, xx2, yy2
-    # w, h
-    # inter, ovr
-
-    for _i in range(ndets):
-        i = order[_i]
-        if suppressed[i] == 1:
-            continue
-        ix1 = x1[i]
-        iy1 = y1[i]
-        ix2 = x2[i]
-        iy2 = y2[i]
-        iarea = areas[i]
-        for _j in range(_i + 1, ndets):
-            j = order[_j]
-            if suppressed[j] == 1:
-                continue
-            xx1 = max(ix1, x1[j])
-            yy1 = max(iy1, y1[j])
-            xx2 = min(ix2, x2[j])
-            yy2 = min(iy2, y2[j])
-            w = max(0.0, xx2 - xx1 + 1)
-            h = max(0.0, yy2 - yy1 + 1)
-            inter = w * h
-            ovr = inter / (iarea + areas[j] - inter)
-            if ovr >= thresh:
-                suppressed[j] = 1
-    keep = np.where(suppressed == 0)[0]
+    # Keep the best remaining box and drop every remaining box overlapping
+    # it in one step. Widths and heights are taken to float64 after the
+    # float32 subtraction, as scalar numpy arithmetic does, so the overlaps
+    # and the kept boxes are exactly those of the pairwise loop.
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        order = order[1:]
+        xx1 = np.maximum(x1[i], x1[order])
+        yy1 = np.maximum(y1[i], y1[order])
+        xx2 = np.minimum(x2[i], x2[order])
+        yy2 = np.minimum(y2[i], y2[order])
+        w = np.maximum(0.0, (xx2 - xx1).astype(np.float64) + 1)
+        h = np.maximum(0.0, (yy2 - yy1).astype(np.float64) + 1)
+        inter = w * h
+        ovr = inter / ((areas[i] + areas[order]).astype(np.float64) - inter)
+        order = order[~(ovr >= thresh)]
+    keep = np.sort(keep)
     dets = dets[keep, :]
     return dets
 
 
-def soft_nms(dets, sigma, thres):
-    dets_final = []
-    while len(dets) > 0:
-        maxpos = np.argmax(dets[:, 0])
-        dets_final.append(dets[maxpos].copy())
-        ts, tx1, ty1, tx2, ty2 = dets[maxpos]
-        scores = dets[:, 0]
+def _overlaps_with(i, inds, x1, y1, x2, y2, areas, eta=1):
+    xx1 = np.maximum(x1[i], x1[inds])
+    yy1 = np.maximum(y1[i], y1[inds])
+    xx2 = np.minimum(x2[i], x2[inds])
+    yy2 = np.minimum(y2[i], y2[inds])
+    w = np.maximum(0.0, xx2 - xx1 + eta)
+    h = np.maximum(0.0, yy2 - yy1 + eta)
+    inter = w * h
+    return inter / (areas[inds] + areas[i] - inter)
+
+
+def soft_nms(dets,
+             sigma,
+             thres,
+             method='gaussian',
+             linear_thresh=0.3,
+             eta=1,
+             top_k=-1):
+    """
+    Soft-NMS of the detections of one class.
+
+    Areas are computed once and the scores are decayed in place on the
+    indices still alive, boxes whose score drops below thres leave the
+    loop. Kept scores never increase, so with top_k > -1 the loop stops
+    once top_k boxes are kept and the next best score is strictly lower.
+
+    Args:
+        dets (np.ndarray): detections, rows of [score, x1, y1, x2, y2]
+        sigma (float): variance of the gaussian decay
+        thres (float): score threshold below which boxes are dropped
+        method (str): decay function, 'gaussian' or 'linear'
+        linear_thresh (float): overlap above which linear decay applies
+        eta (int): 1 for boxes in pixels, 0 for normalized boxes
+        top_k (int): number of kept boxes after which to stop, -1 for all
+
+    Returns:
+        dets_final (np.ndarray): kept detections with decayed scores, in
+            the order they were selected
+    """
+    assert method in ['gaussian', 'linear'], \
+        "Unknown soft-nms method {}".format(method)
+    if len(dets) == 0:
+        return np.array([]).reshape(-1, 5)
+    scores = dets[:, 0].copy()
+    x1 = dets[:, 1]
+    y1 = dets[:, 2]
+    x2 = dets[:, 3]
+    y2 = dets[:, 4]
+    areas = (x2 - x1 + eta) * (y2 - y1 + eta)
+
+    inds = np.arange(dets.shape[0])
+    keep = []
+    keep_scores = []
+    while inds.size > 0:
+        i = inds[np.argmax(scores[inds])]
+        if top_k > -1 and len(keep) >= top_k and scores[i] < keep_scores[-1]:
+            break
+        keep.append(i)
+        keep_scores.append(scores[i])
         # force remove bbox at maxpos
-        scores[maxpos] = -1
-        x1 = dets[:, 1]
-        y1 = dets[:, 2]
-        x2 = dets[:, 3]
-        y2 = dets[:, 4]
-        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-        xx1 = np.maximum(tx1, x1)
-        yy1 = np.maximum(ty1, y1)
-        xx2 = np.minimum(tx2, x2)
-        yy2 = np.minimum(ty2, y2)
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        ovr = inter / (areas + areas[maxpos] - inter)
-        weight = np.exp(-(ovr * ovr) / sigma)
-        scores = scores * weight
-        idx_keep = np.where(scores >= thres)
-        dets[:, 0] = scores
-        dets = dets[idx_keep]
-    dets_final = np.array(dets_final).reshape(-1, 5)
+        scores[i] = -1
+        ovr = _overlaps_with(i, inds, x1, y1, x2, y2, areas, eta)
+        if method == 'gaussian':
+            weight = np.exp(-(ovr * ovr) / sigma)
+        else:
+            weight = np.where(ovr > linear_thresh, 1 - ovr, 1)
+        scores[inds] *= weight
+        inds = inds[scores[inds] >= thres]
+    dets_final = dets[keep]
+    dets_final[:, 0] = keep_scores
     return dets_final
 
 
+def nms_clusters(x1, y1, x2, y2, thresh, eta=1):
+    """
+    Greedy NMS over boxes sorted by descending score, grouping every kept
+    box with the boxes it suppresses, e.g. for box voting.
+
+    Args:
+        x1, y1, x2, y2 (np.ndarray): box coordinates, shape [N]
+        thresh (float): overlap at or above which a box joins a cluster
+        eta (int): 1 for boxes in pixels, 0 for normalized boxes
+
+    Returns:
+        clusters (list): one index array per kept box, its own index first
+    """
+    areas = (x2 - x1 + eta) * (y2 - y1 + eta)
+    inds = np.arange(len(x1))
+    clusters = []
+    while inds.size > 0:
+        ovr = _overlaps_with(inds[0], inds, x1, y1, x2, y2, areas, eta)
+        merge = ovr >= thresh
+        merge[0] = True
+        clusters.append(inds[merge])
+        inds = inds[~merge]
+    return clusters
+
+
 def bbox_area(box):
     w = box[2] - box[0] + 1
     h = box[3] - box[1] + 1
@@ -129,20 +187,23 @@ def bbox_area(box):
 
 
 def bbox_overlaps(x, y):
-    N = x.shape[0]
-    K = y.shape[0]
-    overlaps = np.zeros((N, K), dtype=np.float32)
-    for k in range(K):
-        y_area = bbox_area(y[k])
-        for n in range(N):
-            iw = min(x[n, 2], y[k, 2]) - max(x[n, 0], y[k, 0]) + 1
-            if iw > 0:
-                ih = min(x[n, 3], y[k, 3]) - max(x[n, 1], y[k, 1]) + 1
-                if ih > 0:
-                    x_area = bbox_area(x[n])
-                    ua = x_area + y_area - iw * ih
-                    overlaps[n, k] = iw * ih / ua
-    return overlaps
+    """
+    Pairwise IoU of the boxes in x and y, shape [N, K], computed by
+    broadcasting with the same +1 pixel convention as bbox_area.
+    """
+    x_area = ((x[:, 2] - x[:, 0]).astype(np.float64) + 1) * (
+        (x[:, 3] - x[:, 1]).astype(np.float64) + 1)
+    y_area = ((y[:, 2] - y[:, 0]).astype(np.float64) + 1) * (
+        (y[:, 3] - y[:, 1]).astype(np.float64) + 1)
+    iw = (np.minimum(x[:, np.newaxis, 2], y[np.newaxis, :, 2]) - np.maximum(
+        x[:, np.newaxis, 0], y[np.newaxis, :, 0])).astype(np.float64) + 1
+    ih = (np.minimum(x[:, np.newaxis, 3], y[np.newaxis, :, 3]) - np.maximum(
+        x[:, np.newaxis, 1], y[np.newaxis, :, 1])).astype(np.float64) + 1
+    inter = np.maximum(iw, 0.) * np.maximum(ih, 0.)
+    ua = x_area[:, np.newaxis] + y_area[np.newaxis, :] - inter
+    overlaps = np.zeros(inter.shape, dtype=np.float64)
+    np.divide(inter, ua, out=overlaps, where=inter > 0)
+    return overlaps.astype(np.float32)
 
 
 def box_voting(nms_dets, dets, vote_thresh):
@@ -151,21 +212,317 @@ def box_voting(nms_dets, dets, vote_thresh):
     all_boxes = dets[:, 1:]
     all_scores = dets[:, 0]
     top_to_all_overlaps = bbox_overlaps(top_boxes, all_boxes)
-    for k in range(nms_dets.shape[0]):
-        inds_to_vote = np.where(top_to_all_overlaps[k] >= vote_thresh)[0]
-        boxes_to_vote = all_boxes[inds_to_vote, :]
-        ws = all_scores[inds_to_vote]
-        top_dets[k, 1:] = np.average(boxes_to_vote, axis=0, weights=ws)
+    # score weighted average of the boxes voting for every kept box,
+    # as one masked [K, N] x [N, 4] product
+    weights = np.where(top_to_all_overlaps >= vote_thresh,
+                       all_scores[np.newaxis, :].astype(np.float64), 0.)
+    top_dets[:, 1:] = weights.dot(all_boxes.astype(np.float64)) / weights.sum(
+        axis=1, keepdims=True)
 
     return top_dets
 
 
+def _top_k_per_image(batch_inds, scores, top_k):
+    valid = np.ones(scores.shape, dtype=np.bool_)
+    for i in np.unique(batch_inds):
+        im_inds = np.where(batch_inds == i)[0]
+        if len(im_inds) > top_k:
+            im_scores = scores[im_inds]
+            kth = len(im_scores) - top_k
+            image_thresh = im_scores[np.argpartition(im_scores, kth)[kth]]
+            valid[im_inds] = im_scores >= image_thresh
+    return valid
+
+
+def multiclass_nms(boxes,
+                   scores,
+                   labels,
+                   nms_thresh,
+                   keep_top_k=-1,
+                   batch_inds=None):
+    """
+    Greedy NMS over the candidates of all classes and images in one pass.
+    Candidates only suppress others of the same image and class, as if
+    every class was offset to its own coordinate range. Each round keeps
+    the best remaining candidate of every class and drops what overlaps
+    it, so the number of rounds is the largest per-class keep count.
+
+    Args:
+        boxes (np.ndarray): candidate boxes, shape [N, 4]
+        scores (np.ndarray): candidate scores, shape [N]
+        labels (np.ndarray): class id of every candidate, shape [N]
+        nms_thresh (float): overlap threshold of the suppression
+        keep_top_k (int): detections kept per image over all classes,
+            ties with the k-th score are kept, -1 keeps all
+        batch_inds (np.ndarray|None): image index of every candidate
+
+    Returns:
+        keep (np.ndarray): indices of the kept candidates, ordered by
+            image, class and then candidate index
+    """
+    num = len(scores)
+    if batch_inds is None:
+        batch_inds = np.zeros((num, ), dtype=np.int64)
+    if num == 0:
+        return np.zeros((0, ), dtype=np.int64)
+    labels = np.asarray(labels).astype(np.int64)
+    batch_inds = np.asarray(batch_inds).astype(np.int64)
+    groups = batch_inds * (labels.max() - labels.min() + 1) + (
+        labels - labels.min())
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    # every group in the order nms visits it, ties included, as the
+    # reversed argsort of the group's scores
+    by_group = np.argsort(groups, kind='mergesort')
+    splits = np.flatnonzero(np.diff(groups[by_group])) + 1
+    order = np.concatenate([
+        inds[scores[inds].argsort()[::-1]]
+        for inds in np.split(by_group, splits)
+    ])
+    keep = []
+    while order.size > 0:
+        group = groups[order]
+        first = np.ones(order.shape, dtype=np.bool_)
+        first[1:] = group[1:] != group[:-1]
+        leaders = order[first]
+        keep.append(leaders)
+        leader = leaders[np.cumsum(first)[~first] - 1]
+        order = order[~first]
+        xx1 = np.maximum(x1[leader], x1[order])
+        yy1 = np.maximum(y1[leader], y1[order])
+        xx2 = np.minimum(x2[leader], x2[order])
+        yy2 = np.minimum(y2[leader], y2[order])
+        w = np.maximum(0.0, (xx2 - xx1).astype(np.float64) + 1)
+        h = np.maximum(0.0, (yy2 - yy1).astype(np.float64) + 1)
+        inter = w * h
+        ovr = inter / (
+            (areas[leader] + areas[order]).astype(np.float64) - inter)
+        order = order[~(ovr >= nms_thresh)]
+    keep = np.concatenate(keep)
+
+    # Limit to keep_top_k detections **over all classes** of each image
+    if keep_top_k > -1:
+        keep = keep[_top_k_per_image(batch_inds[keep], scores[keep],
+                                     keep_top_k)]
+    return keep[np.lexsort((keep, groups[keep]))]
+
+
+def multiclass_soft_nms(boxes,
+                        scores,
+                        labels,
+                        sigma,
+                        thres,
+                        keep_top_k=-1,
+                        batch_inds=None,
+                        method='gaussian',
+                        linear_thresh=0.3,
+                        eta=1):
+    """
+    soft_nms over the candidates of all classes and images in one pass.
+    Each round selects the best remaining candidate of every class and
+    decays the others of its class, with the same arithmetic as soft_nms,
+    so the result equals running soft_nms class by class.
+
+    Args:
+        boxes (np.ndarray): candidate boxes, shape [N, 4]
+        scores (np.ndarray): candidate scores, shape [N]
+        labels (np.ndarray): class id of every candidate, shape [N]
+        sigma, thres, method, linear_thresh, eta: as in soft_nms
+        keep_top_k (int): detections kept per image over all classes,
+            ties with the k-th score are kept, -1 keeps all
+        batch_inds (np.ndarray|None): image index of every candidate
+
+    Returns:
+        keep (np.ndarray): indices of the kept candidates, ordered by
+            image, class and then the order of selection
+        keep_scores (np.ndarray): decayed scores of the kept candidates
+    """
+    assert method in ['gaussian', 'linear'], \
+        "Unknown soft-nms method {}".format(method)
+    num = len(scores)
+    if batch_inds is None:
+        batch_inds = np.zeros((num, ), dtype=np.int64)
+    if num == 0:
+        return np.zeros((0, ), dtype=np.int64), scores[:0].copy()
+    labels = np.asarray(labels).astype(np.int64)
+    batch_inds = np.asarray(batch_inds).astype(np.int64)
+    groups = batch_inds * (labels.max() - labels.min() + 1) + (
+        labels - labels.min())
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    areas = (x2 - x1 + eta) * (y2 - y1 + eta)
+
+    scores = scores.copy()
+    kept_num = np.zeros((groups.max() + 1, ), dtype=np.int64)
+    last_scores = np.zeros((groups.max() + 1, ), dtype=scores.dtype)
+    keep = []
+    keep_scores = []
+    keep_rounds = []
+    # per group in index order, argmax takes the first of equal scores
+    alive = np.lexsort((np.arange(num), groups))
+    while alive.size > 0:
+        group = groups[alive]
+        first = np.ones(alive.shape, dtype=np.bool_)
+        first[1:] = group[1:] != group[:-1]
+        seg = np.cumsum(first) - 1
+        cur = scores[alive]
+        seg_max = np.maximum.reduceat(cur, np.nonzero(first)[0])
+        max_pos = np.nonzero(cur == seg_max[seg])[0]
+        first_max = np.ones(max_pos.shape, dtype=np.bool_)
+        first_max[1:] = seg[max_pos[1:]] != seg[max_pos[:-1]]
+        leaders = alive[max_pos[first_max]]
+        lead_groups = groups[leaders]
+        lead_scores = scores[leaders]
+        if keep_top_k > -1:
+            # kept scores never increase, a group with keep_top_k kept
+            # boxes cannot add any above the per-image threshold
+            done = (kept_num[lead_groups] >= keep_top_k) & (
+                lead_scores < last_scores[lead_groups])
+            if done.any():
+                alive = alive[~done[seg]]
+                continue
+        keep.append(leaders)
+        keep_scores.append(lead_scores)
+        keep_rounds.append(kept_num[lead_groups])
+        kept_num[lead_groups] += 1
+        last_scores[lead_groups] = lead_scores
+
+        # force remove the selected boxes
+        scores[leaders] = -1
+        leader = leaders[seg]
+        xx1 = np.maximum(x1[leader], x1[alive])
+        yy1 = np.maximum(y1[leader], y1[alive])
+        xx2 = np.minimum(x2[leader], x2[alive])
+        yy2 = np.minimum(y2[leader], y2[alive])
+        w = np.maximum(0.0, xx2 - xx1 + eta)
+        h = np.maximum(0.0, yy2 - yy1 + eta)
+        inter = w * h
+        ovr = inter / (areas[alive] + areas[leader] - inter)
+        if method == 'gaussian':
+            weight = np.exp(-(ovr * ovr) / sigma)
+        else:
+            weight = np.where(ovr > linear_thresh, 1 - ovr, 1)
+        scores[alive] *= weight
+        alive = alive[scores[alive] >= thres]
+    keep = np.concatenate(keep)
+    keep_scores = np.concatenate(keep_scores)
+    keep_rounds = np.concatenate(keep_rounds)
+
+    if keep_top_k > -1:
+        valid = _top_k_per_image(batch_inds[keep], keep_scores, keep_top_k)
+        keep = keep[valid]
+        keep_scores = keep_scores[valid]
+        keep_rounds = keep_rounds[valid]
+    order = np.lexsort((keep_rounds, groups[keep]))
+    return keep[order], keep_scores[order]
+
+
+def _nms_candidates(boxes, scores, config, num_classes, start_idx,
+                    labels=None):
+    if labels is not None:
+        inds = np.where((labels >= start_idx) & (labels < num_classes))[0]
+        cls = labels[inds].astype(np.int64)
+        scores_j = scores[inds]
+        boxes_j = boxes[inds, :]
+    else:
+        inds, cls = np.nonzero(
+            scores[:, start_idx:num_classes] > config['score_thresh'])
+        cls += start_idx
+        scores_j = scores[inds, cls]
+        boxes_j = boxes.reshape(
+            (boxes.shape[0], boxes.shape[1] // 4, 4))[inds, cls]
+    dets = np.hstack((scores_j[:, np.newaxis], boxes_j)).astype(
+        np.float32, copy=False)
+    return inds, cls, dets
+
+
+def _multiclass_nms_result(cls, dets, config, batch_inds=None):
+    if config.get('use_soft_nms', False):
+        keep, keep_scores = multiclass_soft_nms(
+            dets[:, 1:], dets[:, 0], cls, config['sigma'],
+            config['nms_thresh'], config['detections_per_im'], batch_inds)
+        dets = dets[keep]
+        dets[:, 0] = keep_scores
+    else:
+        keep = multiclass_nms(dets[:, 1:], dets[:, 0], cls,
+                              config['nms_thresh'],
+                              config['detections_per_im'], batch_inds)
+        dets = dets[keep]
+    im_results = np.hstack((cls[keep][:, np.newaxis], dets)).astype(
+        np.float32, copy=False)
+    return keep, im_results
+
+
 def get_nms_result(boxes,
                    scores,
                    config,
                    num_classes,
                    background_label=0,
                    labels=None):
+    if config.get('enable_voting', False):
+        return _get_nms_result_per_class(boxes, scores, config, num_classes,
+                                         background_label, labels)
+    start_idx = 1 if background_label == 0 else 0
+    _, cls, dets = _nms_candidates(boxes, scores, config, num_classes,
+                                   start_idx, labels)
+    _, im_results = _multiclass_nms_result(cls, dets, config)
+    return im_results
+
+
+def get_batch_nms_result(boxes,
+                         scores,
+                         batch_inds,
+                         num_images,
+                         config,
+                         num_classes,
+                         background_label=0,
+                         labels=None):
+    """
+    get_nms_result of several images at once.
+
+    Args:
+        boxes (np.ndarray): boxes of all images, shape [N, 4 * num_classes],
+            or [N, 4] with labels
+        scores (np.ndarray): scores of all images, shape [N, num_classes],
+            or [N] with labels
+        batch_inds (np.ndarray): image index of every row, shape [N]
+        num_images (int): number of images
+        labels (np.ndarray|None): class of every row, shape [N]
+
+    Returns:
+        im_results (np.ndarray): detections ordered by image
+        lengths (list): number of detections of every image
+    """
+    if config.get('enable_voting', False):
+        im_results = []
+        for i in range(num_images):
+            im_inds = np.where(batch_inds == i)[0]
+            im_results.append(
+                get_nms_result(boxes[im_inds], scores[im_inds], config,
+                               num_classes, background_label, None
+                               if labels is None else labels[im_inds]))
+        return np.vstack(im_results), [len(r) for r in im_results]
+    start_idx = 1 if background_label == 0 else 0
+    inds, cls, dets = _nms_candidates(boxes, scores, config, num_classes,
+                                      start_idx, labels)
+    det_inds = batch_inds[inds]
+    keep, im_results = _multiclass_nms_result(cls, dets, config, det_inds)
+    lengths = np.bincount(det_inds[keep], minlength=num_images)
+    return im_results, lengths.tolist()
+
+
+def _get_nms_result_per_class(boxes,
+                              scores,
+                              config,
+                              num_classes,
+                              background_label=0,
+                              labels=None):
     has_labels = labels is not None
     cls_boxes = [[] for _ in range(num_classes)]
     start_idx = 1 if background_label == 0 else 0
@@ -178,7 +535,11 @@ def get_nms_result(boxes,
         dets_j = np.hstack((scores_j[:, np.newaxis], boxes_j)).astype(
             np.float32, copy=False)
         if config.get('use_soft_nms', False):
-            nms_dets = soft_nms(dets_j, config['sigma'], config['nms_thresh'])
+            nms_dets = soft_nms(
+                dets_j,
+                config['sigma'],
+                config['nms_thresh'],
+                top_k=config['detections_per_im'])
         else:
             nms_dets = nms(dets_j, config['nms_thresh'])
         if config.get('enable_voting', False):
@@ -205,39 +566,51 @@ def get_nms_result(boxes,
 def mstest_box_post_process(result, config, num_classes):
     """
     Multi-scale Test
-    Only available for batch_size=1 now.
+    Merge the boxes of all scales and flips of every image in the batch,
+    the LoD of the box results gives the number of boxes of each image.
     """
     post_bbox = {}
     use_flip = False
     ms_boxes = []
     ms_scores = []
+    ms_inds = []
     im_shape = result['im_shape'][0]
+    num_images = im_shape.shape[0]
     for k in result.keys():
         if 'bbox' in k:
             boxes = result[k][0]
             boxes = np.reshape(boxes, (-1, 4 * num_classes))
             scores = result['score' + k[4:]][0]
+            lengths = result[k][1][0] if len(result[k][1]) > 0 else [
+                len(boxes)
+            ]
             if 'flip' in k:
-                boxes = box_flip(boxes, im_shape)
+                boxes = box_flip(boxes, im_shape, lengths)
                 use_flip = True
             ms_boxes.append(boxes)
             ms_scores.append(scores)
+            ms_inds.append(np.repeat(np.arange(len(lengths)), lengths))
 
     ms_boxes = np.concatenate(ms_boxes)
     ms_scores = np.concatenate(ms_scores)
-    bbox_pred = get_nms_result(ms_boxes, ms_scores, config, num_classes)
-    post_bbox.update({'bbox': (bbox_pred, [[len(bbox_pred)]])})
+    ms_inds = np.concatenate(ms_inds)
+    bbox_pred, lengths = get_batch_nms_result(
+        ms_boxes, ms_scores, ms_inds, num_images, config, num_classes)
+    post_bbox.update({'bbox': (bbox_pred, [lengths])})
     if use_flip:
         bbox = bbox_pred[:, 2:]
         bbox_flip = np.append(
-            bbox_pred[:, :2], box_flip(bbox, im_shape), axis=1)
-        post_bbox.update({'bbox_flip': (bbox_flip, [[len(bbox_flip)]])})
+            bbox_pred[:, :2], box_flip(bbox, im_shape, lengths), axis=1)
+        post_bbox.update({'bbox_flip': (bbox_flip, [lengths])})
     return post_bbox
 
 
-def mstest_mask_post_process(result, cfg):
+def mstest_mask_post_process(result, cfg, lengths=None):
+    """
+    Average the masks of all scales and flips, lengths is the number of
+    detections of every image in the batch.
+    """
     mask_list = []
-    im_shape = result['im_shape'][0]
     M = cfg.FPNRoIAlign['mask_resolution']
     for k in result.keys():
         if 'mask' in k:
@@ -251,11 +624,102 @@ def mstest_mask_post_process(result, cfg):
             mask_list.append(masks)
 
     mask_pred = np.mean(mask_list, axis=0)
-    return {'mask': (mask_pred, [[len(mask_pred)]])}
+    if lengths is None:
+        lengths = [len(mask_pred)]
+    return {'mask': (mask_pred, [lengths])}
 
 
-def mask_encode(results, resolution, thresh_binarize=0.5):
+def crop_mask_rle(crop, x0, y0, im_h, im_w):
+    """
+    COCO RLE of an im_h x im_w mask that is zero except for crop pasted
+    at (x0, y0), computed from the run boundaries of the crop alone. The
+    result is identical to pycocotools.mask.encode of the full mask.
+
+    Args:
+        crop (np.ndarray): binary mask inside the image, shape [h, w]
+        x0, y0 (int): position of the top left pixel of crop
+        im_h, im_w (int): image size
+    """
     import pycocotools.mask as mask_util
+    h, w = crop.shape
+    # column major like RLE, each column padded with one zero pixel above
+    # and below standing for the background around the crop
+    padded = np.zeros((w, h + 2), dtype=np.int8)
+    padded[:, 1:-1] = crop.T != 0
+    padded = padded.ravel()
+    changes = np.nonzero(padded[1:] != padded[:-1])[0] + 1
+    cols, rows = np.divmod(changes, h + 2)
+    starts = (x0 + cols) * im_h + y0 + rows - 1
+    # a run ending at the bottom of a full height column and one starting
+    # at the top of the next one are a single run
+    joint = np.zeros(starts.shape, dtype=np.bool_)
+    joint[1:] = starts[1:] == starts[:-1]
+    joint[:-1] |= joint[1:]
+    starts = starts[~joint]
+    counts = np.diff(np.concatenate(([0], starts, [im_h * im_w])))
+    if len(counts) > 1 and counts[-1] == 0:
+        # no trailing empty run when the mask ends with foreground
+        counts = counts[:-1]
+    return mask_util.frPyObjects({
+        'counts': counts,
+        'size': [im_h, im_w]
+    }, im_h, im_w)
+
+
+def paste_mask_rles(boxes, masks, im_h, im_w, thresh_binarize=0.5):
+    """
+    Resize the masks of one image to their boxes and encode them as COCO
+    RLEs without allocating the full image mask.
+
+    Args:
+        boxes (np.ndarray): expanded int boxes of the masks, shape [N, 4]
+        masks (np.ndarray): mask of the predicted class, shape [N, M, M]
+        im_h, im_w (int): image size
+        thresh_binarize (float): threshold of the resized masks
+    """
+    resolution = masks.shape[-1]
+    padded_mask = np.zeros((resolution + 2, resolution + 2), dtype=np.float32)
+    segms = []
+    for j in range(len(boxes)):
+        xmin, ymin, xmax, ymax = boxes[j].tolist()
+        padded_mask[1:-1, 1:-1] = masks[j]
+
+        w = xmax - xmin + 1
+        h = ymax - ymin + 1
+        w = np.maximum(w, 1)
+        h = np.maximum(h, 1)
+        resized_mask = cv2.resize(padded_mask, (w, h))
+        resized_mask = np.array(resized_mask > thresh_binarize, dtype=np.uint8)
+
+        x0 = min(max(xmin, 0), im_w)
+        x1 = min(max(xmax + 1, 0), im_w)
+        y0 = min(max(ymin, 0), im_h)
+        y1 = min(max(ymax + 1, 0), im_h)
+
+        crop = resized_mask[(y0 - ymin):(y1 - ymin), (x0 - xmin):(x1 - xmin)]
+        segms.append(crop_mask_rle(crop, x0, y0, im_h, im_w))
+    return segms
+
+
+_mask_pool = None
+
+
+def map_images(func, args):
+    """
+    Apply func to the per image argument tuples in args, on a thread pool
+    when there is more than one image. cv2.resize and the numpy work in
+    paste_mask_rles release the GIL.
+    """
+    global _mask_pool
+    if len(args) <= 1:
+        return [func(*arg) for arg in args]
+    if _mask_pool is None:
+        from multiprocessing.pool import ThreadPool
+        _mask_pool = ThreadPool(min(multiprocessing.cpu_count(), 8))
+    return _mask_pool.map(lambda arg: func(*arg), args)
+
+
+def mask_encode(results, resolution, thresh_binarize=0.5):
     from ppdet.utils.coco_eval import expand_boxes
     scale = (resolution + 2.0) / resolution
     bboxes = results['bbox'][0]
@@ -269,59 +733,47 @@ def mask_encode(results, resolution, thresh_binarize=0.5):
         return segms
 
     s = 0
+    args = []
     # for each sample
     for i in range(len(lengths)):
         num = lengths[i]
         im_shape = im_shapes[i]
 
         bbox = bboxes[s:s + num][:, 2:]
-        clsid_scores = bboxes[s:s + num][:, 0:2]
-        mask = masks[s:s + num]
+        clsids = bboxes[s:s + num][:, 0].astype(np.int32)
+        mask = masks[s:s + num][np.arange(num), clsids]
         s += num
 
         im_h = int(im_shape[0])
         im_w = int(im_shape[1])
         expand_bbox = expand_boxes(bbox, scale)
         expand_bbox = expand_bbox.astype(np.int32)
-        padded_mask = np.zeros(
-            (resolution + 2, resolution + 2), dtype=np.float32)
-
-        for j in range(num):
-            xmin, ymin, xmax, ymax = expand_bbox[j].tolist()
-            clsid, score = clsid_scores[j].tolist()
-            clsid = int(clsid)
-            padded_mask[1:-1, 1:-1] = mask[j, clsid, :, :]
-
-            w = xmax - xmin + 1
-            h = ymax - ymin + 1
-            w = np.maximum(w, 1)
-            h = np.maximum(h, 1)
-            resized_mask = cv2.resize(padded_mask, (w, h))
-            resized_mask = np.array(
-                resized_mask > thresh_binarize, dtype=np.uint8)
-            im_mask = np.zeros((im_h, im_w), dtype=np.uint8)
-
-            x0 = min(max(xmin, 0), im_w)
-            x1 = min(max(xmax + 1, 0), im_w)
-            y0 = min(max(ymin, 0), im_h)
-            y1 = min(max(ymax + 1, 0), im_h)
-
-            im_mask[y0:y1, x0:x1] = resized_mask[(y0 - ymin):(y1 - ymin), (
-                x0 - xmin):(x1 - xmin)]
-            segm = mask_util.encode(
-                np.array(
-                    im_mask[:, :, np.newaxis], order='F'))[0]
-            segms.append(segm)
+        args.append((expand_bbox, mask, im_h, im_w, thresh_binarize))
+
+    for im_segms in map_images(paste_mask_rles, args):
+        segms.extend(im_segms)
     return segms
 
 
 def corner_post_process(results, config, num_classes):
     detections = results['bbox'][0]
+    lengths = results['bbox'][1][0] if len(results['bbox'][1]) > 0 else [
+        len(detections)
+    ]
+    batch_inds = np.repeat(np.arange(len(lengths)), lengths)
     keep_inds = (detections[:, 1] > -1)
     detections = detections[keep_inds]
+    batch_inds = batch_inds[keep_inds]
     labels = detections[:, 0]
     scores = detections[:, 1]
     boxes = detections[:, 2:6]
-    cls_boxes = get_nms_result(
-        boxes, scores, config, num_classes, background_label=-1, labels=labels)
-    results.update({'bbox': (cls_boxes, [[len(cls_boxes)]])})
+    cls_boxes, lengths = get_batch_nms_result(
+        boxes,
+        scores,
+        batch_inds,
+        len(lengths),
+        config,
+        num_classes,
+        background_label=-1,
+        labels=labels)
+    results.update({'bbox': (cls_boxes, [lengths])})
@@ -36,21 +36,28 @@ def bbox_eval(results,
               overlap_thresh=0.5,
               map_type='11point',
               is_bbox_normalized=False,
-              evaluate_difficult=False):
+              evaluate_difficult=False,
+              classwise=False):
     """
     Bounding box evaluation for VOC dataset
 
     Args:
         results (list): prediction bounding box results.
         class_num (int): evaluation class number.
-        overlap_thresh (float): the postive threshold of
-                        bbox overlap
+        overlap_thresh (float|list): the postive threshold of
+                        bbox overlap, a list of thresholds is
+                        evaluated in one pass.
         map_type (string): method for mAP calcualtion,
                         can only be '11point' or 'integral'
         is_bbox_normalized (bool): whether bbox is normalized
                         to range [0, 1].
         evaluate_difficult (bool): whether to evaluate
                         difficult gt bbox.
+        classwise (bool): whether to log the AP of each class.
+
+    Returns:
+        map_stat (float|list): mAP in percent, a list aligned with
+                        overlap_thresh if it is a list.
     """
     assert 'bbox' in results[0]
     logger.info("Start evaluate...")
@@ -106,10 +113,23 @@ def bbox_eval(results,
 
     logger.info("Accumulating evaluatation results...")
     detection_map.accumulate()
-    map_stat = 100. * detection_map.get_map()
-    logger.info("mAP({:.2f}, {}) = {:.2f}%".format(overlap_thresh, map_type,
-                                                   map_stat))
-    return map_stat
+    multi_thresh = isinstance(overlap_thresh, (list, tuple))
+    threshs = overlap_thresh if multi_thresh else [overlap_thresh]
+    maps = detection_map.get_map() if multi_thresh else \
+        [detection_map.get_map()]
+    class_aps = detection_map.get_class_ap() if multi_thresh else \
+        [detection_map.get_class_ap()]
+    map_stat = []
+    for thresh, mAP, class_ap in zip(threshs, maps, class_aps):
+        map_stat.append(100. * mAP)
+        logger.info("mAP({:.2f}, {}) = {:.2f}%".format(
+            thresh, map_type, 100. * mAP))
+        if classwise:
+            for i, ap in enumerate(class_ap):
+                if not np.isnan(ap):
+                    logger.info("    class {}: AP({:.2f}) = {:.2f}%".format(
+                        i, thresh, 100. * ap))
+    return map_stat if multi_thresh else map_stat[0]
 
 
 def prune_zero_padding(gt_box, gt_label, difficult=None):
@@ -21,6 +21,7 @@ import numpy as np
 
 from ppdet.data.source.widerface import widerface_label
 from ppdet.utils.coco_eval import bbox2out
+from ppdet.utils.post_process import nms_clusters
 
 import logging
 logger = logging.getLogger(__name__)
@@ -52,28 +53,14 @@ def bbox_vote(det):
     if det.shape[0] == 0:
         dets = np.array([[10, 10, 20, 20, 0.002]])
         det = np.empty(shape=[0, 5])
-    while det.shape[0] > 0:
-        # IOU
-        area = (det[:, 2] - det[:, 0] + 1) * (det[:, 3] - det[:, 1] + 1)
-        xx1 = np.maximum(det[0, 0], det[:, 0])
-        yy1 = np.maximum(det[0, 1], det[:, 1])
-        xx2 = np.minimum(det[0, 2], det[:, 2])
-        yy2 = np.minimum(det[0, 3], det[:, 3])
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        o = inter / (area[0] + area[:] - inter)
-
-        # nms
-        merge_index = np.where(o >= 0.3)[0]
+    clusters = nms_clusters(det[:, 0], det[:, 1], det[:, 2], det[:, 3], 0.3)
+    voted = []
+    for k, merge_index in enumerate(clusters):
         det_accu = det[merge_index, :]
-        det = np.delete(det, merge_index, 0)
         if merge_index.shape[0] <= 1:
-            if det.shape[0] == 0:
-                try:
-                    dets = np.row_stack((dets, det_accu))
-                except:
-                    dets = det_accu
+            # a single box is only kept when it is the last one
+            if k == len(clusters) - 1:
+                voted.append(det_accu)
             continue
         det_accu[:, 0:4] = det_accu[:, 0:4] * np.tile(det_accu[:, -1:], (1, 4))
         max_score = np.max(det_accu[:, 4])
@@ -81,10 +68,9 @@ def bbox_vote(det):
         det_accu_sum[:, 0:4] = np.sum(det_accu[:, 0:4],
                                       axis=0) / np.sum(det_accu[:, -1:])
         det_accu_sum[:, 4] = max_score
-        try:
-            dets = np.row_stack((dets, det_accu_sum))
-        except:
-            dets = det_accu_sum
+        voted.append(det_accu_sum)
+    if len(voted) > 0:
+        dets = np.row_stack(voted)
     dets = dets[0:750, :]
     # Only keep 0.3 or more
     keep_index = np.where(dets[:, 4] >= 0.01)[0]
@@ -0,0 +1,301 @@
+# Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark the numpy post processing in ppdet.utils.post_process against
+straightforward reference implementations and check the results match.
+
+    python tools/benchmark_post_process.py --sizes 1000 4000 16000 \
+        --corner_batch_sizes 1 8
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+# add python path of PadleDetection to sys.path
+parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 2)))
+if parent_path not in sys.path:
+    sys.path.append(parent_path)
+
+import time
+import argparse
+import numpy as np
+
+from ppdet.utils.post_process import nms, box_voting, corner_post_process
+
+
+def reference_nms(dets, thresh):
+    """Pairwise greedy NMS loop, the previous implementation of nms."""
+    if dets.shape[0] == 0:
+        return dets[[], :]
+    scores = dets[:, 0]
+    x1 = dets[:, 1]
+    y1 = dets[:, 2]
+    x2 = dets[:, 3]
+    y2 = dets[:, 4]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    ndets = dets.shape[0]
+    suppressed = np.zeros((ndets), dtype=np.int32)
+    for _i in range(ndets):
+        i = order[_i]
+        if suppressed[i] == 1:
+            continue
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        for _j in range(_i + 1, ndets):
+            j = order[_j]
+            if suppressed[j] == 1:
+                continue
+            xx1 = max(ix1, x1[j])
+            yy1 = max(iy1, y1[j])
+            xx2 = min(ix2, x2[j])
+            yy2 = min(iy2, y2[j])
+            w = max(0.0, xx2 - xx1 + 1)
+            h = max(0.0, yy2 - yy1 + 1)
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr >= thresh:
+                suppressed[j] = 1
+    keep = np.where(suppressed == 0)[0]
+    return dets[keep, :]
+
+
+def reference_box_voting(nms_dets, dets, vote_thresh):
+    """Per kept box np.average loop of the previous box_voting, with a
+    row-wise IoU in place of the old double-loop bbox_overlaps."""
+    top_dets = nms_dets.copy()
+    all_boxes = dets[:, 1:]
+    all_scores = dets[:, 0]
+    for k in range(nms_dets.shape[0]):
+        x1 = np.maximum(nms_dets[k, 1], all_boxes[:, 0])
+        y1 = np.maximum(nms_dets[k, 2], all_boxes[:, 1])
+        x2 = np.minimum(nms_dets[k, 3], all_boxes[:, 2])
+        y2 = np.minimum(nms_dets[k, 4], all_boxes[:, 3])
+        inter = np.maximum(0., x2 - x1 + 1) * np.maximum(0., y2 - y1 + 1)
+        area = (nms_dets[k, 3] - nms_dets[k, 1] + 1) * (
+            nms_dets[k, 4] - nms_dets[k, 2] + 1)
+        areas = (all_boxes[:, 2] - all_boxes[:, 0] + 1) * (
+            all_boxes[:, 3] - all_boxes[:, 1] + 1)
+        ovr = inter / (area + areas - inter)
+        inds_to_vote = np.where(ovr >= vote_thresh)[0]
+        top_dets[k, 1:] = np.average(
+            all_boxes[inds_to_vote, :], axis=0, weights=all_scores[inds_to_vote])
+    return top_dets
+
+
+def reference_soft_nms(dets, sigma, thres):
+    """Previous soft_nms, re-gathering the remaining dets every round."""
+    dets_final = []
+    while len(dets) > 0:
+        maxpos = np.argmax(dets[:, 0])
+        dets_final.append(dets[maxpos].copy())
+        ts, tx1, ty1, tx2, ty2 = dets[maxpos]
+        scores = dets[:, 0]
+        # force remove bbox at maxpos
+        scores[maxpos] = -1
+        x1 = dets[:, 1]
+        y1 = dets[:, 2]
+        x2 = dets[:, 3]
+        y2 = dets[:, 4]
+        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+        xx1 = np.maximum(tx1, x1)
+        yy1 = np.maximum(ty1, y1)
+        xx2 = np.minimum(tx2, x2)
+        yy2 = np.minimum(ty2, y2)
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas + areas[maxpos] - inter)
+        weight = np.exp(-(ovr * ovr) / sigma)
+        scores = scores * weight
+        idx_keep = np.where(scores >= thres)
+        dets[:, 0] = scores
+        dets = dets[idx_keep]
+    dets_final = np.array(dets_final).reshape(-1, 5)
+    return dets_final
+
+
+def reference_corner_post_process(detections, config, num_classes):
+    """Previous per-class loop of corner_post_process for one image."""
+    detections = detections[detections[:, 1] > -1]
+    labels = detections[:, 0]
+    cls_boxes = []
+    for j in range(num_classes):
+        inds = np.where(labels == j)[0]
+        dets_j = detections[inds, 1:6].astype(np.float32, copy=False)
+        if config.get('use_soft_nms', False):
+            nms_dets = reference_soft_nms(dets_j, config['sigma'],
+                                          config['nms_thresh'])
+        else:
+            nms_dets = reference_nms(dets_j, config['nms_thresh'])
+        label = np.array([j for _ in range(len(nms_dets))])
+        cls_boxes.append(
+            np.hstack((label[:, np.newaxis], nms_dets)).astype(
+                np.float32, copy=False))
+    cls_boxes = np.vstack(cls_boxes)
+    if len(cls_boxes) > config['detections_per_im']:
+        image_thresh = np.sort(cls_boxes[:, 1])[-config['detections_per_im']]
+        cls_boxes = cls_boxes[cls_boxes[:, 1] >= image_thresh]
+    return cls_boxes
+
+
+def make_dets(num, im_size=1333., max_size=300.):
+    x1 = np.random.uniform(0, im_size, num)
+    y1 = np.random.uniform(0, im_size, num)
+    w = np.random.uniform(4, max_size, num)
+    h = np.random.uniform(4, max_size, num)
+    scores = np.random.rand(num)
+    return np.stack(
+        [scores, x1, y1, x1 + w, y1 + h], axis=1).astype(np.float32)
+
+
+def make_corner_dets(num, num_classes, im_size=1333., max_size=300.):
+    """CornerNet style [label, score, x1, y1, x2, y2] rows, unmatched corner
+    pairs have a score of -1."""
+    dets = make_dets(num, im_size, max_size)
+    labels = np.random.randint(0, num_classes, (num, 1)).astype(np.float32)
+    dets[np.random.rand(num) < 0.2, 0] = -1
+    return np.hstack((labels, dets))
+
+
+def timeit(fn, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+def bench_nms(FLAGS):
+    print('{:>8} {:>8} {:>14} {:>14}'.format('boxes', 'kept', 'nms (ms)',
+                                            'reference (ms)'))
+    for num in FLAGS.sizes:
+        dets = make_dets(num)
+        out = nms(dets, FLAGS.nms_thresh)
+        cost = timeit(lambda: nms(dets, FLAGS.nms_thresh), FLAGS.repeat)
+        ref_cost = float('nan')
+        if num <= FLAGS.max_reference_size:
+            ref = reference_nms(dets, FLAGS.nms_thresh)
+            assert np.array_equal(out, ref), \
+                'nms mismatch with {} boxes'.format(num)
+            ref_cost = timeit(lambda: reference_nms(dets, FLAGS.nms_thresh), 1)
+        print('{:>8} {:>8} {:>14.2f} {:>14.2f}'.format(num, len(out), cost,
+                                                     ref_cost))
+
+
+def bench_box_voting(FLAGS):
+    print('{:>8} {:>8} {:>14} {:>14}'.format('boxes', 'kept', 'voting (ms)',
+                                            'reference (ms)'))
+    for num in FLAGS.sizes:
+        dets = make_dets(num)
+        nms_dets = nms(dets, FLAGS.nms_thresh)
+        out = box_voting(nms_dets, dets, FLAGS.vote_thresh)
+        cost = timeit(lambda: box_voting(nms_dets, dets, FLAGS.vote_thresh),
+                      FLAGS.repeat)
+        ref_cost = float('nan')
+        if num <= FLAGS.max_reference_size:
+            ref = reference_box_voting(nms_dets, dets, FLAGS.vote_thresh)
+            # the matrix product sums in a different order than np.average
+            assert np.allclose(out, ref, rtol=1e-6), \
+                'box voting mismatch with {} boxes'.format(num)
+            ref_cost = timeit(
+                lambda: reference_box_voting(nms_dets, dets, FLAGS.vote_thresh),
+                1)
+        print('{:>8} {:>8} {:>14.2f} {:>14.2f}'.format(num, len(out), cost,
+                                                     ref_cost))
+
+
+def bench_corner(FLAGS):
+    config = {
+        'use_soft_nms': True,
+        'detections_per_im': 100,
+        'nms_thresh': 0.001,
+        'sigma': 0.5
+    }
+    print('{:>8} {:>8} {:>14} {:>14}'.format('batch', 'dets', 'corner (ms)',
+                                            'reference (ms)'))
+    for batch_size in FLAGS.corner_batch_sizes:
+        dets = [
+            make_corner_dets(FLAGS.corner_num_dets, FLAGS.num_classes)
+            for _ in range(batch_size)
+        ]
+        batch = np.vstack(dets)
+        lengths = [[len(d) for d in dets]]
+
+        def run():
+            results = {'bbox': (batch, lengths)}
+            corner_post_process(results, config, FLAGS.num_classes)
+            return results['bbox']
+
+        out, out_lengths = run()
+        cost = timeit(run, FLAGS.repeat)
+        refs = [
+            reference_corner_post_process(d, config, FLAGS.num_classes)
+            for d in dets
+        ]
+        assert np.array_equal(out, np.vstack(refs)) and \
+            out_lengths[0] == [len(r) for r in refs], \
+            'corner post process mismatch with batch size {}'.format(batch_size)
+        ref_cost = timeit(lambda: [
+            reference_corner_post_process(d, config, FLAGS.num_classes)
+            for d in dets
+        ], 1)
+        print('{:>8} {:>8} {:>14.2f} {:>14.2f}'.format(batch_size, len(out),
+                                                     cost, ref_cost))
+
+
+def main(FLAGS):
+    np.random.seed(0)
+    bench_nms(FLAGS)
+    bench_box_voting(FLAGS)
+    bench_corner(FLAGS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs='+',
+        default=[100, 1000, 4000, 10000, 20000],
+        help="Number of boxes to run NMS on.")
+    parser.add_argument("--nms_thresh", type=float, default=0.5)
+    parser.add_argument("--vote_thresh", type=float, default=0.8)
+    parser.add_argument(
+        "--max_reference_size",
+        type=int,
+        default=2000,
+        help="Largest input the pairwise reference loop is timed on.")
+    parser.add_argument(
+        "--corner_batch_sizes",
+        type=int,
+        nargs='+',
+        default=[1, 8],
+        help="Batch sizes of the CornerNet post processing benchmark.")
+    parser.add_argument(
+        "--corner_num_dets",
+        type=int,
+        default=1000,
+        help="Decoded corner pairs per image, num_dets of CornerHead.")
+    parser.add_argument("--num_classes", type=int, default=80)
+    parser.add_argument("--repeat", type=int, default=3)
+    FLAGS = parser.parse_args()
+    main(FLAGS)
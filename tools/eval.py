@@ -22,10 +22,11 @@ parent_path = os.path.abspath(os.path.join(__file__, *(['..'] * 2)))
 if parent_path not in sys.path:
     sys.path.append(parent_path)
 
+import json
 import paddle
 import paddle.fluid as fluid
 
-from ppdet.utils.eval_utils import parse_fetches, eval_run, eval_results, json_eval_results
+from ppdet.utils.eval_utils import parse_fetches, eval_run, eval_results, json_eval_results, COCOResultCollector
 import ppdet.utils.checkpoint as checkpoint
 from ppdet.utils.check import check_gpu, check_xpu, check_version, check_config, enable_static_mode
 
@@ -92,6 +93,12 @@ def main():
 
     dataset = cfg['EvalReader']['dataset']
 
+    # processes for the COCO per image evaluation, 0 to evaluate in process
+    eval_workers = cfg.eval_workers if 'eval_workers' in cfg else 0
+    # COCO results are saved as 'json' or 'npz', only use in COCO eval
+    result_format = cfg.eval_result_format \
+        if 'eval_result_format' in cfg else 'json'
+
     # eval already exists json file
     if FLAGS.json_eval:
         logger.info(
@@ -99,7 +106,10 @@ def main():
             "output_eval directly. And proposal.json, bbox.json and mask.json "
             "will be detected by default.")
         json_eval_results(
-            cfg.metric, json_directory=FLAGS.output_eval, dataset=dataset)
+            cfg.metric,
+            json_directory=FLAGS.output_eval,
+            dataset=dataset,
+            num_workers=eval_workers)
         return
 
     compile_program = fluid.CompiledProgram(eval_prog).with_data_parallel()
@@ -156,14 +166,22 @@ def main():
     resolution = None
     if 'Mask' in cfg.architecture or cfg.architecture == 'HybridTaskCascade':
         resolution = model.mask_head.resolution
+    # convert COCO results batch by batch while evaluating
+    collector = COCOResultCollector(is_bbox_normalized, resolution) \
+        if cfg.metric == 'COCO' else None
     results = eval_run(exe, compile_program, loader, keys, values, cls, cfg,
-                       sub_eval_prog, sub_keys, sub_values, resolution)
+                       sub_eval_prog, sub_keys, sub_values, resolution,
+                       collector)
 
     # evaluation
     # if map_type not set, use default 11point, only use in VOC eval
     map_type = cfg.map_type if 'map_type' in cfg else '11point'
+    # overlap_thresh can be a list, e.g. [0.5, 0.75], only use in VOC eval
+    overlap_thresh = cfg.overlap_thresh if 'overlap_thresh' in cfg else 0.5
+    # whether to log the AP of each class, only use in VOC eval
+    classwise = cfg.classwise if 'classwise' in cfg else False
     save_only = getattr(cfg, 'save_prediction_only', False)
-    eval_results(
+    box_ap_stats = eval_results(
         results,
         cfg.metric,
         cfg.num_classes,
@@ -172,7 +190,19 @@ def main():
         FLAGS.output_eval,
         map_type,
         dataset=dataset,
-        save_only=save_only)
+        save_only=save_only,
+        overlap_thresh=overlap_thresh,
+        num_workers=eval_workers,
+        classwise=classwise,
+        result_format=result_format)
+
+    # report to the training job in async eval mode, see tools/train.py,
+    # there are no stats when the predictions are only saved
+    if FLAGS.stats_file:
+        with open(FLAGS.stats_file, 'w') as f:
+            json.dump({
+                'box_ap_stats': [float(s) for s in box_ap_stats or []]
+            }, f)
 
 
 if __name__ == '__main__':
@@ -189,5 +219,10 @@ if __name__ == '__main__':
         default=None,
         type=str,
         help="Evaluation file directory, default is current directory.")
+    parser.add_argument(
+        "--stats_file",
+        default=None,
+        type=str,
+        help="Json file to write the box ap stats to.")
     FLAGS = parser.parse_args()
     main()
@@ -40,7 +40,7 @@ from ppdet.core.workspace import load_config, merge_config, create
 from ppdet.data.reader import create_reader
 
 from ppdet.utils import dist_utils
-from ppdet.utils.eval_utils import parse_fetches, eval_run, eval_results
+from ppdet.utils.eval_utils import parse_fetches, eval_run, eval_results, COCOResultCollector, AsyncEvaluator
 from ppdet.utils.stats import TrainingStats
 from ppdet.utils.cli import ArgsParser
 from ppdet.utils.check import check_gpu, check_xpu, check_version, check_config, enable_static_mode
@@ -154,7 +154,11 @@ def main():
     train_keys, train_values, _ = parse_fetches(train_fetches)
     train_values.append(lr)
 
-    if FLAGS.eval:
+    # in async eval mode, snapshots are evaluated by tools/eval.py
+    # in separate processes, no eval program is built here
+    async_eval = FLAGS.eval and FLAGS.async_eval
+    sync_eval = FLAGS.eval and not FLAGS.async_eval
+    if sync_eval:
         eval_prog = fluid.Program()
         with fluid.program_guard(eval_prog, startup_prog):
             with fluid.unique_name.guard():
@@ -205,7 +209,7 @@ def main():
     if use_xpu:
         compiled_train_prog = train_prog
 
-    if FLAGS.eval:
+    if sync_eval:
         compiled_eval_prog = fluid.CompiledProgram(eval_prog)
         if use_xpu:
             compiled_eval_prog = eval_prog
@@ -241,6 +245,15 @@ def main():
 
     # if map_type not set, use default 11point, only use in VOC eval
     map_type = cfg.map_type if 'map_type' in cfg else '11point'
+    # overlap_thresh can be a list, e.g. [0.5, 0.75], only use in VOC eval
+    overlap_thresh = cfg.overlap_thresh if 'overlap_thresh' in cfg else 0.5
+    # whether to log the AP of each class, only use in VOC eval
+    classwise = cfg.classwise if 'classwise' in cfg else False
+    # processes for the COCO per image evaluation, 0 to evaluate in process
+    eval_workers = cfg.eval_workers if 'eval_workers' in cfg else 0
+    # COCO results are saved as 'json' or 'npz', only use in COCO eval
+    result_format = cfg.eval_result_format \
+        if 'eval_result_format' in cfg else 'json'
 
     train_stats = TrainingStats(cfg.log_iter, train_keys)
     train_loader.start()
@@ -260,6 +273,42 @@ def main():
         vdl_loss_step = 0
         vdl_mAP_step = 0
 
+    if async_eval:
+        assert cfg.metric in ['COCO', 'VOC'], \
+            "async eval only supports COCO and VOC metric"
+        assert FLAGS.async_eval_max_pending > 0, \
+            "async_eval_max_pending should be at least 1"
+        # a CPU evaluation of a large model may take longer than the save
+        # interval, then training stalls waiting for it
+        assert FLAGS.async_eval_device, \
+            "--async_eval_device is required in async eval, set a GPU id " \
+            "or 'cpu'"
+        async_evaluator = AsyncEvaluator(
+            os.path.join(parent_path, 'tools', 'eval.py'),
+            FLAGS.config,
+            FLAGS.opt,
+            output_dir=FLAGS.output_eval or save_dir,
+            device=FLAGS.async_eval_device)
+
+    def update_best_model(finished):
+        for eval_it, weights, box_ap_stats in finished:
+            if len(box_ap_stats) == 0:
+                # e.g. save_prediction_only, there is no ap to compare
+                logger.info("No test box ap of iter {}".format(eval_it))
+                continue
+            # results may come out of order, log them at the snapshot iter
+            if FLAGS.use_vdl:
+                vdl_writer.add_scalar("mAP", box_ap_stats[0], eval_it)
+            logger.info("Test box ap of iter {}: {}".format(eval_it,
+                                                            box_ap_stats[0]))
+            if box_ap_stats[0] > best_box_ap_list[0]:
+                best_box_ap_list[0] = box_ap_stats[0]
+                best_box_ap_list[1] = eval_it
+                checkpoint.copy_model(weights,
+                                      os.path.join(save_dir, "best_model"))
+            logger.info("Best test box ap: {}, in iter: {}".format(
+                best_box_ap_list[0], best_box_ap_list[1]))
+
     for it in range(start_iter, cfg.max_iters):
         start_time = end_time
         end_time = time.time()
@@ -270,6 +319,9 @@ def main():
         outs = exe.run(compiled_train_prog, fetch_list=train_values)
         stats = {k: np.array(v).mean() for k, v in zip(train_keys, outs[:-1])}
 
+        if async_eval:
+            update_best_model(async_evaluator.poll())
+
         # use vdl-paddle to log loss
         if FLAGS.use_vdl:
             if it % cfg.log_iter == 0:
@@ -300,11 +352,19 @@ def main():
                 exe.run(ema.apply_program)
             checkpoint.save(exe, train_prog, os.path.join(save_dir, save_name))
 
-            if FLAGS.eval:
+            if async_eval:
+                # only block when too many snapshots are being evaluated
+                update_best_model(
+                    async_evaluator.wait(FLAGS.async_eval_max_pending - 1))
+                async_evaluator.submit(it, os.path.join(save_dir, save_name))
+            elif FLAGS.eval:
                 # evaluation
                 resolution = None
                 if 'Mask' in cfg.architecture:
                     resolution = model.mask_head.resolution
+                collector = COCOResultCollector(
+                    is_bbox_normalized,
+                    resolution) if cfg.metric == 'COCO' else None
                 results = eval_run(
                     exe,
                     compiled_eval_prog,
@@ -313,11 +373,16 @@ def main():
                     eval_values,
                     eval_cls,
                     cfg,
-                    resolution=resolution)
+                    resolution=resolution,
+                    collector=collector)
                 box_ap_stats = eval_results(
                     results, cfg.metric, cfg.num_classes, resolution,
                     is_bbox_normalized, FLAGS.output_eval, map_type,
-                    cfg['EvalReader']['dataset'])
+                    cfg['EvalReader']['dataset'],
+                    overlap_thresh=overlap_thresh,
+                    num_workers=eval_workers,
+                    classwise=classwise,
+                    result_format=result_format)
 
                 # use vdl_paddle to log mAP
                 if FLAGS.use_vdl:
@@ -337,6 +402,9 @@ def main():
 
     train_loader.reset()
 
+    if async_eval:
+        update_best_model(async_evaluator.wait())
+
 
 if __name__ == '__main__':
     enable_static_mode()
@@ -362,6 +430,24 @@ if __name__ == '__main__':
         action='store_true',
         default=False,
         help="Whether to perform evaluation in train")
+    parser.add_argument(
+        "--async_eval",
+        action='store_true',
+        default=False,
+        help="Evaluate snapshots in separate processes without blocking "
+        "training, only used with --eval.")
+    parser.add_argument(
+        "--async_eval_device",
+        default=None,
+        type=str,
+        help="GPU id to run async evaluation on, or 'cpu', required with "
+        "--async_eval. GPU ids index CUDA_VISIBLE_DEVICES if it is set.")
+    parser.add_argument(
+        "--async_eval_max_pending",
+        default=1,
+        type=int,
+        help="Max number of snapshots evaluated at the same time in async "
+        "eval, training waits for the oldest one when it is reached.")
     parser.add_argument(
         "--output_eval",
         default=None,